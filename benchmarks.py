@@ -0,0 +1,260 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import platform
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timezone
+
+import numpy as np
+import networkx as nx
+
+import construct_graphs
+import edge_store
+import model
+import sparse_centrality
+from csr_graph import CSRGraph
+
+# Bounding box of London (latitude, longitude) for synthetic cities
+LAT_RANGE = (51.28, 51.69)
+LNG_RANGE = (-0.51, 0.33)
+# Average speeds in km/h in the time intervals (see construct_graphs.temporal_graph)
+SPEEDS = (18, 24, 19, 30)
+
+
+def synthetic_city(n, path, k=16, seed=42):
+    """
+    Write a random city of n nodes into an edge store. Nodes are uniformly spread over
+    London, every node has directed edges to its k nearest nodes and travel times follow
+    from the distance, the speed of the time interval and random congestion.
+    :param n: number of nodes
+    :param path: directory of the edge store to write to
+    :param k: number of edges from every node
+    :param seed: seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    geo_loc = np.column_stack([rng.uniform(*LNG_RANGE, n), rng.uniform(*LAT_RANGE, n)])
+    edge_store.save_nodes(np.arange(n), geo_loc, path)
+
+    src, dst, dist = construct_graphs.spatial_edges(geo_loc, k=k)
+    # Undirected pairs from spatial_edges in both directions
+    src, dst, dist = np.concatenate([src, dst]), np.concatenate([dst, src]), np.concatenate([dist, dist])
+    for i, speed in enumerate(SPEEDS):
+        congestion = rng.lognormal(0, 0.3, len(src))
+        edge_store.save_edges(i, src, dst, 60 + 3600 * dist / speed * congestion, np.ones(len(src)), path)
+
+
+def measure(function, repeats=3):
+    """
+    Run function repeats times with its output hidden.
+    :return: a tuple of the result of the last run and the list of times in seconds
+    """
+    times = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            tic = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - tic)
+    return result, times
+
+
+def run_benchmarks(sizes=(1000,), repeats=3, pairs=100, max_exact=2000, max_dense=2000, max_sparse=20000,
+                   seed=42):
+    """
+    Benchmark graph construction, statistics, centralities, routing and model training
+    on synthetic cities of the given sizes.
+    Exact networkx centralities only run up to max_exact nodes, exact scipy closeness (a dijkstra
+    from every node) up to max_sparse nodes, and the complete spatial graph and everything that
+    keeps matrices between all pairs of nodes (precomputed travel times, features of models)
+    up to max_dense nodes. Larger cities use the k-nearest spatial graph and sampled centralities.
+    :param sizes: numbers of nodes of synthetic cities
+    :param repeats: number of runs of every benchmark
+    :param pairs: number of origin/destination pairs for routing
+    :param max_exact: largest city for exact networkx centralities
+    :param max_dense: largest city for the complete spatial graph and all-pairs matrices
+    :param max_sparse: largest city for exact scipy closeness
+    :param seed: seed of cities, pairs and models
+    :return: list of results, one dict per benchmark
+    """
+    results = []
+
+    def record(name, size, function, repeats=repeats):
+        result, times = measure(function, repeats)
+        results.append({"name": name, "size": size, "median": float(np.median(times)),
+                        "min": float(np.min(times)), "repeats": repeats})
+        print(f"{name:>32s} | {size:>7,d} | {np.median(times):10.4f} s", file=sys.stderr)
+        return result
+
+    for n in sizes:
+        path = tempfile.mkdtemp(prefix="city_")
+        try:
+            synthetic_city(n, path, seed=seed)
+
+            k = None if n <= max_dense else 8
+            record("spatial_graph", n, lambda: construct_graphs.spatial_graph(k=k, path=path))
+            graphs = [record(f"temporal_graph({i})", n, lambda i=i: construct_graphs.temporal_graph(i, path))
+                      for i in range(len(SPEEDS))]
+            G = graphs[0]
+
+            record("info", n, lambda: construct_graphs.info(G))
+            record("components", n, lambda: construct_graphs.components(G))
+
+            C = record("CSRGraph.temporal(0)", n, lambda: CSRGraph.temporal(0, path))
+            record("info (csr)", n, C.info)
+            record("components (csr)", n, C.components)
+
+            centralities = {
+                "pagerank (scipy)": sparse_centrality.pagerank,
+                "closeness (sampled)": lambda G: construct_graphs.approximate_closeness(G, budget=256, seed=seed),
+                "betweenness (sampled)": lambda G: construct_graphs.approximate_betweenness(G, budget=64, seed=seed),
+            }
+            if n <= max_sparse:
+                centralities["closeness (scipy)"] = sparse_centrality.closeness
+            if n <= max_exact:
+                centralities.update({"closeness": nx.closeness_centrality,
+                                     "betweenness": nx.betweenness_centrality,
+                                     "pagerank": nx.pagerank})
+            for label, centrality in centralities.items():
+                record(label, n, lambda: centrality(G.copy()), repeats=1)
+
+            rng = np.random.default_rng(seed)
+            od = rng.integers(n, size=(pairs, 2)).tolist()
+            record("predict_with_shortest_path", n, lambda: [model.predict_with_shortest_path(a, b, G) for a, b in od])
+            record("bfs_first_joint", n, lambda: [model.bfs_first_joint(a, b, G) for a, b in od])
+
+            for name, function in benchmark_cli(path, all_pairs=n <= max_dense).items():
+                record(name, n, function)
+
+            if n <= max_dense:
+                for name, function in benchmark_models(path, seed=seed).items():
+                    record(name, n, function, repeats=1)
+        finally:
+            shutil.rmtree(path)
+
+    return results
+
+
+def benchmark_cli(path, all_pairs=True):
+    """
+    Startup benchmarks of cli.py, every command runs in a new interpreter
+    as from a shell script, so the times include all imports.
+    :param path: directory of an edge store
+    :param all_pairs: also precompute travel times between all nodes and route with them
+    :return: dict of benchmark names and functions running them
+    """
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+    run = lambda *args: subprocess.run([sys.executable, cli, "--store", path, *args], check=True,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    benchmarks = {
+        "cli --help": lambda: run("--help"),
+        "cli route (dijkstra)": lambda: run("route", "0", "1", "--interval", "1"),
+    }
+    if all_pairs:
+        benchmarks["cli build --travel-times"] = lambda: run("build", "--graphs", "0", "--travel-times")
+        benchmarks["cli route (precomputed)"] = lambda: run("route", "0", "1")
+    benchmarks["import model"] = lambda: subprocess.run([sys.executable, "-c", "import model"], check=True,
+                                                        cwd=os.path.dirname(cli))
+    return benchmarks
+
+
+def learning_data(path, filename, rows=20000, seed=42):
+    """
+    Write synthetic learning data of a synthetic city in the format of google_data.py:
+    random locations near nodes and google times from shortest paths in the morning with noise.
+    """
+    from scipy.sparse import csgraph
+
+    rng = np.random.default_rng(seed)
+    ids, geo_loc = edge_store.load_nodes(path)
+    sources = rng.choice(len(ids), size=min(200, len(ids)), replace=False)
+    D = csgraph.dijkstra(construct_graphs.temporal_csr(0, path), indices=ids[sources])
+    row = np.arange(rows) % len(sources)
+    n1, n2 = sources[row], rng.integers(len(ids), size=rows)
+    seconds = D[row, ids[n2]]
+    found = np.isfinite(seconds)
+    n1, n2, seconds = n1[found], n2[found], seconds[found]
+
+    # Columns x1, y1, x2, y2 are latitude and longitude of the locations
+    locations = np.column_stack([geo_loc[n1][:, ::-1], geo_loc[n2][:, ::-1]]) + rng.normal(0, 0.002, (len(n1), 4))
+    hours = seconds * rng.lognormal(0, 0.2, len(n1)) / 3600
+    np.savetxt(filename, np.column_stack([locations, hours]), delimiter=",", header="x1,y1,x2,y2,google_time",
+               comments="")
+
+
+def benchmark_models(path, rows=20000, seed=42):
+    """
+    Benchmarks of the steps of model.do_model on synthetic learning data of a city: features
+    (features.load_features without cache) and training and inference of its regressors
+    on the same split.
+    :param path: directory of the edge store of the city
+    :return: dict of benchmark names and functions running them
+    """
+    from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+    from sklearn.model_selection import train_test_split
+
+    import features
+
+    filename = os.path.join(path, "learning_data.csv")
+    learning_data(path, filename, rows, seed)
+    data = {}
+
+    def load():
+        data["X"], data["y"], _ = features.load_features(filename, path=path, cache_dir=tempfile.mkdtemp(dir=path))
+        data["split"] = train_test_split(data["X"], data["y"], test_size=0.30, random_state=42)
+
+    benchmarks = {"load_features": load}
+    for name, regressor in (("random_forest", RandomForestRegressor), ("gradient_boosting", GradientBoostingRegressor)):
+        m = regressor(random_state=seed)
+        benchmarks[f"{name} fit"] = lambda m=m: m.fit(data["split"][0], data["split"][2])
+        benchmarks[f"{name} predict"] = lambda m=m: m.predict(data["split"][1])
+    return benchmarks
+
+
+def compare(results, baseline, threshold=1.2):
+    """
+    Benchmarks that got slower than threshold times their time in the baseline.
+    :param results: results of run_benchmarks
+    :param baseline: results of an earlier run
+    :return: list of (name, size, baseline time, time) of regressions
+    """
+    before = {(r["name"], r["size"]): r["median"] for r in baseline}
+    return [(r["name"], r["size"], before[r["name"], r["size"]], r["median"]) for r in results
+            if (r["name"], r["size"]) in before and r["median"] > threshold * before[r["name"], r["size"]]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of graph construction, centrality, routing and models")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000], help="nodes of synthetic cities")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--pairs", type=int, default=100, help="origin/destination pairs for routing")
+    parser.add_argument("--max-exact", type=int, default=2000, help="largest city for exact centralities")
+    parser.add_argument("--max-dense", type=int, default=2000,
+                        help="largest city for the complete spatial graph and all-pairs matrices")
+    parser.add_argument("--max-sparse", type=int, default=20000, help="largest city for exact scipy closeness")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmarks.json")
+    parser.add_argument("--compare", help="json of an earlier run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeats, args.pairs, args.max_exact, args.max_dense, args.max_sparse,
+                             seed=args.seed)
+    with open(args.output, "w") as f:
+        json.dump({
+            "meta": {"created": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+                      "platform": platform.platform(), "cpus": os.cpu_count(), "numpy": np.__version__,
+                      "networkx": nx.__version__, "seed": args.seed},
+            "results": results,
+        }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        for name, size, before, after in regressions:
+            print(f"Regression: {name} ({size:,d} nodes) {before:.4f} s -> {after:.4f} s")
+        sys.exit(1 if regressions else 0)
@@ -1,97 +1,43 @@
-import networkx as nx
-import construct_graphs
+import pipeline
+from csr_graph import CSRGraph
+import instrument
 
 if __name__ == "__main__":
+    instrument.configure()
 
     # Construct spatial graph
-    G_spat = construct_graphs.spatial_graph()
-    construct_graphs.info(G_spat)
+    # Graphs here are only needed for their statistics, so the compact
+    # array-backed graphs are used (see csr_graph.py)
+    G_spat = CSRGraph.spatial()
+    G_spat.info()
 
     print("\n")
 
     # Construct temporal graph for each time slot in the day
     # This means 4 different temporal directed graphs
-    G_temp_morning = construct_graphs.temporal_graph(0)
-    construct_graphs.info(G_temp_morning)
+    G_temp_morning = CSRGraph.temporal(0)
+    G_temp_morning.info()
 
     print("\n")
 
-    G_temp_mid = construct_graphs.temporal_graph(1)
-    construct_graphs.info(G_temp_mid)
+    G_temp_mid = CSRGraph.temporal(1)
+    G_temp_mid.info()
 
     print("\n")
 
-    G_temp_afternoon = construct_graphs.temporal_graph(2)
-    construct_graphs.info(G_temp_afternoon)
+    G_temp_afternoon = CSRGraph.temporal(2)
+    G_temp_afternoon.info()
 
     print("\n")
 
-    G_temp_night = construct_graphs.temporal_graph(3)
-    construct_graphs.info(G_temp_night)
+    G_temp_night = CSRGraph.temporal(3)
+    G_temp_night.info()
 
     print("\n")
 
-    # Closeness centrality    
-    print("Closeness centrality for spatial graph")
-    construct_graphs.tops(G_spat, nx.closeness_centrality, 'closeness')
+    # Closeness, betweenness and PageRank for every graph.
+    # These are independent jobs, so they run in parallel on a process pool
+    # (see pipeline.py) and their results are collected in one table.
+    results = pipeline.run()
+    pipeline.report(results)
 
-    print("Closeness centrality for temporal graph - morning")
-    construct_graphs.tops(G_temp_morning, nx.closeness_centrality, 'closeness')
-
-    print("Closeness centrality for temporal graph - mid")
-    construct_graphs.tops(G_temp_mid, nx.closeness_centrality, 'closeness')
-
-    print("Closeness centrality for temporal graph - afternoon")
-    construct_graphs.tops(G_temp_afternoon, nx.closeness_centrality, 'closeness')
-
-    print("Closeness centrality for temporal graph - night")
-    construct_graphs.tops(G_temp_night, nx.closeness_centrality, 'closeness')
-
-
-    # Betweenness centrality
-    print("Betweenness centrality for spatial graph")
-    construct_graphs.tops(G_spat, nx.betweenness_centrality, 'betweenness')
-
-    print("Betweenness centrality for temporal graph - morning")
-    construct_graphs.tops(G_temp_morning, nx.betweenness_centrality, 'betweenness')
-
-    print("Betweenness centrality for temporal graph - mid")
-    construct_graphs.tops(G_temp_mid, nx.betweenness_centrality, 'betweenness')
-
-    print("Betweenness centrality for temporal graph - afternoon")
-    construct_graphs.tops(G_temp_afternoon, nx.betweenness_centrality, 'betweenness')
-
-    print("Betweenness centrality for temporal graph - night")
-    construct_graphs.tops(G_temp_night, nx.betweenness_centrality, 'betweenness')
-
-    # PageRank
-    print("Pagerank for spatial graph")
-    construct_graphs.tops(G_spat, nx.pagerank, 'pagerank')
-
-    print("Pagerank for temporal graph - morning")
-    construct_graphs.tops(G_temp_morning, nx.pagerank, 'pagerank')
-
-    print("Pagerank for temporal graph - mid")
-    construct_graphs.tops(G_temp_mid, nx.pagerank, 'pagerank')
-
-    print("Pagerank for temporal graph - afternoon")
-    construct_graphs.tops(G_temp_afternoon, nx.pagerank, 'pagerank')
-
-    print("Pagerank for temporal graph - night")
-    construct_graphs.tops(G_temp_night, nx.pagerank, 'pagerank')
-
-    # HITS
-    # print("Pagerank for spatial graph")
-    # construct_graphs.tops(G_spat, nx.pagerank, 'pagerank')
-
-    # print("Pagerank for temporal graph - morning")
-    # construct_graphs.tops(G_temp_morning, nx.pagerank, 'pagerank')
-
-    # print("Pagerank for temporal graph - mid")
-    # construct_graphs.tops(G_temp_mid, nx.pagerank, 'pagerank')
-
-    # print("Pagerank for temporal graph - afternoon")
-    # construct_graphs.tops(G_temp_afternoon, nx.pagerank, 'pagerank')
-
-    # print("Pagerank for temporal graph - night")
-    # construct_graphs.tops(G_temp_night, nx.pagerank, 'pagerank')
@@ -0,0 +1,231 @@
+"""
+Command line interface of the analysis:
+
+    python cli.py ingest        read the uber csv into the edge store (main.read_from_csv)
+    python cli.py merge A B     combine edge stores of several exports (sketches.merge_stores)
+    python cli.py build         statistics of graphs and precomputed travel times
+    python cli.py centrality    top nodes of centralities of all graphs (pipeline.py)
+    python cli.py route A B     travel time and path between two nodes
+    python cli.py train         train and save the models (model.do_model)
+    python cli.py predict       predict travel times with a saved model (inference.py)
+
+Every command imports only the modules it needs, so a route query does not pay for
+importing sklearn, matplotlib or pandas. Graphs are loaded from the edge store and travel
+times precomputed by build are reused, nothing is rebuilt from the json or csv files.
+Startup times of the commands are measured by benchmarks.py (see benchmark_cli).
+"""
+import sys
+import json
+import argparse
+
+import edge_store
+import inference
+import instrument
+
+
+# Time intervals of the temporal graphs (see main.HOD_INTERVALS)
+INTERVALS = range(4)
+
+
+def interval_or_graph(value):
+    if value == "spatial":
+        return value
+    if not value.isdigit() or int(value) not in INTERVALS:
+        raise argparse.ArgumentTypeError(f"expected spatial or a time interval 0-{INTERVALS[-1]}, got {value!r}")
+    return int(value)
+
+
+def ingest(args):
+    if args.from_json:
+        edge_store.from_json(path=args.store)
+        return
+
+    import main
+
+    main.read_from_csv(args.input, args.geojson, store_path=args.store, chunksize=args.chunksize,
+                       hod_slices=None if args.no_slices else main.HOURLY, sketch=not args.no_sketches)
+
+
+def merge(args):
+    import sketches
+
+    sketches.merge_stores(args.stores, args.store)
+
+
+def build(args):
+    from csr_graph import CSRGraph
+
+    for graph in args.graphs:
+        G = CSRGraph.spatial(k=args.k, path=args.store) if graph == "spatial" else CSRGraph.temporal(graph, args.store)
+        G.info()
+        if args.travel_times and graph != "spatial":
+            import travel_times
+
+            # Only computed when missing or when the edges changed since
+            travel_times.all_sources(graph, args.jobs, args.store)
+        if args.landmarks and graph != "spatial":
+            import routing
+
+            routing.build_landmarks(graph, args.landmarks, seed=0, path=args.store)
+
+
+def centrality(args):
+    import pipeline
+
+    graphs = {graph: pipeline.GRAPHS.get(graph, str(graph)) for graph in args.graphs}
+    sampling = {name: value for name, value in (("budget", args.samples), ("error", args.error)) if value is not None}
+    table = pipeline.run(graphs, args.metrics, n=args.top, n_jobs=args.jobs, path=args.store,
+                         backend=args.backend, cache=not args.no_cache, sampling=sampling)
+    pipeline.report(table, graphs)
+
+
+def nearest_node(location, path):
+    """
+    Node id of a command line location: a node id or "latitude,longitude" of the nearest node.
+    """
+    if "," not in location:
+        return int(location)
+
+    import numpy as np
+    from scipy.spatial import cKDTree
+
+    from features import unit_vectors
+
+    lat, lng = map(float, location.split(","))
+    ids, geo_loc = edge_store.load_nodes(path)
+    _, ind = cKDTree(unit_vectors(geo_loc[:, 1], geo_loc[:, 0])).query(unit_vectors(np.array([lat]), np.array([lng])))
+    return int(ids[ind[0]])
+
+
+def route(args):
+    """
+    Travel time between two nodes in seconds, looked up in precomputed travel times when they
+    are current (see travel_times.all_sources), otherwise searched with A* and landmark bounds
+    when build --landmarks built them for the current edges (see routing.Landmarks),
+    otherwise with one dijkstra from the source.
+    Edges can be weighted by other statistics than the mean, eg. p90 for risk-aware routes.
+    With a departure time the route is time-dependent (see routing.time_dependent_search).
+    """
+    n1, n2 = nearest_node(args.source, args.store), nearest_node(args.target, args.store)
+    if args.departure is not None:
+        if not edge_store.has_slices(args.store):
+            sys.exit("No time slices in the edge store, run ingest first")
+        import routing
+        from csr_graph import TimeDependentGraph
+
+        hours, minutes = map(int, args.departure.split(":"))
+        G = TimeDependentGraph.from_store(args.store)
+        seconds, path = routing.time_dependent_search(G, n1, n2, 3600 * hours + 60 * minutes)
+        result = {"source": n1, "target": n2, "departure": args.departure, "seconds": seconds, "path": path}
+    else:
+        import routing
+        import travel_times
+
+        landmarks = routing.load_landmarks(args.interval, args.store) if args.statistic == "mean" else None
+        if args.statistic == "mean" and travel_times.is_current(args.interval, args.store):
+            D, P = travel_times.all_sources(args.interval, path=args.store)
+            path = travel_times.shortest_path(P[n1], n1, n2)
+            seconds = None if path is None else float(D[n1, n2])
+        elif landmarks is not None:
+            import construct_graphs
+
+            seconds, path = landmarks.route(construct_graphs.temporal_graph(args.interval, args.store), n1, n2)
+        else:
+            import construct_graphs
+
+            A = construct_graphs.temporal_csr(args.interval, args.store, args.statistic)
+            times, predecessors = (row[0] for row in travel_times.shortest_paths(A, [n1]))
+            path = travel_times.shortest_path(predecessors, n1, n2)
+            seconds = None if path is None else float(times[n2])
+        result = {"source": n1, "target": n2, "interval": args.interval, "statistic": args.statistic,
+                  "seconds": seconds, "path": path}
+
+    if args.json:
+        print(json.dumps(result))
+        return
+    print("{:>12s} | {} -> {}".format('Route', n1, n2))
+    if result["seconds"] is None:
+        print("{:>12s} | no path".format('Time'))
+        return
+    print("{:>12s} | {:.0f} s ({:.1f} min)".format('Time', result["seconds"], result["seconds"] / 60))
+    print("{:>12s} | {}".format('Path', " -> ".join(map(str, result["path"]))))
+
+
+def train(args):
+    import model
+
+    model.do_model(args.input, plot=not args.no_plot)
+
+
+def predict(args):
+    inference.run(args)
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Analysis of the uber movement graphs of London")
+    parser.add_argument("--store", default=edge_store.STORE_DIR, help="directory of the edge store")
+    parser.add_argument("--log-level", help="logging level, by default INA_LOG_LEVEL or INFO")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("ingest", help="read the uber csv into the edge store")
+    p.add_argument("--input", default="london-lsoa-2020-1-All-HourlyAggregate.csv")
+    p.add_argument("--geojson", default="london_lsoa.json")
+    p.add_argument("--chunksize", type=int, default=1_000_000)
+    p.add_argument("--no-slices", action="store_true", help="skip the time slices of time-dependent routing")
+    p.add_argument("--no-sketches", action="store_true", help="skip the sketches of travel times")
+    p.add_argument("--from-json", action="store_true", help="convert json files of an older version instead")
+    p.set_defaults(run=ingest)
+
+    p = commands.add_parser("merge", help="combine edge stores of several exports into --store")
+    p.add_argument("stores", nargs="+", help="directories of the edge stores to merge")
+    p.set_defaults(run=merge)
+
+    p = commands.add_parser("build", help="graph statistics and precomputed travel times")
+    p.add_argument("--graphs", type=interval_or_graph, nargs="+", default=["spatial", 0, 1, 2, 3],
+                   help="spatial or time intervals")
+    p.add_argument("--k", type=int, help="neighbours in the spatial graph, complete graph by default")
+    p.add_argument("--travel-times", action="store_true", help="precompute travel times between all nodes")
+    p.add_argument("--landmarks", type=int, metavar="K", help="build K landmarks for A* routes (see routing.py)")
+    p.add_argument("--jobs", type=int, help="number of worker processes")
+    p.set_defaults(run=build)
+
+    p = commands.add_parser("centrality", help="top nodes of centralities")
+    p.add_argument("--graphs", type=interval_or_graph, nargs="+", default=["spatial", 0, 1, 2, 3],
+                   help="spatial or time intervals")
+    p.add_argument("--metrics", nargs="+", default=["betweenness", "closeness", "pagerank"],
+                   help="metrics of pipeline.METRICS, eg. sampled_betweenness for an estimate from sampled pivots")
+    p.add_argument("--top", type=int, default=15)
+    p.add_argument("--jobs", type=int, help="number of worker processes")
+    p.add_argument("--backend", default="networkx", choices=["networkx", "scipy"])
+    p.add_argument("--no-cache", action="store_true", help="recompute results of unchanged graphs")
+    p.add_argument("--samples", type=int, help="most pivots of sampled metrics, by default until the top is stable")
+    p.add_argument("--error", type=float, help="sample until the error of sampled metrics is below this")
+    p.set_defaults(run=centrality)
+
+    p = commands.add_parser("route", help="travel time between two nodes")
+    p.add_argument("source", help="node id or latitude,longitude")
+    p.add_argument("target", help="node id or latitude,longitude")
+    p.add_argument("--interval", type=int, default=0, choices=INTERVALS, help="time interval of the temporal graph")
+    p.add_argument("--departure", help="time of departure as HH:MM for time-dependent routing")
+    p.add_argument("--statistic", default="mean", help="travel time statistic of edges, eg. p90 (see sketches.py)")
+    p.add_argument("--json", action="store_true", help="print the result as json")
+    p.set_defaults(run=route)
+
+    p = commands.add_parser("train", help="train and save the models")
+    p.add_argument("--input", default="learning_data_all.csv")
+    p.add_argument("--no-plot", action="store_true")
+    p.set_defaults(run=train)
+
+    p = inference.add_arguments(commands.add_parser("predict", help="predict travel times with a saved model"))
+    p.set_defaults(run=predict)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    instrument.configure(args.log_level)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,158 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import networkx as nx
+from scipy import sparse
+
+import construct_graphs
+import edge_store
+from csr_graph import CSRGraph
+from instrument import span
+
+# Community detection methods of networkx, all of them take a weight and a seed
+METHODS = {
+    "louvain": lambda G, seed, resolution: nx.community.louvain_communities(
+        G, weight="weight", resolution=resolution, seed=seed),
+    "label_propagation": lambda G, seed, resolution: nx.community.asyn_lpa_communities(
+        G, weight="weight", seed=seed),
+}
+
+
+def affinity(A):
+    """
+    Undirected affinities between nodes from a matrix of travel times (or distances):
+    the affinity of a pair is the sum of 1 / time of edges in both directions,
+    so parts of the city that are quick to travel between end up in the same community.
+    """
+    S = sparse.coo_matrix(A).astype(np.float64)
+    off = S.row != S.col
+    S = sparse.csr_matrix((S.data[off], (S.row[off], S.col[off])), shape=S.shape)
+    S.data = 1.0 / S.data
+    return (S + S.T).tocsr()
+
+
+def load_matrix(graph, path=edge_store.STORE_DIR, k=8):
+    """
+    Matrix of a graph to cluster: "spatial" is the spatial graph of k nearest neighbours
+    (the complete one has no structure to find), "contiguity" the graph of neighbouring
+    districts and numbers are time intervals of temporal graphs.
+    """
+    if graph == "spatial":
+        return construct_graphs.spatial_csr(k=k, path=path)
+    if graph == "contiguity":
+        G = construct_graphs.contiguity_graph(path)
+        return nx.to_scipy_sparse_array(G, nodelist=sorted(G), format="csr")
+    return construct_graphs.temporal_csr(graph, path)
+
+
+def detect(graph, method="louvain", seed=42, resolution=1.0, path=edge_store.STORE_DIR):
+    """
+    Find communities of one graph.
+    :param graph: graph to cluster (see load_matrix)
+    :param method: name of the method (see METHODS)
+    :param seed: seed of the method, the same seed gives the same communities
+    :param resolution: resolution of louvain, larger values give smaller communities
+    :param path: directory of the edge store
+    :return: dict with the community label of every node (largest community is 0),
+        community sizes, modularity and time in seconds
+    """
+    with span("communities." + method, graph=graph) as s:
+        tic = time.time()
+        A = load_matrix(graph, path)
+        S = affinity(A)
+        s.graph(S)
+        G = nx.from_scipy_sparse_array(S, edge_attribute="weight")
+        C = sorted(map(sorted, METHODS[method](G, seed, resolution)), key=len, reverse=True)
+
+        labels = np.empty(A.shape[0], dtype=np.int32)
+        for label, nodes in enumerate(C):
+            labels[nodes] = label
+        modularity = nx.community.modularity(G, C, weight="weight")
+        s.set(communities=len(C), modularity=modularity)
+
+    return {"graph": graph, "method": method, "labels": labels, "sizes": [len(c) for c in C],
+            "modularity": modularity, "time": time.time() - tic}
+
+
+def run(graphs=range(4), method="louvain", seed=42, resolution=1.0, n_jobs=None, path=edge_store.STORE_DIR):
+    """
+    Find communities of all graphs in parallel, one worker process per graph.
+    :return: list of results of detect in the order of graphs
+    """
+    graphs = list(graphs)
+    n_jobs = n_jobs or min(len(graphs), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(detect, graphs, [method] * len(graphs), [seed] * len(graphs),
+                                 [resolution] * len(graphs), [path] * len(graphs)))
+
+
+def similarity(results):
+    """
+    Adjusted Rand index between partitions of all pairs of graphs, 1 for the same communities
+    and about 0 for unrelated ones, to see how regions change between time intervals.
+    :return: matrix with a row and a column per result
+    """
+    from sklearn.metrics import adjusted_rand_score
+
+    return np.array([[adjusted_rand_score(a["labels"], b["labels"]) for b in results] for a in results])
+
+
+def quotient(A, labels, reduce="mean"):
+    """
+    Coarsen a graph by its communities: every community becomes one node and the weight of an edge
+    between two communities is the mean (or min) weight of edges between their nodes.
+    Routing and centralities on the small quotient graph give a first estimate for the whole graph.
+    :param A: weighted adjacency matrix, eg. travel times of a temporal graph
+    :param labels: community label of every node (see detect)
+    :param reduce: "mean" or "min" of weights of edges between communities
+    :return: CSRGraph with a node per community, without self-loops
+    """
+    A = sparse.coo_matrix(A)
+    keep = labels[A.row] != labels[A.col]
+    src, dst, weight = labels[A.row[keep]], labels[A.col[keep]], A.data[keep]
+
+    n = int(labels.max()) + 1
+    key, position = np.unique(src.astype(np.int64) * n + dst, return_inverse=True)
+    if reduce == "mean":
+        weight = np.bincount(position, weights=weight) / np.bincount(position)
+    else:
+        weight = np.full(len(key), np.inf)
+        np.minimum.at(weight, position, A.data[keep])
+    return CSRGraph.from_edges(key // n, key % n, weight, np.arange(n), directed=True, name="Quotient graph")
+
+
+def lift(values, labels):
+    """
+    Values of communities (eg. centralities of the quotient graph) as values of their nodes.
+    """
+    return np.asarray(values)[labels]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Communities of the temporal and spatial graphs")
+    parser.add_argument("--graphs", nargs="+", default=["0", "1", "2", "3"],
+                        help="time intervals, spatial or contiguity")
+    parser.add_argument("--method", default="louvain", choices=list(METHODS))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--resolution", type=float, default=1.0)
+    parser.add_argument("--jobs", type=int, help="number of worker processes")
+    parser.add_argument("--save", action="store_true", help="save labels into the edge store")
+    args = parser.parse_args()
+
+    graphs = [int(g) if g.isdigit() else g for g in args.graphs]
+    results = run(graphs, args.method, args.seed, args.resolution, args.jobs)
+    for result in results:
+        print("{:>12s} | '{}'".format('Graph', result["graph"]))
+        print("{:>12s} | {:,d}".format('Communities', len(result["sizes"])))
+        print("{:>12s} | {:.4f}".format('Modularity', result["modularity"]))
+        print("{:>12s} | {}".format('Sizes', ", ".join(map(str, result["sizes"][:10]))))
+        print("{:>12s} | {:.1f} s".format('Time', result["time"]))
+        print()
+        if args.save:
+            edge_store.save_array(f"communities_{result['graph']}_{args.method}", result["labels"])
+
+    print("Adjusted Rand index between graphs")
+    print(np.array2string(similarity(results), precision=2))
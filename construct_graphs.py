@@ -1,11 +1,19 @@
 import networkx as nx
-import haversine as hs
+import numpy as np
 import operator
+import heapq
+import random
 import json
 import time
+import logging
+
+import edge_store
+from instrument import span
 
 from collections import deque
 
+logger = logging.getLogger(__name__)
+
 def isolated(G, i):
   for j in G[i]:
     if j != i:
@@ -77,59 +85,469 @@ def tops(G, centrality, label, n = 15):
   print("{:>12s} | '{:s}'".format('Centrality', label))
   
   tic = time.time()
-  C = centrality(G)
+  with span("centrality." + label) as s:
+    T = top_k(G, centrality, n, label)
+    s.graph(G)
   
-  for p, (i, c) in enumerate(sorted(C.items(), key = operator.itemgetter(1), reverse = True)):
-    if p < n:
-      print("{:>12.6f} | '{:d}' ({:,d})".format(c, G.nodes[i]['label'], G.degree[i]))
+  for i, c in T:
+    print("{:>12.6f} | '{:d}' ({:,d})".format(c, G.nodes[i]['label'], G.degree[i]))
       
+  C = T.result
+  if isinstance(C, Estimate):
+    print("{:>12s} | {:,d} ({:,d} rounds)".format('Samples', C.samples, C.rounds))
+    print("{:>12s} | {:.1f}% of top {:,d}".format('Stability', 100 * C.stability, len(C.top)))
+    print("{:>12s} | {:.2e}".format('Error', C.error))
+
   print("{:>12s} | {:.1f} s".format('Time', time.time() - tic))
   print()
+  return T
+
+class TopK(list):
+  """
+  Top k nodes of a centrality as (node, value) pairs, the highest value first.
+  Besides the pairs it keeps the label of the centrality and the full result
+  of the centrality function when there was one (None for pruned searches).
+  """
+  def __init__(self, items, label = None, result = None):
+    super().__init__(items)
+    self.label = label
+    self.result = result
+    self._ranks = {i: r for r, (i, _) in enumerate(self, start = 1)}
+
+  def rank(self, r):
+    """
+    Node and value at rank r (the first rank is 1).
+    """
+    return self[r - 1]
+
+  def node(self, i):
+    """
+    Rank and value of node i, None if it is not in the top k.
+    """
+    r = self._ranks.get(i)
+    return None if r is None else (r, self[r - 1][1])
+
+def graph_version(G):
+  """
+  Version token of the weights of G: the version of the edges in the edge store it was built from
+  and a counter of changes since. Code that changes nodes, edges or weights of G in place calls
+  touch(G), so results cached in G.graph (see top_k and sparse_centrality.to_csr) are recomputed.
+  """
+  return (G.graph.get("edge_version"), G.graph.get("changes", 0))
+
+def touch(G):
+  """
+  Mark G as changed in place (see graph_version).
+  """
+  G.graph["changes"] = G.graph.get("changes", 0) + 1
+
+def top_k(G, centrality, k = 15, label = None, **kwargs):
+  """
+  Top k nodes of a centrality selected with a heap instead of sorting all nodes.
+  Centralities with a top_k attribute (see closeness) compute only the top k nodes.
+  Results are cached in G.graph per centrality callable and keyword arguments, so asking for the same
+  (or a smaller) top again with the same function does not compute the centrality again, until nodes,
+  edges or weights of G change (see graph_version).
+  :param centrality: function G -> dict of centralities (any callable, eg. a lambda or functools.partial)
+  :param k: number of nodes
+  :param label: name of the centrality in the output, the name of the function by default
+  :param kwargs: keyword arguments of the centrality, eg. distance = "weight"
+  :return: TopK
+  """
+  label = label or getattr(centrality, "__name__", None) or getattr(getattr(centrality, "func", None), "__name__", repr(centrality))
+  key = (centrality, tuple(sorted(kwargs.items())))
+  state = (G.number_of_nodes(), G.number_of_edges(), graph_version(G))
+  cache = G.graph.setdefault("top_k", {})
+  if key in cache and cache[key][0] == state and len(cache[key][1]) >= min(k, len(G)):
+    T = cache[key][1]
+    return TopK(T[:k], label, T.result)
+
+  if hasattr(centrality, "top_k"):
+    T = centrality.top_k(G, k, **kwargs)
+    T.label = label
+  else:
+    C = centrality(G, **kwargs)
+    T = TopK(heapq.nlargest(k, C.items(), key = operator.itemgetter(1)), label, C)
+  cache[key] = (state, T)
+  return T
+
+def closeness_top_k(G, k = 15, distance = None, pivots = 64, seed = 0):
+  """
+  Top k nodes of closeness centrality (as nx.closeness_centrality, incoming distances)
+  with pruned searches. A search stops as soon as its node can no longer get into the current top k:
+  after r nodes with total distance S are reached and every other node is at least d away, the
+  closeness is at most max(g(r), g(n)) / (n - 1) where g(x) = (x - 1)^2 / (S + (x - r) d), as g is convex.
+  Breadth-first searches also use that at most the sum of degrees of the last level are on the next one.
+  Nodes are searched in the order of closeness estimated from a few pivots (or of degree without
+  distance), so the top k fills up with good nodes early and most searches stop after a few steps.
+  :param distance: edge attribute with the distance, the number of edges if None
+  :param pivots: number of pivots of the estimate of the order (see approximate_closeness)
+  :param seed: seed of the pivots
+  :return: TopK
+  """
+  n = len(G)
+  # Incoming distances are outgoing distances in the reversed graph, plain lists
+  # of (neighbour, distance) are much faster to walk than networkx views
+  pred = G.pred if G.is_directed() else G.adj
+  adj = {i: [(j, data.get(distance, 1) if distance else 1) for j, data in pred[i].items()] for i in G}
+  if distance is None:
+    order = sorted(G, key = lambda i: len(adj[i]), reverse = True)
+  else:
+    estimate = approximate_closeness(G, distance, budget = pivots, batch = pivots, patience = 1, seed = seed)
+    order = sorted(G, key = estimate.get, reverse = True)
+
+  def g(x, r, S, d):
+    return (x - 1) ** 2 / (S + (x - r) * d) if S + (x - r) * d > 0 else 0.0
+
+  top = []  # min-heap of (value, position, node) of the best nodes so far
+  for p, v in enumerate(order):
+    threshold = top[0][0] if len(top) == k else -1.0
+    seen, S, r, pruned = {v: 0}, 0, 1, False
+    if distance is None:
+      # Breadth-first search level by level: at most `width` nodes are on the next level,
+      # all other nodes are at least one more level away
+      level, frontier = 0, [v]
+      while frontier:
+        width = min(sum(len(adj[i]) for i in frontier), n - r)
+        near = S + (level + 1) * width
+        best = max(g(r, r, S, level + 1), g(r + width, r, S, level + 1), g(n, r + width, near, level + 2))
+        if best / (n - 1) <= threshold:
+          pruned = True
+          break
+        level += 1
+        reached = []
+        for i in frontier:
+          for j, _ in adj[i]:
+            if j not in seen:
+              seen[j] = level
+              reached.append(j)
+        frontier = reached
+        r += len(frontier)
+        S += level * len(frontier)
+    else:
+      Q, done = [(0, v)], set()
+      while Q:
+        dist, i = heapq.heappop(Q)
+        if i in done:
+          continue
+        done.add(i)
+        if i != v:
+          r, S = r + 1, S + dist
+        for j, w in adj[i]:
+          dj = dist + w
+          if dj < seen.get(j, float('inf')):
+            seen[j] = dj
+            heapq.heappush(Q, (dj, j))
+        while Q and Q[0][1] in done:
+          heapq.heappop(Q)
+        if Q and max(g(r, r, S, Q[0][0]), g(n, r, S, Q[0][0])) / (n - 1) <= threshold:
+          pruned = True
+          break
+
+    if pruned:
+      continue
+    c = (r - 1) ** 2 / (S * (n - 1)) if S > 0 and n > 1 else 0.0
+    if len(top) < k:
+      heapq.heappush(top, (c, -p, v))
+    elif c > top[0][0]:
+      heapq.heapreplace(top, (c, -p, v))
+
+  return TopK([(v, c) for c, _, v in sorted(top, reverse = True)], 'closeness')
+
+def closeness(G, distance = None):
+  """
+  Closeness centrality of all nodes (nx.closeness_centrality), with
+  the pruned closeness_top_k used by top_k and tops.
+  """
+  return nx.closeness_centrality(G, distance = distance)
+
+closeness.top_k = closeness_top_k
+
+class Estimate(dict):
+  """
+  Centrality values estimated from sampled source nodes (pivots).
+  Besides the values it keeps the number of samples and rounds, the largest
+  95% confidence half-width of the values (error) and the share of the top n
+  nodes that did not change in the last round (stability).
+  """
+  samples = 0
+  rounds = 0
+  error = float('inf')
+  stability = 0.0
+  top = ()
+
+def sampled_centrality(G, sample, value, n = 15, batch = 32, budget = None, error = None, min_stability = 1.0, patience = 2, seed = None):
+  """
+  Estimates centrality from batches of random pivots until the estimate is good enough.
+  Without error the sampling stops once at least min_stability of the top n nodes
+  stay the same for patience rounds in a row, with error it stops once the confidence half-width
+  of every value is below error. It always stops after budget pivots.
+  :param sample: function (G, pivots) returning an array of per-node accumulators for the pivots
+  :param value: function (accumulators, number of pivots) returning an array of centralities
+  :param batch: number of pivots per round
+  :param budget: maximum number of pivots, all nodes by default (then the result is exact)
+  :param seed: seed of the random generator
+  :return: Estimate
+  """
+  nodes = list(G)
+  random.Random(seed).shuffle(nodes)
+  budget = len(nodes) if budget is None else min(budget, len(nodes))
+
+  total, rounds, stable = None, [], 0
+  C = Estimate()
+  for start in range(0, budget, batch):
+    pivots = nodes[start:min(start + batch, budget)]
+    acc = sample(G, pivots)
+    total = acc if total is None else total + acc
+    rounds.append(value(acc, len(pivots)))
+
+    top = C.top
+    C = Estimate(zip(G, value(total, start + len(pivots)).tolist()))
+    C.samples, C.rounds = start + len(pivots), len(rounds)
+    C.top = [i for i, _ in heapq.nlargest(n, C.items(), key = operator.itemgetter(1))]
+    C.stability = len(set(top) & set(C.top)) / len(C.top) if C.top else 1.0
+    if len(rounds) > 1:
+      C.error = 1.96 * np.std(rounds, axis = 0, ddof = 1).max() / np.sqrt(len(rounds))
+
+    stable = stable + 1 if C.stability >= min_stability else 0
+    if error is None and stable >= patience or error is not None and C.error <= error:
+      break
+
+  return C
+
+def approximate_betweenness(G, weight = None, **kwargs):
+  """
+  Betweenness centrality (as nx.betweenness_centrality) estimated from sampled
+  source nodes, see sampled_centrality for the arguments.
+  """
+  def sample(G, pivots):
+    B = nx.betweenness_centrality_subset(G, pivots, list(G), normalized = True, weight = weight)
+    return np.array([B[i] for i in G])
+
+  return sampled_centrality(G, sample, lambda acc, k: acc * len(G) / k, **kwargs)
+
+def approximate_closeness(G, distance = None, **kwargs):
+  """
+  Closeness centrality (as nx.closeness_centrality, incoming distances) estimated
+  from distances of sampled source nodes, see sampled_centrality for the arguments.
+  """
+  index = {i: p for p, i in enumerate(G)}
+
+  def sample(G, pivots):
+    # Columns: sum of distances from pivots, number of pivots reaching the node, number of other pivots
+    acc = np.zeros((len(G), 3))
+    acc[:, 2] = len(pivots)
+    for pivot in pivots:
+      if distance is None:
+        D = nx.single_source_shortest_path_length(G, pivot)
+      else:
+        D = nx.single_source_dijkstra_path_length(G, pivot, weight = distance)
+      for i, d in D.items():
+        acc[index[i], 0] += d
+        acc[index[i], 1] += 1
+      acc[index[pivot], 1:] -= 1
+    return acc
+
+  def value(acc, k):
+    # Share of nodes reaching a node divided by their average distance to it
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      c = acc[:, 1] ** 2 / (acc[:, 2] * acc[:, 0])
+    return np.nan_to_num(c, nan = 0.0, posinf = 0.0)
+
+  return sampled_centrality(G, sample, value, **kwargs)
 
-def spatial_graph():
+# Mean earth radius in kilometers, the same one the haversine package uses
+EARTH_RADIUS = 6371.0088
+
+def read_nodes(path = edge_store.STORE_DIR, filename = "./nodes_data.json"):
+  """
+  Reads the node table and returns node ids with their coordinates.
+  The binary store is memory-mapped when it exists, otherwise the json file is parsed.
+  :param path: directory of the edge store
+  :param filename: json file written by main.read_from_csv
+  :return: a tuple of
+      - ids: int array of node ids
+      - geo_loc: float array of shape (n, 2) with [longitude, latitude] per node
+  """
+  if edge_store.has_nodes(path):
+    return edge_store.load_nodes(path)
+
+  with open(filename) as f:
+    data = json.load(f)
+  ids = np.array([int(node['node_id']) for node in data], dtype = np.int32)
+  geo_loc = np.array([node['geo_loc'] for node in data], dtype = np.float64)
+  return ids, geo_loc
+
+def haversine(lat1, lng1, lat2, lng2):
+  """
+  Vectorized haversine distance in kilometers. Arguments are in degrees and
+  can be any numpy-broadcastable arrays, so the same function computes
+  a single distance, a distance per row or a full distance matrix.
+  """
+  lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+  a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+  return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def haversine_matrix(geo_loc):
+  """
+  Distance matrix between all pairs of [longitude, latitude] locations in kilometers.
+  """
+  lng, lat = geo_loc[:, 0], geo_loc[:, 1]
+  return haversine(lat[:, None], lng[:, None], lat[None, :], lng[None, :])
+
+def spatial_edges(geo_loc, k = None, radius = None):
+  """
+  Computes the edges of the spatial graph as arrays (no python loops).
+  Without k and radius all pairs (including self-loops) are returned,
+  otherwise only the k nearest neighbours of each node or all
+  neighbours closer than radius kilometers, found with a BallTree.
+  :param geo_loc: float array of shape (n, 2) with [longitude, latitude] per node
+  :param k: number of nearest neighbours per node
+  :param radius: maximum distance of an edge in kilometers
+  :return: a tuple of src, dst (indices into geo_loc) and distance arrays
+  """
+  n = len(geo_loc)
+  if k is None and radius is None:
+    src, dst = np.triu_indices(n)
+    D = haversine_matrix(geo_loc)
+    return src, dst, D[src, dst]
+
+  # sklearn is only needed for the sparse modes
+  from sklearn.neighbors import BallTree
+
+  # BallTree expects [latitude, longitude] in radians and returns distances on a unit sphere
+  points = np.radians(geo_loc[:, ::-1])
+  tree = BallTree(points, metric = 'haversine')
+  if k is not None:
+    dist, ind = tree.query(points, k = min(k + 1, n))
+    src = np.repeat(np.arange(n), ind.shape[1])
+    dst, dist = ind.ravel(), dist.ravel()
+  else:
+    ind, dist = tree.query_radius(points, r = radius / EARTH_RADIUS, return_distance = True)
+    src = np.repeat(np.arange(n), [len(i) for i in ind])
+    dst, dist = np.concatenate(ind), np.concatenate(dist)
+
+  # Drop self-loops and keep every undirected pair only once
+  keep = src != dst
+  src, dst, dist = src[keep], dst[keep], dist[keep]
+  src, dst = np.minimum(src, dst), np.maximum(src, dst)
+  _, first = np.unique(src * n + dst, return_index = True)
+  return src[first], dst[first], dist[first] * EARTH_RADIUS
+
+def spatial_csr(k = None, radius = None, path = edge_store.STORE_DIR):
+  """
+  Spatial graph (without self-loops) as a symmetric scipy CSR matrix of distances,
+  see spatial_graph for the arguments. Rows and columns are indexed by node ids.
+  """
+  from scipy.sparse import csr_matrix
+
+  ids, geo_loc = read_nodes(path)
+  n = int(ids.max()) + 1
+  src, dst, dist = spatial_edges(geo_loc, k = k, radius = radius)
+  keep = src != dst
+  src, dst, dist = ids[src[keep]], ids[dst[keep]], dist[keep]
+  return csr_matrix((np.concatenate([dist, dist]), (np.concatenate([src, dst]), np.concatenate([dst, src]))), shape = (n, n))
+
+def spatial_graph(k = None, radius = None, path = edge_store.STORE_DIR):
     """
     Function construts a spatial graph where
     each node represents a part of the city
     and each weighted edge represents the distance from part a to b.
     We will denote graph as Gs = (Ns, Es, ws)
+    By default the graph is complete (all pairs of parts of the city),
+    with k or radius only nearby parts are connected (see spatial_edges).
+    :param k: connect each node only to its k nearest neighbours
+    :param radius: connect only nodes closer than radius kilometers
+    :param path: directory of the edge store with the nodes
     """
-    G = nx.Graph(name = "Spatial graph")
-    f = open("./nodes_data.json")
-    data = json.load(f)
+    G = nx.Graph(name = "Spatial graph", edge_version = ("spatial", k, radius, edge_store.version("nodes", path)))
+    with span("load.nodes"):
+      ids, geo_loc = read_nodes(path)
 
-    print("Constructing a spatial graph")
+    logger.info("Constructing a spatial graph")
 
-    # Let's walk through all parts of the city and use them as nodes in the graph
-    # Then we calculate distances to all other parts of the city and add them
-    # as weghts to edges: edge represents a distance between two parts of the city.
+    # Let's use all parts of the city as nodes in the graph.
+    # Then we calculate distances between parts of the city at once and add them
+    # as weights to edges: edge represents a distance between two parts of the city.
     # As the direction doesn't matter the constructed graph is undirected.
-    for node in data:
-      from_id = int(node['node_id'])
-      from_x = node['geo_loc'][0]
-      from_y = node['geo_loc'][1]
-      G.add_node(from_id, label=from_id)
-
-      # Now let's add all the edges: distances between different
-      # parts of the city 
-      for edge in data:
-        to_id = int(edge['node_id'])
-        to_x = edge['geo_loc'][0]
-        to_y = edge['geo_loc'][1]
-        
-        # Calculating distance between two locations
-        loc1=(from_x, from_y)
-        loc2=(to_x, to_y)
-        haversine_distance = hs.haversine(loc1,loc2)
-        #print(haversine_distance)
-
-        G.add_edge(from_id, to_id, weight=haversine_distance) 
-    
-    f.close()
+    with span("build.spatial_graph", k = k, radius = radius) as s:
+      for node_id in ids.tolist():
+        G.add_node(node_id, label=node_id)
+
+      src, dst, dist = spatial_edges(geo_loc, k = k, radius = radius)
+      G.add_weighted_edges_from(zip(ids[src].tolist(), ids[dst].tolist(), dist.tolist()))
+      s.graph(G)
+
+    return G
+
+def contiguity_graph(path = edge_store.STORE_DIR, geojson_filename = "london_lsoa.json"):
+    """
+    Function constructs a contiguity graph where
+    each node represents a part of the city
+    and two parts are connected when they share a part of their border.
+    Weights are distances between their centroids, so it is a sparse
+    alternative to the complete spatial graph.
+    :param path: directory of the edge store with the node table (see geometry.node_table)
+    :param geojson_filename: geojson file the node table is computed from if it is not cached
+    """
+    import geometry
+
+    G = nx.Graph(name = "Contiguity graph", edge_version = ("contiguity", edge_store.version("nodes", path)))
+    with span("load.nodes"):
+      table = geometry.node_table(geojson_filename, path)
+
+    logger.info("Constructing a contiguity graph")
+
+    with span("build.contiguity_graph") as s:
+      for node_id in table["ids"].tolist():
+        G.add_node(node_id, label=node_id)
+
+      # Row of every node id in the node table
+      ids = np.asarray(table["ids"])
+      row = np.zeros(ids.max() + 1, dtype = np.int64)
+      row[ids] = np.arange(len(ids))
+      src, dst = np.asarray(table["contiguity_src"]), np.asarray(table["contiguity_dst"])
+      lng, lat = table["geo_loc"][row, 0], table["geo_loc"][row, 1]
+      dist = haversine(lat[src], lng[src], lat[dst], lng[dst])
+      G.add_weighted_edges_from(zip(src.tolist(), dst.tolist(), dist.tolist()))
+      s.graph(G)
 
     return G
 
 
-def temporal_graph(time_interval):
+def temporal_edges(time_interval, path = edge_store.STORE_DIR, statistic = "mean"):
+  """
+  Edges of the temporal graph as src, dst and weight arrays.
+  They are memory-mapped from the edge store when it exists, otherwise
+  edges_data_{time_interval}.json is parsed.
+  :param statistic: travel time statistic of edges (see sketches.STATISTICS), other statistics
+      than the mean are taken from the sketches of travel times in the edge store
+  """
+  if statistic != "mean":
+    import sketches
+
+    return sketches.edges(time_interval, statistic, path)
+
+  if edge_store.has_edges(time_interval, path):
+    return edge_store.load_edges(time_interval, path)
+
+  with open("./edges_data_" + str(time_interval) + ".json") as f:
+    edges = np.array(json.load(f), dtype = np.float64).reshape(-1, 3)
+  return edges[:, 0].astype(np.int32), edges[:, 1].astype(np.int32), edges[:, 2].astype(np.float32)
+
+def temporal_csr(time_interval, path = edge_store.STORE_DIR, statistic = "mean"):
+  """
+  Temporal graph as a scipy CSR matrix where entry [a, b] is the travel time from a to b.
+  Rows and columns are indexed by node ids.
+  """
+  from scipy.sparse import csr_matrix
+
+  ids, _ = read_nodes(path)
+  n = int(ids.max()) + 1
+  src, dst, weight = temporal_edges(time_interval, path, statistic)
+  return csr_matrix((weight, (src, dst)), shape = (n, n))
+
+def temporal_graph(time_interval, path = edge_store.STORE_DIR, statistic = "mean"):
     """
     Function construts a temporal graph where
     each node represents a part of the city
@@ -140,34 +558,27 @@ def temporal_graph(time_interval):
     2 - afternoon rush
     3 - night time
     We will denote graph as Gs = (Ns, Es, ws)
+    :param path: directory of the edge store (json files are used if it doesn't exist)
+    :param statistic: travel time statistic the edges are weighted by, eg. "p90" for
+        risk-aware routing (see temporal_edges)
     """
-    G = nx.DiGraph(name = "Temporal graph") # Directed graph
-    print("Reading: edges_data_" + str(time_interval) + ".json")
-    # Opening JSON file
-    f_nodes = open("./nodes_data.json")
-    f_edges = open("./edges_data_" + str(time_interval) + ".json")
-
-    # returns JSON object as
-    # a dictionary
-    nodes_data = json.load(f_nodes)
-    times_data = json.load(f_edges)
-    # print(type(data))
-
-    print("Constructing a temporal graph")
-
-    # Let's first add all the nodes in the graph from nodes_data.json file
-    for node in nodes_data:
-      node_id = int(node['node_id'])
-      G.add_node(node_id, label=node_id)
-
-    # Now let's append the edges from edges_data.json file
-    for time in times_data:
-      G.add_edge(time[0], time[1], weight=time[2])
-
-    #G.add_weighted_edges_from(data)
-            
-    # Closing files
-    f_nodes.close()
-    f_edges.close()
+    G = nx.DiGraph(name = "Temporal graph", edge_version = (time_interval, statistic, edge_store.version(time_interval, path))) # Directed graph
+    logger.info("Reading: edges_data_%s", time_interval)
+
+    with span("load.edges", interval = time_interval, statistic = statistic) as s:
+      ids, _ = read_nodes(path)
+      src, dst, weight = temporal_edges(time_interval, path, statistic)
+      s.set(edges = len(src))
+
+    logger.info("Constructing a temporal graph")
+
+    with span("build.temporal_graph", interval = time_interval) as s:
+      # Let's first add all the nodes in the graph from the node table
+      for node_id in ids.tolist():
+        G.add_node(node_id, label=node_id)
+
+      # Now let's append all the edges at once
+      G.add_weighted_edges_from(zip(src.tolist(), dst.tolist(), weight.tolist()))
+      s.graph(G)
 
     return G
@@ -0,0 +1,281 @@
+"""
+Compact graph of the city stored as arrays instead of networkx dicts. Neighbours of
+every node are in CSR form (int32 offsets and indices, float32 weights) and nodes are
+renumbered to 0..n-1, so a graph with a million edges takes a few MB and statistics
+like construct_graphs.info are computed with numpy and scipy instead of Python loops.
+Algorithms that still need networkx get a graph from to_networkx.
+"""
+import numpy as np
+import networkx as nx
+from scipy import sparse
+
+import construct_graphs
+import edge_store
+import sparse_centrality
+
+
+class CSRGraph:
+    """
+    Weighted graph in CSR form. Neighbours of node index i are
+    indices[indptr[i]:indptr[i + 1]] with weights in the same positions of weights.
+    Undirected graphs keep every edge in both directions (self-loops once).
+    """
+
+    def __init__(self, indptr, indices, weights, ids, directed=True, name=""):
+        """
+        :param indptr: offsets of neighbours of every node, length n + 1
+        :param indices: node indices of neighbours
+        :param weights: weights of edges to the neighbours
+        :param ids: original node id of every node index
+        :param directed: whether the graph is directed
+        :param name: name of the graph, as G.name of networkx graphs
+        """
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.ids = np.asarray(ids)
+        self.directed = directed
+        self.name = name
+        # Node id to node index, -1 for ids that are not in the graph
+        self._index = np.full(int(self.ids.max()) + 1 if len(self.ids) else 0, -1, dtype=np.int32)
+        self._index[self.ids] = np.arange(len(self.ids), dtype=np.int32)
+
+    @classmethod
+    def from_edges(cls, src, dst, weight, ids=None, directed=True, name=""):
+        """
+        Build a graph from arrays of edges given with original node ids.
+        Every edge must be given only once (for undirected graphs in one direction).
+        :param src: source node ids
+        :param dst: destination node ids
+        :param weight: edge weights
+        :param ids: all node ids, including nodes without edges, by default the ids of the edges
+        :param directed: whether the graph is directed
+        :param name: name of the graph
+        """
+        src, dst, weight = np.asarray(src), np.asarray(dst), np.asarray(weight, dtype=np.float32)
+        ids = np.unique(np.concatenate([src, dst]) if ids is None else np.asarray(ids))
+        # Dense node indices, ids are sorted so searchsorted finds them
+        src, dst = np.searchsorted(ids, src), np.searchsorted(ids, dst)
+        if not directed:
+            loop = src == dst
+            src, dst = np.concatenate([src, dst[~loop]]), np.concatenate([dst, src[~loop]])
+            weight = np.concatenate([weight, weight[~loop]])
+
+        order = np.lexsort((dst, src))
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(ids)), out=indptr[1:])
+        return cls(indptr, dst[order], weight[order], ids, directed, name)
+
+    @classmethod
+    def spatial(cls, k=None, radius=None, path=edge_store.STORE_DIR):
+        """
+        The same graph as construct_graphs.spatial_graph.
+        """
+        ids, geo_loc = construct_graphs.read_nodes(path)
+        src, dst, dist = construct_graphs.spatial_edges(geo_loc, k=k, radius=radius)
+        return cls.from_edges(ids[src], ids[dst], dist, ids, directed=False, name="Spatial graph")
+
+    @classmethod
+    def temporal(cls, time_interval, path=edge_store.STORE_DIR, statistic="mean"):
+        """
+        The same graph as construct_graphs.temporal_graph.
+        """
+        ids, _ = construct_graphs.read_nodes(path)
+        src, dst, weight = construct_graphs.temporal_edges(time_interval, path, statistic)
+        return cls.from_edges(src, dst, weight, ids, directed=True, name="Temporal graph")
+
+    @property
+    def nbytes(self):
+        """
+        Memory of the arrays of the graph in bytes.
+        """
+        return self.indptr.nbytes + self.indices.nbytes + self.weights.nbytes + self.ids.nbytes + self._index.nbytes
+
+    def number_of_nodes(self):
+        return len(self.ids)
+
+    def number_of_selfloops(self):
+        return int(np.count_nonzero(self.indices == self._sources()))
+
+    def number_of_edges(self):
+        if self.directed:
+            return len(self.indices)
+        return (len(self.indices) + self.number_of_selfloops()) // 2
+
+    def index(self, node):
+        """
+        Node indices of node ids.
+        """
+        return self._index[node]
+
+    def neighbors(self, node):
+        """
+        Ids of (outgoing) neighbours of a node id.
+        """
+        i = self._index[node]
+        return self.ids[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def _sources(self):
+        return np.repeat(np.arange(self.number_of_nodes(), dtype=np.int32), np.diff(self.indptr))
+
+    @property
+    def csr(self):
+        """
+        Weighted adjacency matrix as a scipy CSR matrix sharing the arrays of the graph,
+        for the functions of sparse_centrality.
+        """
+        n = self.number_of_nodes()
+        return sparse.csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+
+    def out_degree(self):
+        return np.diff(self.indptr).astype(np.int64)
+
+    def in_degree(self):
+        return np.bincount(self.indices, minlength=self.number_of_nodes())
+
+    def degree(self):
+        """
+        Degree of every node index, counted as networkx does
+        (in + out for directed graphs, self-loops twice for undirected).
+        """
+        if self.directed:
+            return self.out_degree() + self.in_degree()
+        loops = np.bincount(self._sources()[self.indices == self._sources()], minlength=self.number_of_nodes())
+        return self.out_degree() + loops
+
+    def degree_stats(self):
+        """
+        Degree statistics of the graph, the numbers printed by info.
+        :return: dict with the number of isolated nodes (without neighbours other than themselves),
+            nodes of degree 1, the average and the maximum degree
+        """
+        sources = self._sources()
+        others = np.bincount(sources[self.indices != sources], minlength=self.number_of_nodes())
+        degree = self.degree()
+        isolated = others == 0
+        return {
+            "isolated": int(isolated.sum()),
+            "leaves": int(np.count_nonzero(~isolated & (degree == 1))),
+            "average": 2 * self.number_of_edges() / self.number_of_nodes(),
+            "max": int(degree.max()) if len(degree) else 0,
+        }
+
+    def components(self):
+        """
+        Components as arrays of node ids, the same ones as construct_graphs.components.
+        Undirected graphs have connected components. In directed graphs construct_graphs.components
+        follows only outgoing edges: it takes the nodes reachable from the first node not yet in a
+        component (in the order of a set of node ids) among the nodes not yet in a component,
+        so neither weakly nor strongly connected components. The same search is done here over the arrays.
+        """
+        if not self.directed:
+            count, labels = sparse_centrality.components_csr(self.csr, directed=False)
+            order = np.argsort(labels, kind="stable")
+            return np.split(self.ids[order], np.cumsum(np.bincount(labels, minlength=count))[:-1])
+
+        indptr, indices, ids = self.indptr.tolist(), self.indices.tolist(), self.ids.tolist()
+        index = dict(zip(ids, range(len(ids))))
+        C = []
+        N = set(ids)
+        while N:
+            i = next(iter(N))
+            N.remove(i)
+            S, c = [index[i]], []
+            while S:
+                i = S.pop()
+                c.append(ids[i])
+                for j in indices[indptr[i]:indptr[i + 1]]:
+                    if ids[j] in N:
+                        N.remove(ids[j])
+                        S.append(j)
+            C.append(np.array(c, dtype=self.ids.dtype))
+        return C
+
+    def distance(self, node):
+        """
+        Distances (number of edges) from a node id to all nodes reachable from it,
+        the same as construct_graphs.distance.
+        """
+        D = sparse_centrality.distance_csr(self.csr, self._index[node])
+        return D[D > 0]
+
+    def info(self):
+        """
+        Print the same statistics as construct_graphs.info.
+        """
+        print("{:>12s} | '{:s}'".format('Graph', self.name))
+
+        n, m = self.number_of_nodes(), self.number_of_edges()
+        stats = self.degree_stats()
+        print("{:>12s} | {:,d} ({:,d}, {:,d})".format('Nodes', n, stats["isolated"], stats["leaves"]))
+        print("{:>12s} | {:,d} ({:,d})".format('Edges', m, self.number_of_selfloops()))
+        print("{:>12s} | {:.2f} ({:,d})".format('Degree', stats["average"], stats["max"]))
+        print("{:>12s} | {:.2e}".format('Density', 2 * m / n / (n - 1)))
+
+        C = self.components()
+        print("{:>12s} | {:.1f}% ({:,d})".format('LCC', 100 * max(len(c) for c in C) / n, len(C)))
+        print()
+
+    def to_networkx(self):
+        """
+        The graph as networkx graph, with nodes labeled like the ones of construct_graphs.
+        """
+        G = nx.DiGraph(name=self.name) if self.directed else nx.Graph(name=self.name)
+        for node_id in self.ids.tolist():
+            G.add_node(node_id, label=node_id)
+
+        src, dst, weights = self._sources(), self.indices, self.weights
+        if not self.directed:
+            keep = src <= dst
+            src, dst, weights = src[keep], dst[keep], weights[keep]
+        G.add_weighted_edges_from(zip(self.ids[src].tolist(), self.ids[dst].tolist(), weights.tolist()))
+        return G
+
+
+class TimeDependentGraph(CSRGraph):
+    """
+    Temporal graph with a travel time of every edge in every time slice of the day
+    (see edge_store.save_slices). Slices share the topology of the graph, their travel
+    times are the rows of slice_weights in the order of indices, and hours gives the
+    slice of every hour of the day. As a CSRGraph it is weighted with the mean over the slices.
+    """
+
+    def __init__(self, indptr, indices, slice_weights, ids, hours, name="Time-dependent graph"):
+        """
+        :param slice_weights: travel times of shape (number of slices, number of edges)
+        :param hours: time slice of every hour of the day
+        """
+        self.slice_weights = np.asarray(slice_weights, dtype=np.float32)
+        self.hours = np.asarray(hours, dtype=np.int32)
+        super().__init__(indptr, indices, self.slice_weights.mean(axis=0), ids, directed=True, name=name)
+
+    @classmethod
+    def from_store(cls, path=edge_store.STORE_DIR):
+        """
+        Load the time slices saved by main.read_from_csv.
+        """
+        # The node table is not necessarily ordered by id, searchsorted needs sorted ids
+        ids = np.sort(construct_graphs.read_nodes(path)[0])
+        src, dst, weight, _, hours = edge_store.load_slices(path)
+        # Edges are sorted by (src, dst) in the store, so they are already in CSR order
+        src = np.searchsorted(ids, src)
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(ids)), out=indptr[1:])
+        return cls(indptr, np.searchsorted(ids, dst), weight, ids, hours)
+
+    @property
+    def nbytes(self):
+        return super().nbytes + self.slice_weights.nbytes
+
+    def slice_of(self, seconds):
+        """
+        Time slice at a time of the day in seconds after midnight (times past midnight wrap around).
+        """
+        return self.hours[(np.asarray(seconds) // 3600).astype(np.int64) % 24]
+
+    def at(self, seconds):
+        """
+        Graph of the time slice at a time of the day, sharing the topology of this graph.
+        """
+        i = int(self.slice_of(seconds))
+        return CSRGraph(self.indptr, self.indices, self.slice_weights[i], self.ids, name=f"{self.name} (slice {i})")
@@ -0,0 +1,248 @@
+import os
+import json
+
+import numpy as np
+
+# Directory with the binary version of nodes_data.json and edges_data_{i}.json.
+# Every array is saved as its own .npy file, so it can be memory-mapped
+# without parsing and without copying it into memory.
+STORE_DIR = "edge_store"
+
+
+def _file(name, path):
+    return os.path.join(path, name + ".npy")
+
+
+def save_nodes(node_ids, geo_loc, path=STORE_DIR):
+    """
+    Save the node table.
+    :param node_ids: ids of the nodes (parts of the city)
+    :param geo_loc: array of shape (n, 2) with [longitude, latitude] of every node
+    :param path: directory of the store
+    """
+    os.makedirs(path, exist_ok=True)
+    np.save(_file("node_ids", path), np.asarray(node_ids, dtype=np.int32))
+    np.save(_file("geo_loc", path), np.asarray(geo_loc, dtype=np.float64))
+    bump_version("nodes", path)
+
+
+def load_nodes(path=STORE_DIR):
+    """
+    Memory-map the node table.
+    :param path: directory of the store
+    :return: a tuple of node_ids and geo_loc arrays
+    """
+    return (np.load(_file("node_ids", path), mmap_mode="r"),
+            np.load(_file("geo_loc", path), mmap_mode="r"))
+
+
+def save_edges(time_interval, src, dst, weight, count=None, path=STORE_DIR):
+    """
+    Save the edges of one time interval as three columns.
+    Edges are kept sorted by (src, dst), so single edges can be found with a binary search.
+    :param time_interval: slot in the day (see construct_graphs.temporal_graph)
+    :param src: ids of the source nodes
+    :param dst: ids of the destination nodes
+    :param weight: mean travel times
+    :param count: number of observations behind every mean (needed for updates, see updates.py)
+    :param path: directory of the store
+    """
+    order = np.lexsort((dst, src))
+    src, dst, weight = np.asarray(src)[order], np.asarray(dst)[order], np.asarray(weight)[order]
+    os.makedirs(path, exist_ok=True)
+    np.save(_file(f"edges_{time_interval}_src", path), np.asarray(src, dtype=np.int32))
+    np.save(_file(f"edges_{time_interval}_dst", path), np.asarray(dst, dtype=np.int32))
+    np.save(_file(f"edges_{time_interval}_weight", path), np.asarray(weight, dtype=np.float32))
+    if count is not None:
+        np.save(_file(f"edges_{time_interval}_count", path), np.asarray(count, dtype=np.int64)[order])
+    bump_version(time_interval, path)
+
+
+def load_edges(time_interval, path=STORE_DIR, mmap_mode="r"):
+    """
+    Memory-map the edges of one time interval.
+    :param time_interval: slot in the day (see construct_graphs.temporal_graph)
+    :param path: directory of the store
+    :param mmap_mode: "r" for read-only arrays, "r+" to change them in place
+    :return: a tuple of src, dst and weight arrays
+    """
+    return tuple(np.load(_file(f"edges_{time_interval}_{column}", path), mmap_mode=mmap_mode)
+                 for column in ("src", "dst", "weight"))
+
+
+def load_counts(time_interval, path=STORE_DIR, mmap_mode="r"):
+    """
+    Number of observations behind every edge weight, ones if they were not saved.
+    """
+    if os.path.exists(_file(f"edges_{time_interval}_count", path)):
+        return np.load(_file(f"edges_{time_interval}_count", path), mmap_mode=mmap_mode)
+    return np.ones(len(load_edges(time_interval, path)[0]), dtype=np.int64)
+
+
+def save_slices(src, dst, weight, count, hours, path=STORE_DIR):
+    """
+    Save edges with a travel time in every time slice of the day (see main.read_from_csv).
+    All slices share one set of edges sorted by (src, dst), so the weights
+    of all slices are one matrix and the topology is stored only once.
+    :param src: ids of the source nodes
+    :param dst: ids of the destination nodes
+    :param weight: mean travel times, array of shape (number of slices, number of edges)
+    :param count: number of observations behind every weight, same shape as weight
+    :param hours: slice of every hour of the day
+    :param path: directory of the store
+    """
+    order = np.lexsort((dst, src))
+    os.makedirs(path, exist_ok=True)
+    np.save(_file("slices_src", path), np.asarray(src, dtype=np.int32)[order])
+    np.save(_file("slices_dst", path), np.asarray(dst, dtype=np.int32)[order])
+    np.save(_file("slices_weight", path), np.ascontiguousarray(np.asarray(weight, dtype=np.float32)[:, order]))
+    np.save(_file("slices_count", path), np.ascontiguousarray(np.asarray(count, dtype=np.int64)[:, order]))
+    np.save(_file("slices_hours", path), np.asarray(hours, dtype=np.int32))
+    bump_version("slices", path)
+
+
+def load_slices(path=STORE_DIR, mmap_mode="r"):
+    """
+    Memory-map the edges of all time slices saved by save_slices.
+    :return: a tuple of src, dst, weight, count and hours arrays
+    """
+    return tuple(np.load(_file(f"slices_{column}", path), mmap_mode=mmap_mode)
+                 for column in ("src", "dst", "weight", "count", "hours"))
+
+
+def save_sketch(time_interval, src, dst, count, mean, m2, hist, path=STORE_DIR):
+    """
+    Save the travel time sketches of the edges of one time interval (see sketches.py).
+    Edges are sorted by (src, dst) like in save_edges.
+    :param time_interval: slot in the day (see construct_graphs.temporal_graph)
+    :param src: ids of the source nodes
+    :param dst: ids of the destination nodes
+    :param count: number of observations of every edge
+    :param mean: mean travel time of every edge
+    :param m2: sum of squared deviations of travel times from the mean
+    :param hist: histogram of travel times of every edge, array of shape (edges, sketches.BINS)
+    :param path: directory of the store
+    """
+    order = np.lexsort((dst, src))
+    os.makedirs(path, exist_ok=True)
+    np.save(_file(f"sketch_{time_interval}_src", path), np.asarray(src, dtype=np.int32)[order])
+    np.save(_file(f"sketch_{time_interval}_dst", path), np.asarray(dst, dtype=np.int32)[order])
+    np.save(_file(f"sketch_{time_interval}_count", path), np.asarray(count, dtype=np.int64)[order])
+    np.save(_file(f"sketch_{time_interval}_mean", path), np.asarray(mean, dtype=np.float64)[order])
+    np.save(_file(f"sketch_{time_interval}_m2", path), np.asarray(m2, dtype=np.float64)[order])
+    np.save(_file(f"sketch_{time_interval}_hist", path), np.asarray(hist, dtype=np.float32)[order])
+    bump_version(f"sketch_{time_interval}", path)
+
+
+def load_sketch(time_interval, path=STORE_DIR, mmap_mode="r"):
+    """
+    Memory-map the travel time sketches of one time interval.
+    :return: dict with src, dst, count, mean, m2 and hist arrays
+    """
+    return {column: np.load(_file(f"sketch_{time_interval}_{column}", path), mmap_mode=mmap_mode)
+            for column in ("src", "dst", "count", "mean", "m2", "hist")}
+
+
+def version(time_interval, path=STORE_DIR):
+    """
+    Version of the edges of one time interval (or "nodes" for the node table), it changes whenever they are saved or updated,
+    so results computed from them can be checked whether they are still valid.
+    """
+    return versions(path).get(str(time_interval), 0)
+
+
+def versions(path=STORE_DIR):
+    """
+    Versions of all time intervals (see version) read at once, keyed by str(time_interval).
+    """
+    try:
+        with open(os.path.join(path, "versions.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def versions_stamp(path=STORE_DIR):
+    """
+    Modification time and size of the file of versions, None if there is none. It is cheaper
+    than reading the versions, so callers checking them often only read them when it changed.
+    """
+    try:
+        stat = os.stat(os.path.join(path, "versions.json"))
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def bump_version(time_interval, path=STORE_DIR):
+    versions = {}
+    if os.path.exists(os.path.join(path, "versions.json")):
+        with open(os.path.join(path, "versions.json")) as f:
+            versions = json.load(f)
+    versions[str(time_interval)] = versions.get(str(time_interval), 0) + 1
+    with open(os.path.join(path, "versions.json"), "w") as f:
+        json.dump(versions, f)
+
+
+def save_array(name, array, path=STORE_DIR):
+    """
+    Save any other array derived from the graph data next to the edges.
+    """
+    os.makedirs(path, exist_ok=True)
+    np.save(_file(name, path), array)
+
+
+def load_array(name, path=STORE_DIR, mmap_mode="r"):
+    return np.load(_file(name, path), mmap_mode=mmap_mode)
+
+
+def has_array(name, path=STORE_DIR):
+    return os.path.exists(_file(name, path))
+
+
+def array_file(name, path=STORE_DIR):
+    """
+    File of an array of the store, for arrays written in place (eg. with np.lib.format.open_memmap)
+    or renamed atomically instead of saved with save_array.
+    """
+    return _file(name, path)
+
+
+def has_nodes(path=STORE_DIR):
+    return os.path.exists(_file("node_ids", path))
+
+
+def has_edges(time_interval, path=STORE_DIR):
+    return os.path.exists(_file(f"edges_{time_interval}_weight", path))
+
+
+def has_slices(path=STORE_DIR):
+    return os.path.exists(_file("slices_weight", path))
+
+
+def has_sketch(time_interval, path=STORE_DIR):
+    return os.path.exists(_file(f"sketch_{time_interval}_hist", path))
+
+
+def from_json(nodes_filename="nodes_data.json", edges_filename="edges_data_{}.json",
+              intervals=range(4), path=STORE_DIR):
+    """
+    Convert json files written by an older main.read_from_csv into the store.
+    :param nodes_filename: json file with the nodes
+    :param edges_filename: json file pattern with the edges of each interval
+    :param intervals: time intervals to convert
+    :param path: directory of the store
+    """
+    with open(nodes_filename) as f:
+        nodes_data = json.load(f)
+    save_nodes([int(node["node_id"]) for node in nodes_data],
+               [node["geo_loc"] for node in nodes_data], path=path)
+
+    for i in intervals:
+        with open(edges_filename.format(i)) as f:
+            edges = np.array(json.load(f), dtype=np.float64).reshape(-1, 3)
+        save_edges(i, edges[:, 0], edges[:, 1], edges[:, 2], path=path)
+
+
+if __name__ == "__main__":
+    from_json()
@@ -0,0 +1,151 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import construct_graphs
+import edge_store
+import model
+import pipeline
+import travel_times
+from features import unit_vectors
+from inference import Predictor, MODELS_DIR
+from instrument import span
+
+# Uber travel times are in seconds, google_time in hours
+SECONDS_PER_HOUR = 3600
+
+
+def nearest_nodes(lat, lng, path=edge_store.STORE_DIR):
+    """
+    Node id of the nearest node (centroid of a part of the city) of every location, found with a KD-tree
+    on the unit sphere (see features.FeatureContext.nearest).
+    """
+    ids, geo_loc = construct_graphs.read_nodes(path)
+    tree = cKDTree(unit_vectors(geo_loc[:, 1], geo_loc[:, 0]))
+    _, row = tree.query(unit_vectors(np.asarray(lat), np.asarray(lng)))
+    return np.asarray(ids)[row]
+
+
+def bfs_pairs(time_interval, n1, n2, path=edge_store.STORE_DIR):
+    """
+    Travel times of pairs with model.bfs_first_joint, nan where it finds no path.
+    """
+    G = pipeline.load_graph(time_interval, path)
+    times = [model.bfs_first_joint(a, b, G) for a, b in zip(n1.tolist(), n2.tolist())]
+    return np.array([np.nan if t is None else t for t in times])
+
+
+def shortest_path_times(n1, n2, time_interval, n_jobs=None, path=edge_store.STORE_DIR):
+    """
+    Travel times of pairs on shortest paths (as predict_with_shortest_path), looked up in the
+    travel times between all nodes, which are computed once in parallel and shared with
+    the other consumers (see travel_times.all_sources).
+    """
+    D, _ = travel_times.all_sources(time_interval, n_jobs, path)
+    return D[n1, n2]
+
+
+def scores(predictions, truth):
+    """
+    RMSE and MAE of predictions of pairs with a prediction, and the number of pairs without one.
+    """
+    found = np.isfinite(predictions)
+    errors = predictions[found] - truth[found]
+    return {"pairs": int(found.sum()), "missing": int((~found).sum()),
+            "rmse": float(np.sqrt(np.mean(errors ** 2))) if found.any() else np.nan,
+            "mae": float(np.mean(np.abs(errors))) if found.any() else np.nan}
+
+
+def evaluate(filename="learning_data_all.csv", intervals=range(4), bfs=True,
+             models=("random_forest", "gradient_boosting"), n_jobs=None, path=edge_store.STORE_DIR,
+             test_size=0.30, seed=42):
+    """
+    Compare travel times of graph routing and learned models with google travel times.
+    Every method predicts travel times in hours (like google_time) for all pairs of the csv file:
+        - shortest_path_{i}: shortest paths in the temporal graph of interval i
+        - bfs_{i}: model.bfs_first_joint in the temporal graph of interval i
+        - model names: saved models (see model.do_model and inference.py)
+    Models were trained on a part of the same file, so scores are also reported for the
+    held out pairs only, split the same way as in model.do_model.
+    :param filename: csv from google_data.py with columns x1, y1, x2, y2 and google_time
+    :param intervals: time intervals of temporal graphs to route in
+    :param bfs: also evaluate bfs_first_joint, which is a lot slower than batch dijkstra
+    :param models: names of saved models in MODELS_DIR, missing ones are skipped
+    :param n_jobs: number of worker processes, by default the number of cores
+    :param path: directory of the edge store
+    :param test_size: part of the file held out in model.do_model
+    :param seed: random state of the split in model.do_model
+    :return: a tuple of
+        - summary: data frame with a row per method with RMSE, MAE and latency
+        - pairs: data frame with a row per pair with nodes, predictions and errors of every method
+    """
+    from sklearn.model_selection import train_test_split
+
+    df = pd.read_csv(filename)
+    truth = df.google_time.values
+    _, held_out = train_test_split(np.arange(len(df)), test_size=test_size, random_state=seed)
+    pairs = pd.DataFrame({"n1": nearest_nodes(df.x1.values, df.y1.values, path),
+                          "n2": nearest_nodes(df.x2.values, df.y2.values, path),
+                          "google_time": truth, "held_out": np.isin(np.arange(len(df)), held_out)})
+    n1, n2 = pairs.n1.values, pairs.n2.values
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    predictions, seconds = {}, {}
+    for i in intervals:
+        tic = time.perf_counter()
+        with span("routing.evaluate", method="shortest_path", interval=i, pairs=len(df)):
+            times = shortest_path_times(n1, n2, i, n_jobs, path)
+        predictions[f"shortest_path_{i}"] = times / SECONDS_PER_HOUR
+        seconds[f"shortest_path_{i}"] = time.perf_counter() - tic
+
+    if bfs:
+        # The pool is only open while it has work, all_sources above uses its own workers
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunks = np.array_split(np.arange(len(df)), n_jobs)
+            for i in intervals:
+                tic = time.perf_counter()
+                with span("routing.evaluate", method="bfs", interval=i, pairs=len(df)):
+                    times = np.concatenate(list(executor.map(bfs_pairs, [i] * n_jobs, [n1[c] for c in chunks],
+                                                             [n2[c] for c in chunks], [path] * n_jobs)))
+                predictions[f"bfs_{i}"] = times / SECONDS_PER_HOUR
+                seconds[f"bfs_{i}"] = time.perf_counter() - tic
+
+    for name in models:
+        artifact = os.path.join(MODELS_DIR, f"{name}.pkl")
+        if not os.path.exists(artifact):
+            continue
+        predictor = Predictor(artifact)
+        tic = time.perf_counter()
+        predictions[name] = predictor.predict(df.x1.values, df.y1.values, df.x2.values, df.y2.values)
+        seconds[name] = time.perf_counter() - tic
+
+    held_out = pairs.held_out.values
+    rows = []
+    for method, predicted in predictions.items():
+        predicted = np.where(np.isnan(predicted), np.inf, predicted)
+        pairs[method] = predicted
+        pairs[f"{method}_error"] = predicted - truth
+        rows.append({"method": method, **scores(predicted, truth),
+                     "rmse_held_out": scores(predicted[held_out], truth[held_out])["rmse"],
+                     "seconds": seconds[method], "us_per_pair": 1e6 * seconds[method] / len(df)})
+    return pd.DataFrame(rows), pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate travel times of routing and models against google")
+    parser.add_argument("--input", default="learning_data_all.csv")
+    parser.add_argument("--intervals", type=int, nargs="+", default=list(range(4)))
+    parser.add_argument("--no-bfs", action="store_true", help="skip the slow bfs_first_joint")
+    parser.add_argument("--models", nargs="*", default=["random_forest", "gradient_boosting"])
+    parser.add_argument("--jobs", type=int, help="number of worker processes")
+    parser.add_argument("--output", default="evaluation.csv", help="csv with errors of every pair")
+    args = parser.parse_args()
+
+    summary, pairs = evaluate(args.input, args.intervals, bfs=not args.no_bfs, models=args.models, n_jobs=args.jobs)
+    pairs.to_csv(args.output, index=False)
+    print(summary.to_string(index=False))
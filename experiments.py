@@ -0,0 +1,165 @@
+import os
+import time
+import pickle
+import hashlib
+import resource
+import argparse
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor, HistGradientBoostingRegressor
+from sklearn.metrics import mean_squared_error
+from sklearn.model_selection import KFold, ParameterGrid, ParameterSampler
+
+from features import load_features, cache_key
+
+CACHE_DIR = "experiment_cache"
+
+# Regressors and their hyperparameter grids. Boosting models stop early
+# on a validation part of the training fold once the score stops improving.
+MODELS = {
+    "random_forest": (RandomForestRegressor, {
+        "n_estimators": [100, 300],
+        "max_depth": [None, 20],
+        "min_samples_leaf": [1, 5],
+    }),
+    "gradient_boosting": (GradientBoostingRegressor, {
+        "n_estimators": [1000],
+        "learning_rate": [0.05, 0.1],
+        "max_depth": [3, 5],
+        "n_iter_no_change": [10],
+    }),
+    "hist_gradient_boosting": (HistGradientBoostingRegressor, {
+        "max_iter": [1000],
+        "learning_rate": [0.05, 0.1],
+        "max_leaf_nodes": [31, 63],
+        "early_stopping": [True],
+    }),
+}
+
+# Data of the current worker process, set once by _init_worker instead of sending it with every job
+_data = {}
+
+
+def _init_worker(X, y, data_key, trace_memory=False):
+    _data["X"], _data["y"], _data["key"], _data["trace_memory"] = X, y, data_key, trace_memory
+
+
+def configurations(models=MODELS, n_iter=None, seed=42):
+    """
+    All (name, params) configurations of the grids, or n_iter random ones per model.
+    """
+    configs = []
+    for name, (_, grid) in models.items():
+        params = ParameterGrid(grid) if n_iter is None else ParameterSampler(grid, n_iter, random_state=seed)
+        configs.extend((name, dict(p)) for p in params)
+    return configs
+
+
+def fit_fold(name, factory, params, fold, train, test, cache_dir=CACHE_DIR):
+    """
+    Fit one configuration on one fold and measure it. The fitted model and its
+    measurements are cached, so the same fold is never fitted twice.
+    Memory is the peak RSS of the worker process over its whole lifetime (process_peak_mb, so
+    it includes earlier folds of the same worker), with trace_memory (see run_experiments) also
+    the peak of memory allocated during this fit (peak_mb), which is exact but makes fits a lot slower.
+    :param factory: regressor class (or any function returning a regressor) called with params
+    :return: dict with fit and predict time (s), RMSE, peak memory and model size (MB)
+    """
+    factory_name = f"{factory.__module__}.{factory.__qualname__}"
+    key = hashlib.sha256(repr((_data["key"], name, factory_name, sorted(params.items()), fold,
+                               _data["trace_memory"])).encode()).hexdigest()[:16]
+    cache = os.path.join(cache_dir, f"{name}_{key}.pkl")
+    if os.path.exists(cache):
+        with open(cache, "rb") as f:
+            return pickle.load(f)["result"]
+
+    X, y = _data["X"], _data["y"]
+    model = factory(**params)
+
+    if _data["trace_memory"]:
+        tracemalloc.start()
+    tic = time.perf_counter()
+    model.fit(X[train], y[train])
+    fit_time = time.perf_counter() - tic
+    peak = np.nan
+    if _data["trace_memory"]:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    # ru_maxrss is in kilobytes on linux
+    process_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    tic = time.perf_counter()
+    predicts = model.predict(X[test])
+    predict_time = time.perf_counter() - tic
+
+    dump = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    result = {
+        "model": name,
+        "params": repr(params),
+        "fold": fold,
+        "rmse": float(np.sqrt(mean_squared_error(y[test], predicts))),
+        "fit_time": fit_time,
+        "predict_time": predict_time,
+        "peak_mb": peak / 2 ** 20,
+        "process_peak_mb": process_peak / 2 ** 20,
+        "model_mb": len(dump) / 2 ** 20,
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache, "wb") as f:
+        pickle.dump({"result": result, "model": model}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return result
+
+
+def run_experiments(models=MODELS, folds=5, n_iter=None, n_jobs=None, seed=42,
+                    filename="learning_data_all.csv", cache_dir=CACHE_DIR, trace_memory=False):
+    """
+    Cross-validate every configuration of the models on a process pool.
+    :param models: regressors and their grids (see MODELS)
+    :param folds: number of folds
+    :param n_iter: number of random configurations per model, the whole grid if None
+    :param n_jobs: number of worker processes, by default the number of cores
+    :param seed: seed of the folds and the random search
+    :param filename: csv with the learning data (see features.load_features)
+    :param cache_dir: directory of fitted folds
+    :param trace_memory: measure memory of fits with tracemalloc (see fit_fold)
+    :return: data frame with a row per configuration, the best RMSE first
+    """
+    X, y, _ = load_features(filename)
+    # Content of the file, version of the features and versions of the edge store (see features.cache_key)
+    data_key = (cache_key(filename), folds, seed)
+    splits = list(KFold(folds, shuffle=True, random_state=seed).split(X))
+    jobs = [(name, models[name][0], params, fold, train, test)
+            for name, params in configurations(models, n_iter, seed)
+            for fold, (train, test) in enumerate(splits)]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(X, y, data_key, trace_memory)) as executor:
+        futures = [executor.submit(fit_fold, *job, cache_dir) for job in jobs]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    df = pd.DataFrame(results)
+    table = df.groupby(["model", "params"]).agg(
+        rmse=("rmse", "mean"), rmse_std=("rmse", "std"),
+        fit_time=("fit_time", "mean"), predict_time=("predict_time", "mean"),
+        peak_mb=("peak_mb", "max"), process_peak_mb=("process_peak_mb", "max"), model_mb=("model_mb", "mean"))
+    return table.sort_values("rmse").reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-validated hyperparameter search of travel time models")
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=list(MODELS))
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--n-iter", type=int, help="random search with this many configurations per model")
+    parser.add_argument("--jobs", type=int, help="number of worker processes")
+    parser.add_argument("--trace-memory", action="store_true", help="exact, but slow, memory of fits")
+    parser.add_argument("--output", default="experiments.csv")
+    args = parser.parse_args()
+
+    table = run_experiments({name: MODELS[name] for name in args.models}, folds=args.folds,
+                            n_iter=args.n_iter, n_jobs=args.jobs, trace_memory=args.trace_memory)
+    table.to_csv(args.output, index=False)
+    print(table.to_string())
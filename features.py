@@ -0,0 +1,185 @@
+import os
+import pickle
+import hashlib
+
+import numpy as np
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+import construct_graphs
+import edge_store
+import sparse_centrality
+import travel_times
+
+# Change whenever the features change, so old cached feature files are not used
+FEATURES_VERSION = 3
+CACHE_DIR = "feature_cache"
+# Distances and travel times of pairs without a path are replaced by this multiple of the largest finite one
+UNREACHABLE_FACTOR = 2
+
+
+def bearing(lat1, lng1, lat2, lng2):
+    """
+    Vectorized initial bearing from the first to the second location in degrees (0 is north, 90 east).
+    """
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    y = np.sin(lng2 - lng1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lng2 - lng1)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+
+def unit_vectors(lat, lng):
+    """
+    Locations on the unit sphere as 3D vectors.
+    """
+    lat, lng = np.radians(lat), np.radians(lng)
+    return np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+
+class FeatureContext:
+    """
+    Everything needed to compute features of origin/destination pairs: nodes for mapping
+    coordinates to parts of the city, shortest path distances of the spatial and temporal
+    graphs between all nodes and centralities of nodes. It is built once, then features of
+    any number of pairs are computed with array lookups (see compute).
+    """
+
+    def __init__(self, intervals=range(4), k=8, path=edge_store.STORE_DIR):
+        """
+        :param intervals: time intervals of temporal graphs to take travel times from
+        :param k: number of neighbours in the spatial graph (see construct_graphs.spatial_graph)
+        :param path: directory of the edge store
+        """
+        self.intervals = list(intervals)
+        ids, geo_loc = construct_graphs.read_nodes(path)
+        # Rows of the node table (and of the KD-tree) are not node ids, matrices below are indexed by node ids
+        self.ids = np.array(ids)
+        self._row = np.full(int(self.ids.max()) + 1, -1)
+        self._row[self.ids] = np.arange(len(self.ids))
+        self.geo_loc = np.array(geo_loc)
+        # Nearest points on the sphere are also nearest in 3D, where a KD-tree is much faster than a BallTree
+        self.tree = cKDTree(unit_vectors(geo_loc[:, 1], geo_loc[:, 0]))
+
+        # Shortest path distances over the sparse spatial graph (road-like distances)
+        self.spatial = csgraph.dijkstra(construct_graphs.spatial_csr(k=k, path=path), directed=False).astype(np.float32)
+
+        # Travel times between all nodes, shared with the other consumers of travel_times.all_sources,
+        # which computes them only once per version of the edges
+        self.times = []
+        pagerank, closeness = [], []
+        for i in self.intervals:
+            A = construct_graphs.temporal_csr(i, path)
+            D, _ = travel_times.all_sources(i, path=path)
+            self.times.append(np.asarray(D))
+            # Centralities over the nodes of the table only, ids without a node are no part of the graph
+            pagerank.append(sparse_centrality.pagerank_csr(A[self.ids][:, self.ids]))
+            closeness.append(sparse_centrality.closeness_from_distances(np.asarray(D)[np.ix_(self.ids, self.ids)]))
+        self.pagerank, self.closeness = np.zeros(len(self._row)), np.zeros(len(self._row))
+        self.pagerank[self.ids] = np.mean(pagerank, axis=0)
+        self.closeness[self.ids] = np.mean(closeness, axis=0)
+
+        # Finite values for pairs without a path, models don't accept infinity
+        self.caps = [UNREACHABLE_FACTOR * float(D[np.isfinite(D)].max(initial=0)) for D in [self.spatial] + self.times]
+
+    @property
+    def names(self):
+        return (["aerial", "x1", "x2", "y1", "y2", "bearing", "spatial_distance"]
+                + [f"travel_time_{i}" for i in self.intervals]
+                + ["pagerank_1", "pagerank_2", "closeness_1", "closeness_2", "is_reachable"])
+
+    def nearest(self, lat, lng):
+        """
+        Node id of the nearest node (centroid of a part of the city) of every location.
+        """
+        _, row = self.tree.query(unit_vectors(lat, lng))
+        return self.ids[row]
+
+    def rows(self, node_ids):
+        """
+        Rows of node ids in the node table (and in geo_loc).
+        """
+        return self._row[np.asarray(node_ids)]
+
+    def compute(self, x1, y1, x2, y2):
+        """
+        Features of origin/destination pairs, with columns in the order of names.
+        :param x1: latitudes of origins
+        :param y1: longitudes of origins
+        :param x2: latitudes of destinations
+        :param y2: longitudes of destinations
+        :return: feature matrix with a row per pair
+        """
+        x1, y1, x2, y2 = (np.asarray(a, dtype=np.float64) for a in (x1, y1, x2, y2))
+        n1, n2 = self.nearest(x1, y1), self.nearest(x2, y2)
+        distances = [D[n1, n2] for D in [self.spatial] + self.times]
+        reachable = np.logical_and.reduce([np.isfinite(d) for d in distances])
+        distances = [np.where(np.isfinite(d), d, cap) for d, cap in zip(distances, self.caps)]
+        columns = [construct_graphs.haversine(x1, y1, x2, y2), x1, x2, y1, y2, bearing(x1, y1, x2, y2)]
+        columns += distances
+        columns += [self.pagerank[n1], self.pagerank[n2], self.closeness[n1], self.closeness[n2], reachable]
+        return np.column_stack(columns)
+
+
+def cache_key(filename, intervals=range(4), k=8, path=edge_store.STORE_DIR):
+    """
+    Hash of everything the features of a csv file depend on: its content, the
+    version of the features and versions of the graph data (see edge_store.version).
+    Without filename it is the hash of the FeatureContext only.
+    """
+    h = hashlib.sha256()
+    if filename is not None:
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    versions = [edge_store.version("nodes", path)] + [edge_store.version(i, path) for i in intervals]
+    h.update(repr((FEATURES_VERSION, list(intervals), k, os.path.abspath(path), versions)).encode())
+    return h.hexdigest()[:16]
+
+
+def load_features(filename="learning_data_all.csv", intervals=range(4), k=8, path=edge_store.STORE_DIR,
+                  cache_dir=CACHE_DIR):
+    """
+    Features and google travel times of all rows of the learning data. They are
+    computed once and saved in cache_dir, later calls with the same inputs only load them.
+    :param filename: csv file from google_data.py
+    :param intervals: time intervals of temporal graphs (see FeatureContext)
+    :param k: number of neighbours in the spatial graph (see FeatureContext)
+    :param path: directory of the edge store
+    :param cache_dir: directory of cached feature files
+    :return: a tuple of
+        - X: feature matrix
+        - y: google travel times
+        - names: names of the columns of X
+    """
+    key = cache_key(filename, intervals, k, path)
+    cache = os.path.join(cache_dir, f"features_{key}.npz")
+    if os.path.exists(cache):
+        data = np.load(cache)
+        return data["X"], data["y"], data["names"].tolist()
+
+    import pandas as pd
+
+    df = pd.read_csv(filename)
+    context = load_context(intervals, k, path, cache_dir)
+    X = context.compute(df.x1.values, df.y1.values, df.x2.values, df.y2.values)
+    y = df.google_time.values
+
+    np.savez(cache, X=X, y=y, names=np.array(context.names))
+    return X, y, context.names
+
+
+def load_context(intervals=range(4), k=8, path=edge_store.STORE_DIR, cache_dir=CACHE_DIR):
+    """
+    FeatureContext features are computed with (see load_features). It is cached
+    in cache_dir as well, so models can be saved together with it (see inference.py).
+    """
+    cache = os.path.join(cache_dir, f"context_{cache_key(None, intervals, k, path)}.pkl")
+    if os.path.exists(cache):
+        with open(cache, "rb") as f:
+            return pickle.load(f)
+
+    context = FeatureContext(intervals, k, path)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache, "wb") as f:
+        pickle.dump(context, f)
+    return context
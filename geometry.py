@@ -0,0 +1,180 @@
+"""
+Geometry of the parts of the city (LSOA districts) from london_lsoa.json.
+All rings of all polygons are flattened into one array of vertices, so centroids,
+areas, bounding boxes and neighbours of all districts are computed with numpy at once.
+The results are saved as a node table in the edge store and only recomputed when the
+geojson file changes (see node_table).
+"""
+import os
+import json
+
+import numpy as np
+
+import edge_store
+from instrument import span
+
+# Change whenever the computed geometry changes, so old node tables are recomputed
+GEOMETRY_VERSION = 1
+# Length of a degree of latitude in kilometers
+KM_PER_DEGREE = 111.32
+# Vertices closer than this (in degrees, about 10 cm) are the same vertex of neighbouring districts
+VERTEX_PRECISION = 1e-6
+
+
+def flatten(geojson_filename):
+    """
+    Read all rings of all districts into flat arrays.
+    :param geojson_filename: geojson file with a (Multi)Polygon feature per district
+    :return: dict with
+        - ids: node id (MOVEMENT_ID) of every district
+        - names: display name of every district
+        - coords: array of shape (vertices, 2) with [longitude, latitude] of every vertex
+        - ring_start: index of the first vertex of every ring, and the number of vertices at the end
+        - ring_feature: district of every ring
+        - ring_hole: whether the ring is a hole of its polygon
+    """
+    with open(geojson_filename) as f:
+        features = json.load(f)["features"]
+
+    ids, names, rings, ring_feature, ring_hole = [], [], [], [], []
+    for i, feature in enumerate(features):
+        ids.append(int(feature["properties"]["MOVEMENT_ID"]))
+        names.append(feature["properties"]["DISPLAY_NAME"])
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        for polygon in polygons:
+            for r, ring in enumerate(polygon):
+                # The last vertex of a ring repeats the first one
+                rings.append(ring[:-1] if ring[0] == ring[-1] else ring)
+                ring_feature.append(i)
+                ring_hole.append(r > 0)
+
+    lengths = np.array([len(ring) for ring in rings])
+    return {
+        "ids": np.array(ids, dtype=np.int32),
+        "names": np.array(names),
+        "coords": np.array([vertex[:2] for ring in rings for vertex in ring], dtype=np.float64),
+        "ring_start": np.concatenate([[0], np.cumsum(lengths)]),
+        "ring_feature": np.array(ring_feature),
+        "ring_hole": np.array(ring_hole),
+    }
+
+
+def centroids(coords, ring_start, ring_feature, ring_hole, n_features):
+    """
+    Area-weighted centroids and areas of districts over all their polygons, holes are subtracted.
+    Coordinates are treated as planar (equirectangular), which is accurate at the size of a city.
+    :return: a tuple of
+        - geo_loc: array of shape (n_features, 2) with [longitude, latitude] of centroids
+        - area: area of every district in square kilometers
+    """
+    lengths = np.diff(ring_start)
+    ring = np.repeat(np.arange(len(lengths)), lengths)
+    # Next vertex of every vertex, the last vertex of a ring is followed by its first one
+    following = np.arange(1, len(coords) + 1)
+    following[ring_start[1:] - 1] = ring_start[:-1]
+
+    x, y = coords[:, 0], coords[:, 1]
+    x1, y1 = x[following], y[following]
+    cross = x * y1 - x1 * y
+    # Shoelace formula for the signed area and the centroid of every ring
+    area = 0.5 * np.bincount(ring, weights=cross, minlength=len(lengths))
+    cx = np.bincount(ring, weights=(x + x1) * cross, minlength=len(lengths)) / 6
+    cy = np.bincount(ring, weights=(y + y1) * cross, minlength=len(lengths)) / 6
+
+    # Rings can be in either orientation, holes count negatively
+    sign = np.where(ring_hole, -1, 1) * np.sign(area)
+    weight = np.abs(area) * np.where(ring_hole, -1, 1)
+    feature_area = np.bincount(ring_feature, weights=weight, minlength=n_features)
+    geo_loc = np.column_stack([np.bincount(ring_feature, weights=sign * cx, minlength=n_features),
+                               np.bincount(ring_feature, weights=sign * cy, minlength=n_features)])
+    geo_loc /= feature_area[:, None]
+
+    km2 = feature_area * KM_PER_DEGREE ** 2 * np.cos(np.radians(geo_loc[:, 1]))
+    return geo_loc, km2
+
+
+def bounding_boxes(coords, ring_start, ring_feature):
+    """
+    Bounding box of every district.
+    :return: array of shape (n_features, 4) with min longitude, min latitude, max longitude and max latitude
+    """
+    # Rings of a district are consecutive, so its vertices are one block of coords
+    first_ring = np.flatnonzero(np.r_[True, ring_feature[1:] != ring_feature[:-1]])
+    start = ring_start[first_ring]
+    return np.column_stack([np.minimum.reduceat(coords, start), np.maximum.reduceat(coords, start)])
+
+
+def adjacency(coords, ring_start, ring_feature, min_shared=2):
+    """
+    Pairs of neighbouring districts, which share at least min_shared vertices of their borders.
+    With min_shared=2 districts must share a part of the border, with 1 touching in a point is enough.
+    :return: a tuple of src and dst arrays with district indices, every pair once with src < dst
+    """
+    lengths = np.diff(ring_start)
+    feature = np.repeat(ring_feature, lengths)
+    vertex = np.round(coords / VERTEX_PRECISION).astype(np.int64)
+    _, key = np.unique(vertex, axis=0, return_inverse=True)
+
+    # Every district once per vertex, sorted by vertex, so districts sharing a vertex are next to each other
+    key, feature = np.unique(np.column_stack([key.ravel(), feature]), axis=0).T
+    src, dst = [], []
+    d = 1
+    while d < len(key):
+        same = key[d:] == key[:-d]
+        if not same.any():
+            break
+        src.append(feature[:-d][same])
+        dst.append(feature[d:][same])
+        d += 1
+    if not src:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    src, dst = np.concatenate(src), np.concatenate(dst)
+    pairs, shared = np.unique(np.column_stack([np.minimum(src, dst), np.maximum(src, dst)]), axis=0,
+                              return_counts=True)
+    pairs = pairs[shared >= min_shared]
+    return pairs[:, 0], pairs[:, 1]
+
+
+def _cache_key(geojson_filename, min_shared):
+    stat = os.stat(geojson_filename)
+    return [GEOMETRY_VERSION, os.path.abspath(geojson_filename), stat.st_size, stat.st_mtime, min_shared]
+
+
+def node_table(geojson_filename="london_lsoa.json", path=edge_store.STORE_DIR, min_shared=2):
+    """
+    Node table of all districts: ids, names, centroids, areas, bounding boxes and contiguity edges.
+    It is computed once and saved in the edge store (nodes with edge_store.save_nodes, the rest as arrays),
+    later calls only load it until the geojson file changes.
+    :param geojson_filename: geojson file with the districts
+    :param path: directory of the edge store
+    :param min_shared: number of shared vertices of neighbouring districts (see adjacency)
+    :return: dict with ids, names, geo_loc, area, bbox, and contiguity src and dst (node ids)
+    """
+    key = _cache_key(geojson_filename, min_shared)
+    meta = os.path.join(path, "geometry.json")
+    columns = ("names", "area", "bbox", "contiguity_src", "contiguity_dst")
+    if os.path.exists(meta) and edge_store.has_nodes(path):
+        with open(meta) as f:
+            if json.load(f) == key:
+                ids, geo_loc = edge_store.load_nodes(path)
+                table = {name: edge_store.load_array(f"node_{name}", path) for name in columns}
+                return {"ids": ids, "geo_loc": geo_loc, **table}
+
+    with span("parse.geometry") as s:
+        flat = flatten(geojson_filename)
+        n = len(flat["ids"])
+        geo_loc, area = centroids(flat["coords"], flat["ring_start"], flat["ring_feature"], flat["ring_hole"], n)
+        bbox = bounding_boxes(flat["coords"], flat["ring_start"], flat["ring_feature"])
+        src, dst = adjacency(flat["coords"], flat["ring_start"], flat["ring_feature"], min_shared)
+        s.set(nodes=n, edges=len(src), vertices=len(flat["coords"]))
+
+    ids = flat["ids"]
+    table = {"names": flat["names"], "area": area, "bbox": bbox, "contiguity_src": ids[src], "contiguity_dst": ids[dst]}
+    edge_store.save_nodes(ids, geo_loc, path)
+    for name, array in table.items():
+        edge_store.save_array(f"node_{name}", array, path)
+    with open(meta, "w") as f:
+        json.dump(key, f)
+    return {"ids": ids, "geo_loc": geo_loc, **table}
@@ -1,13 +1,26 @@
+import os
+import csv
+import time
 import random
+import asyncio
+import argparse
+import threading
+import http.server
+import urllib.error
+import urllib.parse
+import urllib.request
 import haversine as hs
-import googlemaps
 from time import sleep
 from pprint import pprint
-import pandas as pd
 import math
+import logging
 import numpy as np
 import json
 
+import instrument
+
+logger = logging.getLogger(__name__)
+
 
 def get_input_data(filename):
     with open(filename, "r") as f:
@@ -15,6 +28,9 @@ def get_input_data(filename):
 
 
 def download():
+    import googlemaps
+    import pandas as pd
+
     # insert your google developer api key here. Do this on the google developer platform,
     # find the instructions how to do this on the internet. You will also have to enable billing
     # and the api for your account
@@ -78,5 +94,305 @@ def download():
     df.to_csv("learning_data_all.csv", index=False)
 
 
+# Limits of the distance matrix API for a single request
+MAX_DIMENSION = 25
+MAX_ELEMENTS = 100
+API_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+COLUMNS = ["x1", "y1", "x2", "y2", "aerial", "google_distance", "google_time"]
+
+
+def make_batches(data, rounds=50, seed=42):
+    """
+    Sample origins and destinations the same way as download(): every round takes 25 origins
+    and 25 destinations that were not used yet. Origins of a round are packed into requests of
+    MAX_ELEMENTS elements. The batches only depend on the seed, so an interrupted collection
+    can be resumed (see collect).
+    :param data: nodes from nodes_data.json
+    :param rounds: number of rounds of sampling
+    :param seed: seed of the random generator
+    :return: list of (origin ids, destination ids) pairs, one per request
+    """
+    rng = random.Random(seed)
+    origin_ids = list(range(len(data)))
+    destination_ids = list(range(len(data)))
+    per_request = MAX_ELEMENTS // MAX_DIMENSION
+
+    batches = []
+    for _ in range(rounds):
+        if len(origin_ids) < MAX_DIMENSION or len(destination_ids) < MAX_DIMENSION:
+            break
+        dest_ind = rng.sample(destination_ids, MAX_DIMENSION)
+        origin_ind = rng.sample(origin_ids, MAX_DIMENSION)
+        for i in dest_ind:
+            destination_ids.remove(i)
+        for i in origin_ind:
+            origin_ids.remove(i)
+        for start in range(0, MAX_DIMENSION, per_request):
+            batches.append((origin_ind[start:start + per_request], dest_ind))
+    return batches
+
+
+class TokenBucket:
+    """
+    Rate limiter: allows rate requests per second on average and bursts of up to capacity requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    pass
+
+
+def request_matrix(origins, destinations, api_key, base_url=API_URL, timeout=30):
+    """
+    One request to the distance matrix API.
+    :param origins: list of (lat, lng) locations
+    :param destinations: list of (lat, lng) locations
+    :return: parsed json response
+    :raises RetryableError: if the request should be repeated later
+    """
+    query = urllib.parse.urlencode({
+        "origins": "|".join(f"{lat},{lng}" for lat, lng in origins),
+        "destinations": "|".join(f"{lat},{lng}" for lat, lng in destinations),
+        "mode": "driving",
+        "key": api_key,
+    })
+    try:
+        with urllib.request.urlopen(f"{base_url}?{query}", timeout=timeout) as response:
+            res = json.load(response)
+    except urllib.error.HTTPError as e:
+        if e.code == 429 or e.code >= 500:
+            raise RetryableError(f"HTTP {e.code}")
+        raise
+    except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+        raise RetryableError(str(e))
+
+    if res["status"] in ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR"):
+        raise RetryableError(res["status"])
+    if res["status"] != "OK":
+        raise RuntimeError(f"Distance matrix request failed: {res['status']} {res.get('error_message', '')}")
+    return res
+
+
+def matrix_rows(origins, destinations, res):
+    """
+    Rows of learning_data_all.csv from one distance matrix response, elements without a route are skipped.
+    """
+    rows = []
+    for (x1, y1), row in zip(origins, res["rows"]):
+        for (x2, y2), element in zip(destinations, row["elements"]):
+            if element["status"] != "OK":
+                continue
+            curr_dist_google = int(math.floor(int(element["distance"]["value"]) / 1000))
+            curr_dur_google = element["duration"]["value"] / 3600
+            rows.append([x1, y1, x2, y2, hs.haversine((x1, y1), (x2, y2)), curr_dist_google, curr_dur_google])
+    return rows
+
+
+async def collect(api_key, output="learning_data_all.csv", rounds=50, seed=42, concurrency=8, rate=10,
+                  retries=5, base_url=API_URL, nodes_filename="nodes_data.json"):
+    """
+    Collect travel times from the distance matrix API with concurrent requests.
+    Requests are packed up to MAX_ELEMENTS elements, limited by a token bucket and retried
+    with exponential backoff. Results are appended to output after every request and the
+    ids of finished requests with the size of output after their rows to output + ".checkpoint"
+    (see read_checkpoint), so running it again with the same seed continues where the previous
+    run stopped, without rows of a request that was written but not checkpointed.
+    :param api_key: google developer api key (see download)
+    :param output: csv file to append results to
+    :param rounds: number of rounds of sampling (see make_batches)
+    :param seed: seed of the sampling
+    :param concurrency: maximum number of requests at the same time
+    :param rate: maximum number of requests per second
+    :param retries: number of retries of a failed request
+    :param base_url: url of the api, change it to use a mock server (see MockServer)
+    :param nodes_filename: json file with the nodes
+    :return: number of requests done in this run
+    """
+    data = get_input_data(nodes_filename)
+    batches = make_batches(data, rounds, seed)
+
+    checkpoint = output + ".checkpoint"
+    done, size = read_checkpoint(checkpoint)
+    if size is not None and os.path.exists(output) and os.path.getsize(output) > size:
+        # Rows after the last checkpoint belong to a request that is done again
+        with open(output, "r+b") as f:
+            f.truncate(size)
+    if not os.path.exists(output):
+        with open(output, "w", newline="") as f:
+            csv.writer(f).writerow(COLUMNS)
+
+    bucket = TokenBucket(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    write_lock = asyncio.Lock()
+
+    def location(i):
+        lng, lat = data[i]["geo_loc"]
+        return lat, lng
+
+    async def run(batch_id, origin_ind, dest_ind):
+        origins = [location(i) for i in origin_ind]
+        destinations = [location(i) for i in dest_ind]
+        async with semaphore:
+            for attempt in range(retries + 1):
+                await bucket.acquire()
+                try:
+                    res = await asyncio.to_thread(request_matrix, origins, destinations, api_key, base_url)
+                    break
+                except RetryableError as e:
+                    if attempt == retries:
+                        logger.warning("Request %s failed: %s", batch_id, e)
+                        return 0
+                    logger.debug("Request %s: %s, retry %d of %d", batch_id, e, attempt + 1, retries)
+                    await asyncio.sleep(min(60, 2 ** attempt) * (0.5 + random.random()))
+
+        async with write_lock:
+            with open(output, "a", newline="") as f:
+                csv.writer(f).writerows(matrix_rows(origins, destinations, res))
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            with open(checkpoint, "a") as f:
+                f.write(f"{batch_id},{size}\n")
+        return 1
+
+    todo = [run(i, o, d) for i, (o, d) in enumerate(batches) if i not in done]
+    logger.info("Requests: %d of %d left", len(todo), len(batches))
+    return sum(await asyncio.gather(*todo))
+
+
+def read_checkpoint(checkpoint):
+    """
+    Finished requests of collect. Every line is the id of a request and the size of the output
+    after its rows were written, a line cut off by a crash is ignored.
+    :return: a tuple of the set of ids of finished requests and the size of the output
+        after the last of them (None if it is not known)
+    """
+    done, size = set(), None
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                fields = line.split(",")
+                done.add(int(fields[0]))
+                # Checkpoints of older versions only have the ids
+                size = int(fields[1]) if len(fields) > 1 else None
+    return done, size
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    """
+    Local stand-in for the distance matrix API for offline benchmarks of collect.
+    Distances are haversine distances times detour and durations follow from speed.
+    Use it as a context manager, the server runs in a background thread and
+    its url is in the url attribute.
+    """
+
+    def __init__(self, port=0, detour=1.3, speed=30, latency=0.05, error_rate=0.0):
+        """
+        :param port: port to listen on (0 for any free port)
+        :param detour: ratio between driving and haversine distance
+        :param speed: driving speed in km/h
+        :param latency: seconds the server waits before every response
+        :param error_rate: share of requests answered with OVER_QUERY_LIMIT
+        """
+        self.detour, self.speed, self.latency, self.error_rate = detour, speed, latency, error_rate
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/maps/api/distancematrix/json"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        sleep(server.latency)
+
+        def locations(name):
+            return np.array([[float(x) for x in loc.split(",")] for loc in params[name][0].split("|")])
+
+        if random.random() < server.error_rate:
+            res = {"status": "OVER_QUERY_LIMIT", "rows": []}
+        else:
+            o, d = locations("origins"), locations("destinations")
+            lat1, lng1 = np.radians(o[:, [0]]), np.radians(o[:, [1]])
+            lat2, lng2 = np.radians(d[None, :, 0]), np.radians(d[None, :, 1])
+            a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+            meters = 2 * 6371008.8 * np.arcsin(np.sqrt(a)) * server.detour
+            seconds = meters / (server.speed / 3.6)
+            res = {"status": "OK", "rows": [{"elements": [
+                {"status": "OK", "distance": {"value": int(m)}, "duration": {"value": int(s)}}
+                for m, s in zip(row_m, row_s)]} for row_m, row_s in zip(meters, seconds)]}
+
+        body = json.dumps(res).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark_mock(output="mock_learning_data.csv", **kwargs):
+    """
+    Run collect against a local MockServer and print its throughput.
+    :param kwargs: arguments of collect
+    """
+    for filename in (output, output + ".checkpoint"):
+        if os.path.exists(filename):
+            os.remove(filename)
+    with MockServer() as server:
+        tic = time.time()
+        requests = asyncio.run(collect("mock", output=output, base_url=server.url, **kwargs))
+        seconds = time.time() - tic
+    # Requests are not always full (the last one of a round has fewer origins), count the rows
+    with open(output) as f:
+        elements = sum(1 for _ in f) - 1
+    logger.info("%d requests (%d elements) in %.2f s, %.1f requests/s, %.0f elements/s",
+                requests, elements, seconds, requests / seconds, elements / seconds)
+
+
 if __name__ == "__main__":
-    download()
+    parser = argparse.ArgumentParser(description="Collect travel times from the google distance matrix api")
+    parser.add_argument("--output", default="learning_data_all.csv")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=10)
+    parser.add_argument("--mock", action="store_true", help="benchmark against a local mock server")
+    args = parser.parse_args()
+    instrument.configure()
+
+    if args.mock:
+        benchmark_mock(rounds=args.rounds, seed=args.seed, concurrency=args.concurrency, rate=args.rate)
+    else:
+        # Set the api key (see download) in the GOOGLE_MAPS_API_KEY environment variable
+        asyncio.run(collect(os.environ["GOOGLE_MAPS_API_KEY"], output=args.output, rounds=args.rounds,
+                            seed=args.seed, concurrency=args.concurrency, rate=args.rate))
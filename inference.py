@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import pickle
+import argparse
+from datetime import datetime, timezone
+
+import numpy as np
+
+from instrument import span
+
+# Version of the artifact format, load_artifact refuses artifacts of other versions
+ARTIFACT_VERSION = 1
+MODELS_DIR = "models"
+
+
+def save_artifact(model, context, filename, metrics=None):
+    """
+    Save a trained model together with everything needed to use it: the FeatureContext
+    it was trained with (see features.py) and the schema of its features.
+    :param model: trained sklearn regressor
+    :param context: features.FeatureContext of the training features
+    :param filename: file to save the artifact to
+    :param metrics: dict of evaluation metrics of the model, eg. {"rmse": ...}
+    """
+    import sklearn
+
+    artifact = {
+        "version": ARTIFACT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "model_name": type(model).__name__,
+        "params": model.get_params(),
+        "sklearn_version": sklearn.__version__,
+        "features": context.names,
+        "metrics": metrics or {},
+        "model": model,
+        "context": context,
+    }
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "wb") as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_artifact(filename):
+    """
+    Load an artifact saved by save_artifact.
+    :raises ValueError: if the artifact has an unsupported version or its features don't match its context
+    """
+    with open(filename, "rb") as f:
+        artifact = pickle.load(f)
+    if artifact.get("version") != ARTIFACT_VERSION:
+        raise ValueError(f"Unsupported model artifact version {artifact.get('version')} in {filename}, "
+                         f"expected {ARTIFACT_VERSION}")
+    if artifact["features"] != artifact["context"].names:
+        raise ValueError(f"Features of the model in {filename} don't match its feature context")
+    return artifact
+
+
+class Predictor:
+    """
+    Travel time predictions of a saved model. The artifact is loaded once,
+    then pairs are predicted in batches of fixed size.
+    """
+
+    def __init__(self, filename, chunk_size=4096):
+        """
+        :param filename: artifact saved by save_artifact
+        :param chunk_size: number of pairs whose features are computed and predicted at once
+        """
+        self.artifact = load_artifact(filename)
+        self.model = self.artifact["model"]
+        self.context = self.artifact["context"]
+        self.chunk_size = chunk_size
+
+    def predict(self, x1, y1, x2, y2):
+        """
+        Predict travel times (in hours, like google_time) between locations.
+        :param x1: latitudes of origins
+        :param y1: longitudes of origins
+        :param x2: latitudes of destinations
+        :param y2: longitudes of destinations
+        :return: array of predicted travel times
+        """
+        x1, y1, x2, y2 = (np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in (x1, y1, x2, y2))
+        predictions = np.empty(len(x1))
+        with span("model.predict", model=self.artifact["model_name"], rows=len(x1)):
+            for start in range(0, len(x1), self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                predictions[chunk] = self.model.predict(self.context.compute(x1[chunk], y1[chunk], x2[chunk], y2[chunk]))
+        return predictions
+
+    def predict_nodes(self, n1, n2):
+        """
+        Same as predict, but between centroids of nodes.
+        """
+        a, b = self.context.geo_loc[self.context.rows(n1)], self.context.geo_loc[self.context.rows(n2)]
+        return self.predict(a[..., 1], a[..., 0], b[..., 1], b[..., 0])
+
+    def latency(self, batch_size=1000, repeats=200, seed=0):
+        """
+        Measure latency of predicting batches of random node pairs.
+        :return: dict with p50 and p99 latency in milliseconds
+        """
+        rng = np.random.default_rng(seed)
+        ids = self.context.ids
+        self.predict_nodes(rng.choice(ids, size=batch_size), rng.choice(ids, size=batch_size))
+        times = []
+        for _ in range(repeats):
+            n1, n2 = rng.choice(ids, size=batch_size), rng.choice(ids, size=batch_size)
+            tic = time.perf_counter()
+            self.predict_nodes(n1, n2)
+            times.append(1000 * (time.perf_counter() - tic))
+        return {"p50": float(np.percentile(times, 50)), "p99": float(np.percentile(times, 99))}
+
+
+def add_arguments(parser):
+    """
+    Arguments of predictions from the command line, shared with the predict command of cli.py.
+    """
+    parser.add_argument("--model", default=os.path.join(MODELS_DIR, "random_forest.pkl"))
+    parser.add_argument("--input", help="csv with columns x1, y1, x2, y2 (or n1, n2 with --nodes), - for stdin")
+    parser.add_argument("--output", default="-", help="csv to write predictions to, - for stdout")
+    parser.add_argument("--nodes", action="store_true", help="input has node ids instead of coordinates")
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--benchmark", action="store_true", help="measure latency of batches of 1000 pairs")
+    return parser
+
+
+def run(args):
+    """
+    Predict travel times of the pairs of a csv file with parsed arguments (see add_arguments).
+    """
+    predictor = Predictor(args.model, chunk_size=args.chunk_size)
+    if args.benchmark:
+        print(predictor.latency())
+        return
+
+    import pandas as pd
+
+    df = pd.read_csv(sys.stdin if args.input in (None, "-") else args.input)
+    if args.nodes:
+        df["google_time"] = predictor.predict_nodes(df.n1.values, df.n2.values)
+    else:
+        df["google_time"] = predictor.predict(df.x1.values, df.y1.values, df.x2.values, df.y2.values)
+    df.to_csv(sys.stdout if args.output == "-" else args.output, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Predict travel times with a model saved by model.do_model")
+    run(add_arguments(parser).parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
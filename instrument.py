@@ -0,0 +1,165 @@
+"""
+Spans for measuring where time and memory go in the pipeline.
+
+A span is a named block of code (loading, parsing, building a graph, a centrality, ...)
+measured with wall time, CPU time and peak RSS, with counts of nodes and edges it worked on.
+Nothing has to be edited to measure a run, it is controlled by environment variables:
+
+    INA_TRACE       json lines file every finished span is appended to
+    INA_PROFILE     "cprofile", "tracemalloc" or both separated by a comma
+    INA_PROFILE_DIR directory of cProfile stats of outermost spans (default "profiles")
+    INA_LOG_LEVEL   level of console output of scripts (default INFO, DEBUG shows every span)
+"""
+import os
+import json
+import time
+import logging
+import resource
+import functools
+import itertools
+
+logger = logging.getLogger(__name__)
+
+TRACE = os.environ.get("INA_TRACE")
+PROFILE = {p.strip() for p in os.environ.get("INA_PROFILE", "").lower().split(",") if p.strip()}
+PROFILE_DIR = os.environ.get("INA_PROFILE_DIR", "profiles")
+
+# Spans open in the current process, the innermost last
+_stack = []
+_ids = itertools.count(1)
+# Trace file of the current process, reopened in forked workers
+_trace = {}
+
+
+def configure(level=None):
+    """
+    Set up console logging for scripts. The level is taken from INA_LOG_LEVEL if not given.
+    """
+    level = level or os.environ.get("INA_LOG_LEVEL", "INFO")
+    logging.basicConfig(level=level.upper() if isinstance(level, str) else level,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+def peak_rss():
+    """
+    Peak resident memory of the process in MB (ru_maxrss is in kilobytes on linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _write(record):
+    pid = os.getpid()
+    if pid not in _trace:
+        _trace.clear()
+        _trace[pid] = open(TRACE, "a", buffering=1)
+    _trace[pid].write(json.dumps(record) + "\n")
+
+
+class Span:
+    """
+    A measured block of code, created by span.
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.id = next(_ids)
+        self.parent = _stack[-1] if _stack else None
+        self._traced_peak = 0
+        self._profile = None
+
+    def set(self, **attrs):
+        """
+        Add attributes to the span, eg. span.set(rows=len(df)).
+        """
+        self.attrs.update(attrs)
+        return self
+
+    def graph(self, G):
+        """
+        Record the number of nodes and edges of a networkx graph or a sparse matrix.
+        """
+        if hasattr(G, "number_of_nodes"):
+            return self.set(nodes=G.number_of_nodes(), edges=G.number_of_edges())
+        return self.set(nodes=G.shape[0], edges=int(G.nnz))
+
+    def __enter__(self):
+        if "tracemalloc" in PROFILE:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # The peak is shared by nested spans, so remember the parent's peak before resetting it
+            if self.parent is not None:
+                self.parent._traced_peak = max(self.parent._traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        # Only one profiler can run at a time, so only outermost spans are profiled
+        if "cprofile" in PROFILE and not _stack:
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+        _stack.append(self)
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        _stack.pop()
+
+        record = {"name": self.name, "id": self.id, "parent": self.parent.id if self.parent else None,
+                  "pid": os.getpid(), "start": time.time() - wall, "wall": wall, "cpu": cpu,
+                  "peak_rss_mb": peak_rss(), **self.attrs}
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+
+        if "tracemalloc" in PROFILE:
+            import tracemalloc
+
+            self._traced_peak = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+            record["traced_peak_mb"] = self._traced_peak / 2 ** 20
+            if self.parent is not None:
+                self.parent._traced_peak = max(self.parent._traced_peak, self._traced_peak)
+            tracemalloc.reset_peak()
+        if self._profile is not None:
+            self._profile.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            filename = os.path.join(PROFILE_DIR, f"{self.name}_{os.getpid()}_{self.id}.prof")
+            self._profile.dump_stats(filename)
+            record["profile"] = filename
+
+        if TRACE:
+            _write(record)
+        logger.debug("%s: %.3f s wall, %.3f s cpu, %.0f MB peak RSS %s",
+                     self.name, wall, cpu, record["peak_rss_mb"], self.attrs or "")
+        return False
+
+
+def span(name, **attrs):
+    """
+    Measure a block of code:
+
+        with span("build.temporal_graph", interval=0) as s:
+            G = ...
+            s.graph(G)
+
+    :param name: name of the span, stages are prefixed with load, parse, build, centrality, routing or model
+    :param attrs: attributes saved with the span
+    """
+    return Span(name, attrs)
+
+
+def traced(name=None):
+    """
+    Decorator measuring every call of a function as a span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__qualname__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
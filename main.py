@@ -1,114 +1,208 @@
+import numpy as np
 import pandas as pd
-import geojson
 from pprint import pprint
 import json
 import pickle
+import logging
+import itertools
+
+import edge_store
+import geometry
+import instrument
+import sketches
+from instrument import span
+
+logger = logging.getLogger(__name__)
+
+
+# Time interval of every hour of the day (index is the hod column):
+#     6-10 morning rush -> 0
+#     10-14 mid-day -> 1
+#     14-18 evening rush -> 2
+#     18-6 (next day) non-rush -> 3
+HOD_INTERVALS = np.array([3] * 6 + [0] * 4 + [1] * 4 + [2] * 4 + [3] * 6)
+# Finest resolution of the data, every hour of the day is its own time slice
+HOURLY = np.arange(24)
+
+
+def aggregate(key, weights=None):
+    """
+    Sum up weights of equal keys.
+    :return: a tuple of the sorted distinct keys, the sums of their weights and their counts
+    """
+    keys, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+    return keys, np.bincount(inverse, weights=weights, minlength=len(keys)), counts.astype(np.int64)
+
+
+def merge_aggregates(a, b):
+    """
+    Merge two aggregates (see aggregate) into the aggregate of all their rows.
+    """
+    keys = np.union1d(a[0], b[0])
+    i, j = np.searchsorted(keys, a[0]), np.searchsorted(keys, b[0])
+    sums, counts = np.zeros(len(keys)), np.zeros(len(keys), dtype=np.int64)
+    sums[i], counts[i] = a[1], a[2]
+    sums[j] += b[1]
+    counts[j] += b[2]
+    return keys, sums, counts
+
+
+def aggregate_travel_times(filename, n_nodes, chunksize=1_000_000, hod_intervals=HOD_INTERVALS,
+                           sketch_intervals=None):
+    """
+    Stream the csv file in chunks and sum up mean travel times of every (interval, source, destination).
+    Edges are keyed by (interval * n_nodes + source) * n_nodes + destination, every chunk is aggregated
+    by its keys and the aggregates (and sketches) of chunks are merged pairwise (see sketches.PairwiseMerge),
+    so memory depends on the number of observed edges and the chunk size, not on the size of the file
+    or all pairs of nodes, and every edge is copied about log2(chunks) times.
+    :param filename: Name of the file to read data from
+    :param n_nodes: Number of nodes, all node ids must be smaller
+    :param chunksize: Number of csv rows read at once
+    :param hod_intervals: Time interval of each hour of the day
+    :param sketch_intervals: Time interval of each hour of the day for travel time sketches
+        (see sketches.py), None to skip them
+    :return: a tuple of
+        - keys: sorted keys of observed edges
+        - sums: sum of mean travel times for every key
+        - counts: number of rows for every key
+        - sketch: sketch of travel times of edges observed in sketch_intervals, keyed like sums, or None
+    """
+    totals = sketches.PairwiseMerge(merge_aggregates)
+    sketch_parts = None if sketch_intervals is None else sketches.PairwiseMerge(sketches.merge)
+
+    # Sums only need the mean travel time, the spread of travel times is read only for sketches
+    columns = ["sourceid", "dstid", "hod", "mean_travel_time"]
+    if sketch_parts is not None:
+        columns += ["standard_deviation_travel_time", "geometric_mean_travel_time",
+                    "geometric_standard_deviation_travel_time"]
+    chunks = iter(pd.read_csv(filename, usecols=columns, chunksize=chunksize))
+    for cnt in itertools.count():
+        with span("load.csv_chunk", chunk=cnt) as s:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            s.set(rows=len(chunk))
+        logger.info("Aggregating chunk: %s", cnt)
+
+        with span("parse.csv_chunk", chunk=cnt, rows=len(chunk)):
+            src = chunk["sourceid"].values
+            dst = chunk["dstid"].values
+            if max(src.max(), dst.max()) >= n_nodes:
+                raise ValueError(f"Node id out of range in {filename}, expected ids below {n_nodes}")
+
+            key = (hod_intervals[chunk["hod"].values].astype(np.int64) * n_nodes + src) * n_nodes + dst
+            totals.add(aggregate(key, chunk["mean_travel_time"].values))
+
+        if sketch_parts is not None:
+            with span("build.sketches", chunk=cnt, rows=len(chunk)):
+                key = (sketch_intervals[chunk["hod"].values].astype(np.int64) * n_nodes + src) * n_nodes + dst
+                sketch_parts.add(sketches.from_observations(
+                    key, chunk["mean_travel_time"].values, chunk["standard_deviation_travel_time"].values,
+                    chunk["geometric_mean_travel_time"].values, chunk["geometric_standard_deviation_travel_time"].values))
+
+    total = totals.result((np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)))
+    return (*total, None if sketch_parts is None else sketch_parts.result(sketches.empty()))
+
+
+def interval_edges(keys, sums, counts, time_interval, n_nodes):
+    """
+    Edges of one time interval from the aggregated keys, sums and counts.
+    :return: a tuple of src, dst, mean travel time and count arrays
+    """
+    block = slice(*np.searchsorted(keys, [time_interval * n_nodes * n_nodes, (time_interval + 1) * n_nodes * n_nodes]))
+    pair = keys[block] - time_interval * n_nodes * n_nodes
+    return pair // n_nodes, pair % n_nodes, sums[block] / counts[block], counts[block]
+
+
+def group_hours(keys, sums, counts, hod_slices, n_nodes):
+    """
+    Sum up hourly sums and counts (aggregate_travel_times with HOURLY) into coarser time slices.
+    :param hod_slices: time slice of each hour of the day, eg. HOD_INTERVALS
+    :return: keys, sums and counts of the slices, keyed like aggregate_travel_times
+    """
+    hour, pair = np.divmod(keys, n_nodes * n_nodes)
+    grouped, inverse = np.unique(np.asarray(hod_slices, dtype=np.int64)[hour] * n_nodes * n_nodes + pair,
+                                 return_inverse=True)
+    return (grouped, np.bincount(inverse, weights=sums, minlength=len(grouped)),
+            np.bincount(inverse, weights=counts, minlength=len(grouped)).astype(np.int64))
+
+
+def slice_edges(keys, sums, counts, n_nodes, n_slices):
+    """
+    Edges of all time slices at once, over one shared set of edges: every pair of nodes
+    with a travel time in any slice. Slices without data of an edge get its mean over the whole day.
+    Only the observed pairs get a column, not all pairs of nodes.
+    :return: a tuple of src, dst, mean travel time and count arrays, the last two of shape (slices, edges)
+    """
+    time_slice, pair = np.divmod(keys, n_nodes * n_nodes)
+    pairs, edge = np.unique(pair, return_inverse=True)
+    slice_sums = np.zeros((n_slices, len(pairs)))
+    slice_counts = np.zeros((n_slices, len(pairs)), dtype=np.int64)
+    slice_sums[time_slice, edge], slice_counts[time_slice, edge] = sums, counts
+    day = slice_sums.sum(axis=0) / slice_counts.sum(axis=0)
+    mean = np.where(slice_counts > 0, slice_sums / np.maximum(slice_counts, 1), day)
+    return pairs // n_nodes, pairs % n_nodes, mean, slice_counts
 
 
 def read_from_csv(filename="london-lsoa-2020-1-All-HourlyAggregate.csv",
-                  geojson_filename="london_lsoa.json"):
+                  geojson_filename="london_lsoa.json", store_path=edge_store.STORE_DIR,
+                  chunksize=1_000_000, hod_slices=HOURLY, sketch=True):
     """
     Function takes the file, reads its data and processes it into a format that we need.
+    The file is read in chunks (see aggregate_travel_times), so it can be larger than memory.
+    Travel times are aggregated per hour once, then summed up into the four time intervals
+    of the temporal graphs and into the time slices of time-dependent routing (see edge_store.save_slices).
     :param filename: Name of the file to read data from
     :param geojson_filename: Name of the file to read geo data from
+    :param store_path: Directory of the edge store to write the graph data to
+    :param chunksize: Number of csv rows read at once
+    :param hod_slices: Time slice of each hour of the day for time-dependent routing, None to skip them
+    :param sketch: Also save sketches of travel times of every edge in every interval (see sketches.py),
+        so temporal graphs can be weighted by percentiles of travel times
     :return:
     """
-    df = pd.read_csv(filename)
+    # Centroids, areas and neighbours of districts from the geo data, they are
+    # computed once and cached in the edge store (see geometry.py)
+    with span("load.geometry"):
+        table = geometry.node_table(geojson_filename, path=store_path)
+    nodes_data = [{"display_name": str(name), "node_id": str(node_id), "geo_loc": loc}
+                  for name, node_id, loc in zip(table["names"], table["ids"].tolist(), table["geo_loc"].tolist())]
+    n_nodes = int(table["ids"].max()) + 1
 
-    # Remove data we don't need
-    df.drop('standard_deviation_travel_time', inplace=True, axis=1)
-    df.drop('geometric_standard_deviation_travel_time', inplace=True, axis=1)
-    df.drop('geometric_mean_travel_time', inplace=True, axis=1)
+    # Separate the data into hours of the day, which are later summed up into
+    # time chunks (see HOD_INTERVALS) to average the travel times of each edge in every interval
+    with span("parse.travel_times", nodes=n_nodes):
+        *hourly, edge_sketch = aggregate_travel_times(
+            filename, n_nodes, chunksize=chunksize, hod_intervals=HOURLY,
+            sketch_intervals=HOD_INTERVALS if sketch else None)
+        intervals = group_hours(*hourly, HOD_INTERVALS, n_nodes)
 
-    # Separate the data into different time chunks (as defined below)
-    """
-        6-10 morning rush
-        10-14 mid-day
-        14-18 evening rush
-        18-6 (next day) non-rush -> this is in one dataframe
-    """
-    df_midnight_five = df[df["hod"] < 6]
-    df_copy = df.drop(df_midnight_five.index.values)
-    df_morning_rush = df_copy[df_copy["hod"] < 10]
-    df_copy = df_copy.drop(df_morning_rush.index.values)
-    df_mid_day = df_copy[df_copy["hod"] < 14]
-    df_copy = df_copy.drop(df_mid_day.index.values)
-    df_afternoon_rush = df_copy[df_copy["hod"] < 18]
-    df_copy = df_copy.drop(df_afternoon_rush.index.values)
-    df_six_midnight = df_copy.copy()
-    df_copy = df_copy.drop(df_six_midnight.index.values)
-    df_night = pd.concat([df_midnight_five, df_six_midnight])
-
-    # Read geo data from the json file
-    with open(geojson_filename) as f:
-        geo_data = geojson.load(f)
-    # pprint(geo_data["features"][1])
-
-    # Save geo data from the json file
-    nodes_data = []
-    for district in geo_data["features"]:
-        properties = district["properties"]
-        coordinates = district["geometry"]["coordinates"][0][0]
-        # Take average geo location of district
-        sum_x = 0
-        sum_y = 0
-        for [x, y] in coordinates:
-            sum_x += x
-            sum_y += y
-        # There is some more data we can save, but I am not really sure what it means
-        nodes_data.append({
-            "display_name": properties["DISPLAY_NAME"],
-            "node_id": properties["MOVEMENT_ID"],
-            "geo_loc": [sum_x / len(coordinates), sum_y / len(coordinates)]
-        })
-
-    # Convert data frames into lists, so they take less space and only convey information that we need
-    edges = []
-    for cnt, df_e in enumerate([df_morning_rush, df_mid_day, df_afternoon_rush, df_night]):
-        df_e.drop('hod', inplace=True, axis=1)
-
-        print(f"Iterating data in interval: {cnt}")
-        to_print = []
-        visited = {}
-        for [i, j, mtt] in df_e.values.tolist():
-            if f"{i},{j}" not in visited:
-                visited[f"{i},{j}"] = [mtt]
-            else:
-                visited[f"{i},{j}"].append(mtt)
-
-        for key in visited:
-            i, j = [float(x) for x in key.split(",")]
-            vals = visited[key]
-            to_print.append([int(i), int(j), sum(vals)/len(vals)])
-
-        # The last interval is very large, so we split it into three parts, so the files can be stored on github
-        """if cnt == 3:
-            mod = int(len(to_print) / 3)
-            t = []
-            for i, el in enumerate(to_print):
-                t.append(el)
-                # If condition is (i + 1) % mod == 0, then we will get one small file with 1-3 edges in it and we don't
-                # want that
-                if (i + 1) % (mod + 3) == 0:
-                    edges.append(t)
-                    t = []
-            edges.append(t)
-        else:"""
-        edges.append(to_print)
-
-    dict_to_save = {
-        "nodes": nodes_data,
-        "edges": edges
-    }
     # Write data to json files, with formating for easier reading
     with open('nodes_data.json', 'w') as handle:
-        json.dump(dict_to_save["nodes"], handle, indent=2)
+        json.dump(nodes_data, handle, indent=2)
+
+    # Edges are written into the binary edge store (columns of src, dst and travel time),
+    # which construct_graphs memory-maps instead of parsing json
+    for i in range(HOD_INTERVALS.max() + 1):
+        logger.info("Saving data in interval: %s", i)
+        with span("build.edges", interval=i) as s:
+            src, dst, mean, count = interval_edges(*intervals, i, n_nodes)
+            edge_store.save_edges(i, src, dst, mean, count, path=store_path)
+            s.set(nodes=n_nodes, edges=len(src))
 
-    for i, e in enumerate(dict_to_save["edges"]):
-        with open(f'edges_data_{i}.json', 'w') as handle:
-            # parsed = json.loads(str(e))
-            json.dump(e, handle)  # , indent=2)
+    if edge_sketch is not None:
+        logger.info("Saving travel time sketches")
+        sketches.save(edge_sketch, n_nodes, store_path)
 
+    if hod_slices is not None:
+        hod_slices = np.asarray(hod_slices)
+        logger.info("Saving data in %s time slices", hod_slices.max() + 1)
+        with span("build.slices", slices=int(hod_slices.max() + 1)) as s:
+            src, dst, mean, count = slice_edges(*group_hours(*hourly, hod_slices, n_nodes), n_nodes,
+                                                int(hod_slices.max() + 1))
+            edge_store.save_slices(src, dst, mean, count, hod_slices, path=store_path)
+            s.set(nodes=n_nodes, edges=len(src))
 
 if __name__ == "__main__":
+    instrument.configure()
     read_from_csv()
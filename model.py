@@ -1,67 +1,105 @@
+import os
+import logging
 from pprint import pprint
+from collections import deque
 
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
-from sklearn.metrics import mean_squared_error
 import numpy as np
-import pandas as pd
-from sklearn.model_selection import train_test_split
-import matplotlib.pyplot as plt
-import networkx as nx
 import construct_graphs
+import edge_store
+from features import load_features, load_context
+from inference import save_artifact, MODELS_DIR
+import routing
+import instrument
+from instrument import span
 
+logger = logging.getLogger(__name__)
 
-def predict_with_shortest_path(n1, n2, G):
+
+def predict_with_shortest_path(n1, n2, G, bounds=None, approximate=False, time_interval=None,
+                               path=edge_store.STORE_DIR):
     """
     Predict time of travel between two nodes, that we do not have data for
     :param n1: node a
     :param n2: node b
     :param G: Graph with nodes a and b
-    :return: time of travel between a and b
+    :param bounds: lower bounds for A* (see routing.haversine_bounds), bidirectional dijkstra if None
+    :param approximate: use the faster bfs_first_joint, which doesn't always find the shortest path
+    :param time_interval: interval G was built from. Its precomputed travel times between all nodes
+        are looked up when they are current, otherwise its landmarks (see routing.build_landmarks) give
+        the bounds for A*, and without landmarks the travel times are computed once and shared
+        (see travel_times.all_sources)
+    :param path: directory of the edge store with the travel times and landmarks
+    :return: time of travel between a and b, None if there is no path
     """
-    path = nx.shortest_path(G, source=n1, target=n2, weight="weight")
-    travel_time = 0
-    prev = path[0]
-    print(path)
-    for node in path[1:]:
-        travel_time += G[prev][node]["weight"]
-        prev = node
+    if approximate:
+        return bfs_first_joint(n1, n2, G)
+
+    if time_interval is not None:
+        import travel_times
+
+        landmarks = routing.load_landmarks(time_interval, path)
+        if travel_times.is_current(time_interval, path) or landmarks is None:
+            D, _ = travel_times.all_sources(time_interval, path=path)
+            return float(D[n1, n2]) if np.isfinite(D[n1, n2]) else None
+        bounds = bounds or landmarks.bounds
+
+    travel_time, route = routing.bidirectional_search(G, n1, n2, bounds=bounds)
     return travel_time
 
 
+def predict_with_travel_times(n1, n2, time_interval, travel_times):
+    """
+    Same as predict_with_shortest_path for many pairs at once, using travel times
+    precomputed for all pairs of nodes (see travel_times.py)
+    :param n1: array of nodes a
+    :param n2: array of nodes b
+    :param time_interval: array of time intervals (or one interval for all pairs)
+    :param travel_times: travel_times.TravelTimes with the intervals loaded
+    :return: array of times of travel between a and b
+    """
+    with span("routing.lookup", pairs=int(np.size(n1))):
+        return travel_times.lookup(n1, n2, time_interval)
+
+
+def joint_path(node, visited_curr, visited_opposite):
+    """
+    Helper function for the check_bfs().
+    Build the path through node from parents in both visited dicts.
+    """
+    path = [node]
+    while visited_curr[path[-1]]["parent"] is not None:
+        path.append(visited_curr[path[-1]]["parent"])
+    path.reverse()
+    while visited_opposite[path[-1]]["parent"] is not None:
+        path.append(visited_opposite[path[-1]]["parent"])
+    return path
+
+
 def check_bfs(neigh, G, visited_curr, visited_opposite, queue):
     """
     Helper function for the bfs_first_joint().
     Checks whether current neighbor has been visited on other side.
     If it has been visited on other side, then return the weights of both paths.
-    Else iterate over its neighbors, build their paths and calculate weights and add them to
+    Else iterate over its neighbors, remember their parent and calculate weights and add them to
     visited_curr, then add them to the queue.
     :param neigh: current node under consideration
     :param G: given graph
     :param visited_curr: dict of visited nodes for the current node (from n1 or n2 side)
     :param visited_opposite: dict of visited nodes for the opposited node (from n2 or n1 side)
-    :param queue: the queue for the BFS
+    :param queue: the queue (deque) for the BFS
     :return: if path found -> travel time, else -> None
     """
-    curr_path = visited_curr[neigh]["path"]
     if neigh in visited_opposite:
-        """ 
-        # Test prints
-        pprint(visited_curr)
-        pprint(visited_opposite)
-        """
-        visited_opposite[neigh]["path"].reverse()
-        curr_path.extend(visited_opposite[neigh]["path"][1:])
-        print(f'First joint on node: {neigh}, with path: {curr_path}')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('First joint on node: %s, with path: %s', neigh, joint_path(neigh, visited_curr, visited_opposite))
         return visited_curr[neigh]["weight"] + visited_opposite[neigh]["weight"]
 
     for n, metadata in sorted(G[neigh].items(), key=lambda edge: edge[1]['weight']):
         if n not in visited_curr:
             queue.append(n)
-            p = curr_path.copy()
-            p.append(n)
             visited_curr[n] = {
                 "weight": visited_curr[neigh]["weight"] + metadata["weight"],
-                "path": p
+                "parent": neigh
             }
 
     return None
@@ -72,23 +110,24 @@ def bfs_first_joint(n1, n2, G):
     Do BFS over graph from n1 to n2 and n2 to n1 at the same time.
     Take first common neighbor of n1 and n2, n3. Return travel time = p1 + p2,
     where p1 is travel time over path from n1 to n3 and p2 is travel time over path from n2 to n3.
+    This is fast, but usually not the shortest path (see routing.bidirectional_search for the exact one).
     :param n1: node a
     :param n2: node b
     :param G: Graph with nodes a and b
     :return: time of travel between a and b. If no travel time is found, return None
     """
 
-    visited1 = {n1: {"weight": 0, "path": [n1]}}
-    visited2 = {n2: {"weight": 0, "path": [n2]}}
-    queue1 = [n1]
-    queue2 = [n2]
+    visited1 = {n1: {"weight": 0, "parent": None}}
+    visited2 = {n2: {"weight": 0, "parent": None}}
+    queue1 = deque([n1])
+    queue2 = deque([n2])
     while queue1 and queue2:
-        travel_time = check_bfs(queue1.pop(0), G, visited_curr=visited1, visited_opposite=visited2, queue=queue1)
-        if travel_time:
+        travel_time = check_bfs(queue1.popleft(), G, visited_curr=visited1, visited_opposite=visited2, queue=queue1)
+        if travel_time is not None:
             return travel_time
 
-        travel_time = check_bfs(queue2.pop(0), G, visited_curr=visited2, visited_opposite=visited1, queue=queue2)
-        if travel_time:
+        travel_time = check_bfs(queue2.popleft(), G, visited_curr=visited2, visited_opposite=visited1, queue=queue2)
+        if travel_time is not None:
             return travel_time
 
     return None
@@ -120,21 +159,32 @@ def model_train_rmse(model, train_x, train_y, test_x, test_y):
         - predicts: the predicted values stored in a list
         - rmse: RMSE value calculated for this model
     """
-    model.fit(train_x, train_y.ravel())
-    predicts = model.predict(test_x)
+    from sklearn.metrics import mean_squared_error
+
+    with span("model.fit", model=type(model).__name__, rows=len(train_x)):
+        model.fit(train_x, train_y.ravel())
+    with span("model.predict", model=type(model).__name__, rows=len(test_x)):
+        predicts = model.predict(test_x)
     rmse = np.sqrt(mean_squared_error(test_y, predicts))
-    print("For model:", str(model), "RMSE:", rmse, "Score:", model.score(test_x, test_y))
+    logger.info("For model: %s RMSE: %s Score: %s", model, rmse, model.score(test_x, test_y))
     return predicts, rmse
 
 
-def do_model():
-    df = pd.read_csv("learning_data_all.csv")
-    # df = pd.read_csv("edges_data_0.json")
-    google_time = df.google_time.values.reshape(-1, 1)
-    print(google_time)
-
-    features = ["aerial", "x1", "x2", "y1", "y2"]
-    X = df.loc[:, features].values
+def do_model(filename="learning_data_all.csv", plot=True):
+    """
+    Train the random forest and gradient boosting regressors on features of the learning data,
+    save them for inference and plot their predictions of the test set against google times.
+    :param filename: csv from google_data.py
+    :param plot: save the plot into learning_time.png and show it
+    """
+    # sklearn and matplotlib are slow to import, so they are only imported for training
+    from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+    from sklearn.model_selection import train_test_split
+
+    # Features are computed once and cached (see features.py), so retraining skips them
+    X, google_time, features = load_features(filename)
+    google_time = google_time.reshape(-1, 1)
+    logger.info("Features: %s", features)
     X_train, X_test, time_train, time_test = train_test_split(X, google_time,
                                                               test_size=0.30,
                                                               random_state=42)
@@ -144,6 +194,15 @@ def do_model():
     br = GradientBoostingRegressor()
     predicts_br, rmse_br = model_train_rmse(br, X_train, time_train, X_test, time_test)
 
+    # Save both models with their features, so they can be used for predictions (see inference.py)
+    context = load_context()
+    save_artifact(rfr, context, os.path.join(MODELS_DIR, "random_forest.pkl"), {"rmse": rmse_rfr})
+    save_artifact(br, context, os.path.join(MODELS_DIR, "gradient_boosting.pkl"), {"rmse": rmse_br})
+    if not plot:
+        return
+
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.set_ylabel("Travel time (predicted)")
     ax.set_xlabel("Travel time (by google maps)")
@@ -165,5 +224,6 @@ def do_model():
 
 
 if __name__ == "__main__":
+    instrument.configure()
     # do_model()
     test_bfs()
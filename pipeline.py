@@ -0,0 +1,255 @@
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+import construct_graphs
+import edge_store
+import sparse_centrality
+from instrument import span
+
+# Graphs of the analysis: "spatial" is the spatial graph, numbers are time intervals of temporal graphs
+GRAPHS = {
+    "spatial": "spatial graph",
+    0: "temporal graph - morning",
+    1: "temporal graph - mid",
+    2: "temporal graph - afternoon",
+    3: "temporal graph - night",
+}
+
+# Ordered from the slowest to the fastest, so the longest jobs are started first
+METRICS = {
+    "betweenness": nx.betweenness_centrality,
+    "closeness": construct_graphs.closeness,
+    "sampled_betweenness": construct_graphs.approximate_betweenness,
+    "sampled_closeness": construct_graphs.approximate_closeness,
+    "pagerank": nx.pagerank,
+}
+
+# Metrics estimated from sampled pivots (see construct_graphs.sampled_centrality), they take
+# the sampling arguments of run and report the number of samples, the stability of the top and the error
+SAMPLED_METRICS = ("sampled_betweenness", "sampled_closeness")
+
+# Metrics of the analysis computed by default, the exact ones
+DEFAULT_METRICS = [metric for metric in METRICS if metric not in SAMPLED_METRICS]
+
+# Metrics of the scipy backend, computed on CSR matrices (see sparse_centrality.py),
+# other metrics fall back to networkx
+SPARSE_METRICS = {
+    "closeness": sparse_centrality.closeness_csr,
+    "pagerank": sparse_centrality.pagerank_csr,
+}
+
+# Metrics of temporal graphs computed from the travel times between all pairs of nodes, which are
+# computed once and shared with routing and evaluation (see travel_times.all_sources)
+TRAVEL_TIME_METRICS = {
+    "travel_time_closeness": sparse_centrality.closeness_from_distances,
+}
+
+# Version of the code of the jobs, increase it when results of run_job change for the same graph
+# (eg. a fixed metric or new result columns), so results cached by older code are recomputed
+CACHE_VERSION = 2
+
+# Columns of the results table, samples, stability and error are only set for SAMPLED_METRICS
+COLUMNS = ["graph", "metric", "rank", "node", "value", "degree", "time", "samples", "stability", "error"]
+
+# Graphs already built in the current worker process
+_graphs = {}
+
+
+def load_graph(graph, path=edge_store.STORE_DIR):
+    """
+    Build a graph of the analysis (see GRAPHS) or return it if this process already built it.
+    Workers build graphs from the memory-mapped edge store, so the edge arrays are
+    shared through the page cache instead of pickling networkx graphs between processes.
+    :param graph: "spatial" or time interval of the temporal graph
+    :param path: directory of the edge store
+    :return: networkx graph
+    """
+    if (graph, path) not in _graphs:
+        if graph == "spatial":
+            _graphs[graph, path] = construct_graphs.spatial_graph(path=path)
+        else:
+            _graphs[graph, path] = construct_graphs.temporal_graph(graph, path)
+    return _graphs[graph, path]
+
+
+def load_csr(graph, path=edge_store.STORE_DIR):
+    """
+    Same as load_graph, but the graph is a CSR matrix indexed by node ids.
+    """
+    if ("csr", graph, path) not in _graphs:
+        if graph == "spatial":
+            _graphs["csr", graph, path] = construct_graphs.spatial_csr(path=path)
+        else:
+            _graphs["csr", graph, path] = construct_graphs.temporal_csr(graph, path)
+    return _graphs["csr", graph, path]
+
+
+def run_job(graph, metric, n=15, path=edge_store.STORE_DIR, backend="networkx", sampling=None):
+    """
+    Compute one centrality on one graph and keep its top n nodes.
+    :param sampling: arguments of sampled metrics (see run)
+    :return: list of result rows (see run)
+    """
+    if metric in TRAVEL_TIME_METRICS:
+        import travel_times
+
+        ids, _ = construct_graphs.read_nodes(path)
+        A = load_csr(graph, path)
+
+        tic = time.time()
+        with span("centrality." + metric, graph=graph, backend="travel_times") as s:
+            D, _ = travel_times.all_sources(graph, path=path)
+            C = TRAVEL_TIME_METRICS[metric](D[np.ix_(ids, ids)])
+            s.graph(A)
+        seconds = time.time() - tic
+
+        degree = A.getnnz(axis=1) + A.getnnz(axis=0)
+        top = np.argsort(-C, kind="stable")[:n]
+        return [{"graph": graph, "metric": metric, "rank": rank, "node": int(ids[i]),
+                 "value": float(C[i]), "degree": int(degree[ids[i]]), "time": seconds}
+                for rank, i in enumerate(top, start=1)]
+
+    if backend == "scipy" and metric in SPARSE_METRICS:
+        A = load_csr(graph, path)
+
+        tic = time.time()
+        with span("centrality." + metric, graph=graph, backend=backend) as s:
+            C = SPARSE_METRICS[metric](A)
+            s.graph(A)
+        seconds = time.time() - tic
+
+        degree = A.getnnz(axis=1) + (A.getnnz(axis=0) if graph != "spatial" else 0)
+        top = np.argsort(-C, kind="stable")[:n]
+        return [{"graph": graph, "metric": metric, "rank": rank, "node": int(i),
+                 "value": float(C[i]), "degree": int(degree[i]), "time": seconds}
+                for rank, i in enumerate(top, start=1)]
+
+    G = load_graph(graph, path)
+
+    tic = time.time()
+    with span("centrality." + metric, graph=graph, backend="networkx") as s:
+        # Only the top n nodes are needed, so closeness prunes searches of the other nodes
+        kwargs = {"n": n, "seed": 0, **(sampling or {})} if metric in SAMPLED_METRICS else {}
+        top = construct_graphs.top_k(G, METRICS[metric], n, metric, **kwargs)
+        s.graph(G)
+    seconds = time.time() - tic
+
+    estimate = {}
+    if isinstance(top.result, construct_graphs.Estimate):
+        estimate = {"samples": top.result.samples, "stability": top.result.stability, "error": top.result.error}
+    return [{"graph": graph, "metric": metric, "rank": rank, "node": G.nodes[i]["label"],
+             "value": c, "degree": G.degree[i], "time": seconds, **estimate}
+            for rank, (i, c) in enumerate(top, start=1)]
+
+
+def graph_version(graph, path=edge_store.STORE_DIR):
+    """
+    Version of the data a graph is built from (see edge_store.version).
+    """
+    return edge_store.version("nodes" if graph == "spatial" else graph, path)
+
+
+def metric_function(metric, backend="networkx"):
+    """
+    Name of the function that computes a metric with a backend (see run_job).
+    """
+    if metric in TRAVEL_TIME_METRICS:
+        function = TRAVEL_TIME_METRICS[metric]
+    elif backend == "scipy" and metric in SPARSE_METRICS:
+        function = SPARSE_METRICS[metric]
+    else:
+        function = METRICS[metric]
+    return f"{function.__module__}.{function.__qualname__}"
+
+
+def load_cache(path=edge_store.STORE_DIR):
+    """
+    Cached results of jobs, empty if they were computed by another CACHE_VERSION.
+    """
+    try:
+        with open(os.path.join(path, "centrality_cache.json")) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return cache["results"] if cache.get("version") == CACHE_VERSION else {}
+
+
+def save_cache(cache, path=edge_store.STORE_DIR):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "centrality_cache.json"), "w") as f:
+        json.dump({"version": CACHE_VERSION, "results": cache}, f)
+
+
+def run(graphs=GRAPHS, metrics=DEFAULT_METRICS, n=15, n_jobs=None, path=edge_store.STORE_DIR, backend="networkx",
+        cache=True, sampling=None):
+    """
+    Run all graph x metric jobs on a process pool and collect their results in one table.
+    :param graphs: graphs to analyse (see GRAPHS)
+    :param metrics: names of metrics to compute (see METRICS)
+    :param n: number of top nodes kept per job
+    :param n_jobs: number of worker processes, by default one per job up to the number of cores
+    :param path: directory of the edge store
+    :param backend: "networkx" or "scipy" (see SPARSE_METRICS)
+    :param cache: reuse results of jobs whose graph did not change since they were computed by
+        the same function and CACHE_VERSION (results are kept in the edge store, see graph_version)
+    :param sampling: arguments of SAMPLED_METRICS (see construct_graphs.sampled_centrality), eg.
+        {"budget": 128} for at most 128 pivots or {"error": 0.01}, by default the sampling stops
+        once the top n is stable
+    :return: data frame with a row per (graph, metric, rank)
+    """
+    jobs = [(metric, graph) for metric in metrics for graph in graphs]
+    results = load_cache(path) if cache else {}
+    sampled = "|" + json.dumps(sampling or {}, sort_keys=True)
+    key = lambda metric, graph: (f"{graph}|{metric}|{n}|{backend}|{metric_function(metric, backend)}"
+                                 + (sampled if metric in SAMPLED_METRICS else ""))
+    todo = [(metric, graph) for metric, graph in jobs
+            if results.get(key(metric, graph), {}).get("version") != graph_version(graph, path)]
+
+    if todo:
+        shared = {graph for metric, graph in todo if metric in TRAVEL_TIME_METRICS}
+        if "spatial" in shared:
+            raise ValueError(f"Metrics {', '.join(TRAVEL_TIME_METRICS)} are only defined for temporal graphs")
+        # Travel times are computed once with all workers before the jobs, which only read them
+        for graph in sorted(shared):
+            import travel_times
+
+            travel_times.all_sources(graph, n_jobs, path)
+
+        if n_jobs is None:
+            n_jobs = min(len(todo), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(run_job, graph, metric, n, path, backend, sampling): (metric, graph)
+                       for metric, graph in todo}
+            for future in as_completed(futures):
+                metric, graph = futures[future]
+                results[key(metric, graph)] = {"version": graph_version(graph, path), "rows": future.result()}
+        if cache:
+            save_cache(results, path)
+
+    rows = [row for metric, graph in jobs for row in results[key(metric, graph)]["rows"]]
+
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def report(table, graphs=GRAPHS):
+    """
+    Print the results table in the same format as construct_graphs.tops.
+    """
+    for (graph, metric), rows in table.groupby(["graph", "metric"], sort=False):
+        print(f"{metric.capitalize()} centrality for {graphs[graph]}")
+        print("{:>12s} | '{:s}'".format('Centrality', metric))
+        for row in rows.itertuples():
+            print("{:>12.6f} | '{:d}' ({:,d})".format(row.value, row.node, row.degree))
+        first = rows.iloc[0]
+        if pd.notna(first["samples"]):
+            print("{:>12s} | {:,d}".format('Samples', int(first["samples"])))
+            print("{:>12s} | {:.1f}% of top {:,d}".format('Stability', 100 * first["stability"], len(rows)))
+            print("{:>12s} | {:.2e}".format('Error', first["error"]))
+        print("{:>12s} | {:.1f} s".format('Time', first["time"]))
+        print()
@@ -0,0 +1,288 @@
+import heapq
+
+import numpy as np
+from scipy.sparse import csgraph
+
+import construct_graphs
+import edge_store
+
+
+def node_coordinates(ids, geo_loc):
+    """
+    Latitude and longitude arrays indexed by node id (nan for ids without a node),
+    as the node table (see construct_graphs.read_nodes) is not necessarily ordered by id.
+    """
+    ids = np.asarray(ids)
+    lat, lng = np.full(ids.max() + 1, np.nan), np.full(ids.max() + 1, np.nan)
+    lat[ids], lng[ids] = geo_loc[:, 1], geo_loc[:, 0]
+    return lat, lng
+
+
+def max_speed(G, ids, geo_loc, weight="weight"):
+    """
+    Highest speed over all edges of G, haversine distance of the edge divided by its weight.
+    Distance divided by this speed never overestimates the travel time between two nodes.
+    An edge between different locations with zero travel time makes the speed infinite,
+    then the bounds are zero and A* is plain dijkstra, but still exact.
+    :param G: graph with node ids as nodes
+    :param ids: node ids of the rows of geo_loc (see construct_graphs.read_nodes)
+    :param geo_loc: array of [longitude, latitude] of every node
+    :param weight: edge attribute with the travel time
+    :return: speed in kilometers per unit of weight
+    """
+    edges = np.array([(i, j, w) for i, j, w in G.edges(data=weight) if i != j], dtype=np.float64).reshape(-1, 3)
+    src, dst, w = edges[:, 0].astype(int), edges[:, 1].astype(int), edges[:, 2]
+    lat, lng = node_coordinates(ids, geo_loc)
+    distance = construct_graphs.haversine(lat[src], lng[src], lat[dst], lng[dst])
+    moved = distance > 0
+    if (w[moved] <= 0).any():
+        return np.inf
+    return (distance[moved] / w[moved]).max(initial=0)
+
+
+def haversine_bounds(ids, geo_loc, speed):
+    """
+    Lower bounds for A* from haversine distances between centroids and the maximum speed.
+    :param ids: node ids of the rows of geo_loc (see construct_graphs.read_nodes)
+    :param geo_loc: array of [longitude, latitude] of every node
+    :param speed: speed that is never exceeded (see max_speed)
+    :return: function (s, t) returning arrays (indexed by node id) of lower bounds of travel times
+        from every node to t and from s to every node, as expected by bidirectional_search
+    """
+    lat, lng = node_coordinates(ids, geo_loc)
+
+    def bounds(s, t):
+        # Distances are symmetric, so the same bound works in both directions
+        return (np.nan_to_num(construct_graphs.haversine(lat, lng, lat[t], lng[t]) / speed),
+                np.nan_to_num(construct_graphs.haversine(lat[s], lng[s], lat, lng) / speed))
+
+    return bounds
+
+
+def bidirectional_search(G, s, t, weight="weight", bounds=None):
+    """
+    Exact shortest path from s to t, searched from both ends at the same time.
+    Without bounds this is bidirectional dijkstra, with bounds it is bidirectional A*
+    with the average of both potentials, which keeps it exact as long as the bounds
+    are consistent (haversine_bounds and landmark bounds are).
+    :param G: networkx graph or digraph, with nodes indexing the arrays of bounds
+    :param s: source node
+    :param t: target node
+    :param weight: edge attribute with the travel time
+    :param bounds: function (s, t) returning arrays of lower bounds of the distance
+        from every node to t and from s to every node
+    :return: a tuple of
+        - travel_time: length of the shortest path, None if there is no path
+        - path: list of nodes on the shortest path, None if there is no path
+    """
+    if s == t:
+        return 0, [s]
+
+    if bounds is None:
+        potential = lambda v: 0
+    else:
+        # Lists are faster than numpy arrays for indexing single nodes
+        to_t, from_s = (np.asarray(b).tolist() for b in bounds(s, t))
+        potential = lambda v: (to_t[v] - from_s[v]) / 2
+
+    # Index 0 is the forward search from s, index 1 the backward search from t.
+    # Keys in heaps are distances shifted by the potential, +potential forward and -potential backward.
+    adj = (G.succ, G.pred) if G.is_directed() else (G.adj, G.adj)
+    sign = (1, -1)
+    dist = ({s: 0}, {t: 0})
+    parent = ({s: None}, {t: None})
+    settled = (set(), set())
+    heaps = ([(potential(s), s)], [(-potential(t), t)])
+
+    best, meet = float("inf"), None
+    while heaps[0] and heaps[1]:
+        # Nothing shorter than the best path can be found any more
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        _, u = heapq.heappop(heaps[side])
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+
+        d, other = dist[side], dist[1 - side]
+        for v, data in adj[side][u].items():
+            nd = d[u] + data[weight]
+            if nd < d.get(v, float("inf")):
+                d[v] = nd
+                parent[side][v] = u
+                heapq.heappush(heaps[side], (nd + sign[side] * potential(v), v))
+            if v in other and d[v] + other[v] < best:
+                best, meet = d[v] + other[v], v
+
+    if meet is None:
+        return None, None
+
+    path = [meet]
+    while parent[0][path[-1]] is not None:
+        path.append(parent[0][path[-1]])
+    path.reverse()
+    while parent[1][path[-1]] is not None:
+        path.append(parent[1][path[-1]])
+    return best, path
+
+
+def select_landmarks(A, k=16, seed=None):
+    """
+    Choose k landmarks far from each other: each next landmark is the node
+    farthest from the landmarks chosen so far (ignoring directions of edges).
+    :param A: CSR matrix of the graph
+    :param k: number of landmarks
+    :param seed: seed for the random first landmark
+    :return: array of landmark nodes
+    """
+    landmarks = [int(np.random.default_rng(seed).integers(A.shape[0]))]
+    closest = np.full(A.shape[0], np.inf)
+    while len(landmarks) < k:
+        D = csgraph.dijkstra(A, directed=False, indices=landmarks[-1])
+        closest = np.minimum(closest, np.where(np.isfinite(D), D, -1))
+        closest[landmarks] = -1
+        landmarks.append(int(closest.argmax()))
+    return np.array(landmarks)
+
+
+def build_landmarks(time_interval, k=16, seed=None, path=edge_store.STORE_DIR):
+    """
+    Preprocess the temporal graph for ALT (A* with landmarks and the triangle inequality):
+    choose landmarks and save distances from and to every landmark into the edge store.
+    :param time_interval: slot in the day (see construct_graphs.temporal_graph)
+    :param k: number of landmarks
+    :param seed: seed for the choice of landmarks
+    :param path: directory of the edge store
+    """
+    A = construct_graphs.temporal_csr(time_interval, path)
+    save_landmarks(time_interval, A, select_landmarks(A, k, seed), path)
+
+
+def save_landmarks(time_interval, A, landmarks, path=edge_store.STORE_DIR):
+    """
+    Save landmarks with their distances in the graph A of a time interval and the version
+    of the edges they were computed from (see has_landmarks).
+    """
+    edge_store.save_array(f"landmarks_{time_interval}", np.asarray(landmarks), path)
+    edge_store.save_array(f"landmarks_from_{time_interval}", csgraph.dijkstra(A, indices=landmarks), path)
+    edge_store.save_array(f"landmarks_to_{time_interval}", csgraph.dijkstra(A.T.tocsr(), indices=landmarks), path)
+    edge_store.save_array(f"landmarks_version_{time_interval}",
+                          np.array([edge_store.version(time_interval, path)]), path)
+
+
+def has_landmarks(time_interval, path=edge_store.STORE_DIR):
+    """
+    Whether landmarks of the time interval were built from its current edges, bounds of
+    landmarks of older edges can overestimate distances, so they must not be used.
+    """
+    return (edge_store.has_array(f"landmarks_version_{time_interval}", path) and
+            int(edge_store.load_array(f"landmarks_version_{time_interval}", path)[0])
+            == edge_store.version(time_interval, path))
+
+
+class Landmarks:
+    """
+    Landmark distances of one temporal graph (see build_landmarks) giving lower bounds for A*.
+    The graph is expected to be strongly connected, bounds through unreachable landmarks are dropped.
+    """
+
+    def __init__(self, time_interval, path=edge_store.STORE_DIR):
+        self.time_interval = time_interval
+        self.landmarks = np.array(edge_store.load_array(f"landmarks_{time_interval}", path))
+        # Distances from landmarks to nodes and from nodes to landmarks, one row per landmark
+        self.dist_from = np.array(edge_store.load_array(f"landmarks_from_{time_interval}", path))
+        self.dist_to = np.array(edge_store.load_array(f"landmarks_to_{time_interval}", path))
+
+    def bounds(self, s, t):
+        """
+        Lower bounds of distances from every node to t and from s to every node,
+        in the format expected by bidirectional_search.
+        """
+        with np.errstate(invalid="ignore"):
+            # d(v, t) >= d(L, t) - d(L, v) and d(v, t) >= d(v, L) - d(t, L)
+            to_t = np.maximum(self.dist_from[:, [t]] - self.dist_from, self.dist_to - self.dist_to[:, [t]])
+            # d(s, v) >= d(L, v) - d(L, s) and d(s, v) >= d(s, L) - d(v, L)
+            from_s = np.maximum(self.dist_from - self.dist_from[:, [s]], self.dist_to[:, [s]] - self.dist_to)
+        return (np.nan_to_num(to_t, nan=0, posinf=0, neginf=0).max(axis=0).clip(0),
+                np.nan_to_num(from_s, nan=0, posinf=0, neginf=0).max(axis=0).clip(0))
+
+    def route(self, G, s, t, weight="weight"):
+        """
+        Shortest path from s to t in G (the temporal graph the landmarks were built for).
+        :return: a tuple of travel time and path (see bidirectional_search)
+        """
+        return bidirectional_search(G, s, t, weight=weight, bounds=self.bounds)
+
+
+# Landmarks loaded in this process by (time interval, path), with the version of the edges
+_landmarks = {}
+
+
+def load_landmarks(time_interval, path=edge_store.STORE_DIR):
+    """
+    Landmarks of a time interval, loaded once per process and again when the edges changed.
+    :return: Landmarks, None if there are no landmarks of the current edges (see has_landmarks)
+    """
+    if not has_landmarks(time_interval, path):
+        return None
+    version = edge_store.version(time_interval, path)
+    if _landmarks.get((time_interval, path), (None, None))[0] != version:
+        _landmarks[time_interval, path] = (version, Landmarks(time_interval, path))
+    return _landmarks[time_interval, path][1]
+
+
+def time_dependent_search(G, s, t, departure):
+    """
+    Earliest arrival from s when leaving at departure. The time advances along the path and
+    every edge takes the travel time of the time slice in which it is entered, so a trip
+    starting before the rush hour gets slower once the rush hour begins.
+    The search is dijkstra ordered by arrival times, which is exact when leaving an edge
+    later never arrives earlier (FIFO). With mean travel times per slice this can be violated
+    only at the boundaries of slices, then the result is the fastest path without waiting.
+    :param G: csr_graph.TimeDependentGraph
+    :param s: source node id
+    :param t: target node id, None for travel times to all nodes
+    :param departure: time of departure in seconds after midnight
+    :return: a tuple of
+        - travel_time: travel time in seconds, None if there is no path
+        - path: list of nodes on the path, None if there is no path
+        or without t an array of travel times to every node (indexed by node index), inf if unreachable
+    """
+    n = G.number_of_nodes()
+    source, target = int(G.index(s)), None if t is None else int(G.index(t))
+    arrival = np.full(n, np.inf)
+    parent = np.full(n, -1, dtype=np.int64)
+    done = np.zeros(n, dtype=bool)
+    arrival[source] = departure
+    heap = [(float(departure), source)]
+
+    while heap:
+        time, u = heapq.heappop(heap)
+        if done[u]:
+            continue
+        done[u] = True
+        if u == target:
+            break
+
+        # Relax all edges of u at once with travel times of the slice u is left in
+        start, end = G.indptr[u], G.indptr[u + 1]
+        v = G.indices[start:end]
+        times = time + G.slice_weights[G.slice_of(time), start:end]
+        better = times < arrival[v]
+        v, times = v[better], times[better]
+        arrival[v], parent[v] = times, u
+        for j, a in zip(v.tolist(), times.tolist()):
+            heapq.heappush(heap, (a, j))
+
+    if target is None:
+        return arrival - departure
+    if not np.isfinite(arrival[target]):
+        return None, None
+
+    path = [target]
+    while path[-1] != source:
+        path.append(int(parent[path[-1]]))
+    path.reverse()
+    return float(arrival[target] - departure), G.ids[path].tolist()
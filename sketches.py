@@ -0,0 +1,264 @@
+"""
+Compact summaries (sketches) of the travel times of every edge in every time interval.
+A sketch keeps the number of observations, the mean and the sum of squared deviations
+(for the variance) and a histogram over fixed, logarithmically spaced bins of travel times
+(for percentiles such as p50 and p90). Every row of the uber csv is the distribution of
+travel times of many trips, which is added to the histogram as a lognormal distribution
+with the geometric mean and standard deviation of the row.
+
+Sketches are arrays with a row per edge, two sketches of the same edges (eg. of two monthly
+exports) are merged exactly without the raw data (see merge and merge_stores), and
+temporal graphs can be weighted by any of their statistics (see edges and STATISTICS).
+"""
+import re
+import logging
+
+import numpy as np
+
+import edge_store
+from instrument import span
+
+logger = logging.getLogger(__name__)
+
+# Edges of the histogram bins in seconds: 63 log-spaced edges from 30 s to 4 h (about 10% apart)
+# and bins below and above them, so every travel time falls into a bin
+EDGES = np.concatenate([[0], np.geomspace(30, 4 * 3600, 63), [np.inf]])
+BINS = len(EDGES) - 1
+with np.errstate(divide="ignore"):
+    LOG_EDGES = np.log(EDGES)
+# Smallest spread of a lognormal distribution, rows without a spread are (almost) single values
+MIN_SIGMA = 1e-3
+# Statistics edges can be weighted by, any other percentile is given as "p" and the percentile, eg. "p75"
+STATISTICS = ("mean", "std", "p50", "p90", "count")
+
+
+def empty():
+    return {"key": np.empty(0, dtype=np.int64), "count": np.empty(0, dtype=np.int64),
+            "mean": np.empty(0), "m2": np.empty(0), "hist": np.empty((0, BINS), dtype=np.float32)}
+
+
+def lognormal(mean, std, geometric_mean, geometric_std):
+    """
+    Parameters (mu and sigma of the log of travel times) of the lognormal distribution of every row,
+    from the geometric mean and standard deviation or, where they are missing, from the mean and
+    standard deviation (with the same mean and variance).
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = np.nan_to_num(std)
+        sigma2 = np.log1p((std / mean) ** 2)
+        mu = np.log(mean) - sigma2 / 2
+        sigma = np.sqrt(sigma2)
+        geometric = (geometric_mean > 0) & (geometric_std >= 1)
+        mu = np.where(geometric, np.log(geometric_mean), mu)
+        sigma = np.where(geometric, np.log(geometric_std), sigma)
+    return mu, np.maximum(np.nan_to_num(sigma), MIN_SIGMA)
+
+
+def from_observations(key, mean, std=None, geometric_mean=None, geometric_std=None, batch=65536):
+    """
+    Sketches of observations, eg. of one chunk of the csv file.
+    :param key: edge of every observation as an integer key (any encoding, see main.aggregate_travel_times)
+    :param mean: mean travel time of every observation
+    :param std: standard deviation of travel times of every observation, zero if not given
+    :param geometric_mean: geometric mean of travel times of every observation
+    :param geometric_std: geometric standard deviation of travel times of every observation
+    :param batch: number of observations whose histograms are computed at once
+    :return: sketch, a dict of arrays with a row per distinct key sorted by key:
+        - key: key of the edge
+        - count: number of observations
+        - mean: mean of the means of observations
+        - m2: sum of squared deviations of travel times from the mean, over the trips
+            of all observations (every observation weighted equally)
+        - hist: histogram of travel times of shape (edges, BINS), every observation adds a mass of 1
+    """
+    from scipy.special import ndtr
+
+    mean = np.asarray(mean, dtype=np.float64)
+    std = np.zeros_like(mean) if std is None else np.asarray(std, dtype=np.float64)
+    geometric_mean = np.full_like(mean, np.nan) if geometric_mean is None else np.asarray(geometric_mean)
+    geometric_std = np.full_like(mean, np.nan) if geometric_std is None else np.asarray(geometric_std)
+
+    order = np.argsort(key, kind="stable")
+    key, mean, std = np.asarray(key)[order], mean[order], np.nan_to_num(std[order])
+    keys, count = np.unique(key, return_counts=True)
+    edge = np.repeat(np.arange(len(keys)), count)
+
+    average = np.bincount(edge, weights=mean) / count
+    # Variance of the mixture of observations: their variances plus the variance of their means
+    m2 = np.bincount(edge, weights=std ** 2 + (mean - average[edge]) ** 2)
+
+    mu, sigma = lognormal(mean, std, geometric_mean[order], geometric_std[order])
+    hist = np.zeros((len(keys), BINS), dtype=np.float32)
+    for first in range(0, len(key), batch):
+        rows = slice(first, first + batch)
+        mass = np.diff(ndtr((LOG_EDGES - mu[rows, None]) / sigma[rows, None]), axis=1)
+        # Observations are sorted by edge, so the edges of a batch are consecutive runs of rows
+        edges, runs = np.unique(edge[rows], return_index=True)
+        hist[edges] += np.add.reduceat(mass, runs, axis=0).astype(np.float32)
+
+    return {"key": keys, "count": count.astype(np.int64), "mean": average, "m2": m2, "hist": hist}
+
+
+def merge(a, b):
+    """
+    Merge two sketches into the sketch of all their observations, as if they were computed at once.
+    Means and sums of squared deviations are combined exactly (Chan et al.), histograms are added.
+    """
+    keys = np.union1d(a["key"], b["key"])
+    i, j = np.searchsorted(keys, a["key"]), np.searchsorted(keys, b["key"])
+
+    count = np.zeros(len(keys), dtype=np.int64)
+    count[i] += a["count"]
+    count[j] += b["count"]
+    mean_a, mean_b = np.zeros(len(keys)), np.zeros(len(keys))
+    count_a, count_b = np.zeros(len(keys)), np.zeros(len(keys))
+    mean_a[i], count_a[i] = a["mean"], a["count"]
+    mean_b[j], count_b[j] = b["mean"], b["count"]
+
+    delta = mean_b - mean_a
+    m2 = np.zeros(len(keys))
+    m2[i] += a["m2"]
+    m2[j] += b["m2"]
+    m2 += delta ** 2 * count_a * count_b / count
+    hist = np.zeros((len(keys), BINS), dtype=np.float32)
+    hist[i] += a["hist"]
+    hist[j] += b["hist"]
+    return {"key": keys, "count": count, "mean": mean_a + delta * count_b / count, "m2": m2, "hist": hist}
+
+
+class PairwiseMerge:
+    """
+    Merge a stream of parts (eg. sketches of the chunks of a csv file) like a binary counter:
+    a part is only merged with a part of as many chunks, so every edge is copied about log2(chunks)
+    times instead of once per chunk into an ever growing result. At most log2(chunks) parts are kept.
+
+        merger = PairwiseMerge(merge)
+        for chunk in chunks:
+            merger.add(from_observations(...))
+        sketch = merger.result(empty())
+    """
+
+    def __init__(self, merge):
+        """
+        :param merge: function merging two parts, the older one first
+        """
+        self.merge = merge
+        self.parts = []  # (chunks, part), the largest and oldest first
+
+    def add(self, part):
+        chunks = 1
+        while self.parts and self.parts[-1][0] == chunks:
+            part = self.merge(self.parts.pop()[1], part)
+            chunks *= 2
+        self.parts.append((chunks, part))
+
+    def result(self, empty):
+        """
+        Merge of all parts, empty if there were none.
+        """
+        part = empty
+        while self.parts:
+            part = self.merge(self.parts.pop()[1], part)
+        return part
+
+
+def percentile(hist, q):
+    """
+    Percentile of travel times of every edge from its histogram, interpolated
+    on the log scale within a bin. Values in the open bins are clamped to their finite edge.
+    :param hist: histograms of shape (edges, BINS)
+    :param q: percentile between 0 and 100
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    cumulative = np.cumsum(hist, axis=1)
+    target = q / 100 * cumulative[:, -1]
+    b = np.minimum((cumulative < target[:, None]).sum(axis=1), BINS - 1)
+    rows = np.arange(len(hist))
+    before = cumulative[rows, b] - hist[rows, b]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.clip(np.nan_to_num((target - before) / hist[rows, b]), 0, 1)
+    lo, hi = LOG_EDGES[b], LOG_EDGES[b + 1]
+    value = np.exp(np.where(np.isfinite(lo) & np.isfinite(hi), lo + fraction * (hi - lo), np.where(np.isfinite(lo), lo, hi)))
+    return np.where(cumulative[:, -1] > 0, value, np.nan)
+
+
+def statistic(sketch, name):
+    """
+    A statistic of every edge of a sketch.
+    :param name: one of STATISTICS or a percentile as "p" and a number (eg. "p95")
+    """
+    if name == "mean":
+        return np.asarray(sketch["mean"])
+    if name == "count":
+        return np.asarray(sketch["count"], dtype=np.float64)
+    if name == "std":
+        return np.sqrt(np.asarray(sketch["m2"]) / np.asarray(sketch["count"]))
+    match = re.fullmatch(r"p(\d+(\.\d+)?)", name)
+    if match is None:
+        raise ValueError(f"Unknown statistic {name}, expected one of {', '.join(STATISTICS)} or a percentile like p95")
+    return percentile(sketch["hist"], float(match.group(1)))
+
+
+def edges(time_interval, name="mean", path=edge_store.STORE_DIR):
+    """
+    Edges of the temporal graph of a time interval weighted by a statistic of their sketches,
+    eg. p90 travel times for risk-aware routing (see construct_graphs.temporal_edges).
+    Sketches come from the csv files only, observations of updates.apply_updates change just the means.
+    :return: a tuple of src, dst and weight arrays
+    """
+    if not edge_store.has_sketch(time_interval, path):
+        raise FileNotFoundError(f"No sketches of interval {time_interval} in {path}, run main.read_from_csv first")
+    sketch = edge_store.load_sketch(time_interval, path)
+    return sketch["src"], sketch["dst"], statistic(sketch, name).astype(np.float32)
+
+
+def save(sketch, n_nodes, path=edge_store.STORE_DIR):
+    """
+    Save a sketch with keys (interval * n_nodes + src) * n_nodes + dst as sketches of every interval.
+    """
+    interval, pair = np.divmod(sketch["key"], n_nodes * n_nodes)
+    for i in np.unique(interval).tolist():
+        rows = interval == i
+        edge_store.save_sketch(i, pair[rows] // n_nodes, pair[rows] % n_nodes, sketch["count"][rows],
+                               sketch["mean"][rows], sketch["m2"][rows], sketch["hist"][rows], path)
+
+
+def merge_stores(paths, path=edge_store.STORE_DIR, intervals=range(4)):
+    """
+    Combine the sketches of several edge stores (eg. one per monthly export) into one store, as if
+    all exports were read at once, without reading the csv files again. The edges of the temporal
+    graphs of the merged store are weighted by the merged means and the node table is taken from
+    the first store if it has none. Time slices of time-dependent routing are not merged.
+    :param paths: directories of the edge stores to merge
+    :param path: directory of the merged store, it may be one of paths
+    :param intervals: time intervals to merge, stores without sketches of an interval are skipped
+        with a warning and intervals no store has sketches of are not merged
+    :return: dict with the number of edges of every merged interval
+    """
+    if not edge_store.has_nodes(path):
+        edge_store.save_nodes(*edge_store.load_nodes(paths[0]), path)
+
+    summary = {}
+    for i in intervals:
+        stores = [store for store in paths if edge_store.has_sketch(i, store)]
+        for store in paths:
+            if store not in stores:
+                logger.warning("No sketches of interval %s in %s, it is merged without this store", i, store)
+        if not stores:
+            continue
+
+        with span("merge.sketches", interval=i, stores=len(stores)) as s:
+            merged = empty()
+            for store in stores:
+                sketch = edge_store.load_sketch(i, store)
+                # Node ids are below 2 ** 31, so a pair fits into one key
+                key = (np.asarray(sketch["src"], dtype=np.int64) << 32) + sketch["dst"]
+                merged = merge(merged, {"key": key, **{c: np.asarray(sketch[c]) for c in ("count", "mean", "m2", "hist")}})
+            s.set(edges=len(merged["key"]))
+
+        src, dst = merged["key"] >> 32, merged["key"] & 0xFFFFFFFF
+        edge_store.save_sketch(i, src, dst, merged["count"], merged["mean"], merged["m2"], merged["hist"], path)
+        edge_store.save_edges(i, src, dst, merged["mean"], merged["count"], path=path)
+        summary[i] = len(src)
+        logger.info("Merged %d edges in interval: %s", len(src), i)
+    return summary
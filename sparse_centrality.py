@@ -0,0 +1,145 @@
+"""
+Centralities and graph statistics computed on a weighted CSR adjacency matrix
+instead of networkx dicts. Functions ending with _csr work on a matrix and return
+an array indexed like its rows, the others take a networkx graph, convert it
+once (the matrix is cached in G.graph) and return a dict, so they can be
+passed to construct_graphs.tops in place of the networkx functions.
+"""
+import numpy as np
+import networkx as nx
+from scipy import sparse
+from scipy.sparse import csgraph
+
+import construct_graphs
+
+
+def to_csr(G, weight="weight"):
+    """
+    Weighted adjacency matrix of G, cached in G.graph until nodes, edges or weights of G change
+    (see construct_graphs.graph_version). Self-loops are kept (on the diagonal),
+    they change PageRank as in nx.pagerank and don't change distances.
+    :param G: networkx graph
+    :param weight: edge attribute with the weight
+    :return: a tuple of
+        - A: CSR matrix where A[a, b] is the weight of the edge from a to b
+        - nodes: list of nodes in the order of rows of A
+    """
+    state = (weight, G.number_of_nodes(), G.number_of_edges(), construct_graphs.graph_version(G))
+    if G.graph.get("csr_state") != state or "csr" not in G.graph:
+        nodes = list(G)
+        to_matrix = getattr(nx, "to_scipy_sparse_array", None) or nx.to_scipy_sparse_matrix
+        A = sparse.csr_matrix(to_matrix(G, nodelist=nodes, weight=weight, format="csr"))
+        A.eliminate_zeros()
+        G.graph["csr"], G.graph["csr_nodes"], G.graph["csr_state"] = A, nodes, state
+    return G.graph["csr"], G.graph["csr_nodes"]
+
+
+def pagerank_csr(A, alpha=0.85, max_iter=100, tol=1.0e-6):
+    """
+    PageRank (as nx.pagerank) by power iteration with the weighted transition matrix.
+    Nodes without outgoing edges jump to a random node.
+    """
+    n = A.shape[0]
+    out = np.asarray(A.sum(axis=1)).ravel()
+    dangling = out == 0
+    P = sparse.diags(np.divide(1.0, out, out=np.zeros(n), where=~dangling)) @ A
+    PT = P.T.tocsr()
+
+    x = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        x_last = x
+        x = alpha * (PT @ x + x[dangling].sum() / n) + (1 - alpha) / n
+        if np.abs(x - x_last).sum() < n * tol:
+            return x
+    raise nx.PowerIterationFailedConvergence(max_iter)
+
+
+def _closeness(D, n):
+    """
+    Closeness of nodes from rows of distances to them (inf where unreachable).
+    """
+    reachable = np.isfinite(D)
+    r = reachable.sum(axis=1)
+    total = np.where(reachable, D, 0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        c = (r - 1) ** 2 / (total * (n - 1))
+    return np.where(total > 0, c, 0.0)
+
+
+def closeness_csr(A, weighted=False, batch=64):
+    """
+    Closeness (as nx.closeness_centrality) from incoming distances, computed
+    with csgraph.dijkstra on batches of nodes at once.
+    :param weighted: use edge weights as distances, otherwise count edges
+    :param batch: number of nodes per dijkstra call (memory is batch * number of nodes)
+    """
+    n = A.shape[0]
+    # Rows of distances on the transposed graph are distances to a node
+    AT = A.T.tocsr()
+    closeness = np.zeros(n)
+    for start in range(0, n, batch):
+        rows = np.arange(start, min(start + batch, n))
+        D = csgraph.dijkstra(AT, directed=True, indices=rows, unweighted=not weighted)
+        closeness[rows] = _closeness(D, n)
+    return closeness
+
+
+def closeness_from_distances(D, batch=64):
+    """
+    Weighted closeness from a matrix of distances between all pairs of nodes
+    (eg. precomputed travel times, see travel_times.all_sources), without any dijkstra.
+    Columns are the incoming distances, they are read in batches, so D can be memory-mapped.
+    """
+    n = D.shape[0]
+    closeness = np.zeros(n)
+    for start in range(0, n, batch):
+        rows = slice(start, min(start + batch, n))
+        closeness[rows] = _closeness(np.asarray(D[:, rows], dtype=np.float64).T, n)
+    return closeness
+
+
+def components_csr(A, directed=True):
+    """
+    Weakly connected components.
+    :return: a tuple of the number of components and the component label of every node
+    """
+    return csgraph.connected_components(A, directed=directed, connection="weak")
+
+
+def distance_csr(A, i):
+    """
+    Number of edges on the shortest paths from node i to every node (-1 if unreachable).
+    """
+    D = csgraph.shortest_path(A, directed=True, unweighted=True, indices=i)
+    return np.where(np.isfinite(D), D, -1).astype(np.int64)
+
+
+def pagerank(G, alpha=0.85, weight="weight"):
+    A, nodes = to_csr(G, weight)
+    return dict(zip(nodes, pagerank_csr(A, alpha=alpha).tolist()))
+
+
+def closeness(G, distance=None):
+    A, nodes = to_csr(G, distance or "weight")
+    return dict(zip(nodes, closeness_csr(A, weighted=distance is not None).tolist()))
+
+
+def components(G):
+    """
+    Weakly connected components as lists of nodes (see construct_graphs.components).
+    """
+    A, nodes = to_csr(G)
+    _, labels = components_csr(A, directed=G.is_directed())
+    C = [[] for _ in range(labels.max() + 1)]
+    for i, label in zip(nodes, labels.tolist()):
+        C[label].append(i)
+    return C
+
+
+def distance(G, i):
+    """
+    Distances of reachable nodes from node i, the same as construct_graphs.distance.
+    """
+    A, nodes = to_csr(G)
+    D = distance_csr(A, nodes.index(i))
+    return D[D > 0].tolist()
@@ -0,0 +1,24 @@
+import functools
+
+import networkx as nx
+
+import construct_graphs
+
+
+def test_top_k_caches_every_centrality_separately():
+    G = nx.karate_club_graph()
+    degree = construct_graphs.top_k(G, lambda G: nx.degree_centrality(G), 5, "degree")
+    pagerank = construct_graphs.top_k(G, lambda G: nx.pagerank(G), 5, "pagerank")
+
+    assert [i for i, _ in degree] == [i for i, _ in construct_graphs.top_k(G, nx.degree_centrality, 5)]
+    assert pagerank == sorted(nx.pagerank(G).items(), key=lambda item: -item[1])[:5]
+    assert pagerank.label == "pagerank"
+
+
+def test_top_k_of_partial():
+    G = nx.karate_club_graph()
+    closeness = functools.partial(nx.closeness_centrality, distance="weight")
+    T = construct_graphs.top_k(G, closeness, 3)
+
+    assert T.label == "closeness_centrality"
+    assert T == sorted(closeness(G).items(), key=lambda item: -item[1])[:3]
@@ -0,0 +1,109 @@
+import logging
+
+import numpy as np
+import pytest
+from scipy.optimize import brentq
+from scipy.special import ndtr
+
+import edge_store
+import sketches
+
+N_NODES = 6
+
+
+def observations(rows, seed):
+    """
+    Random rows of an uber export: edge keys of two intervals and lognormal travel times.
+    """
+    rng = np.random.default_rng(seed)
+    key = rng.integers(2 * N_NODES * N_NODES, size=rows)
+    geometric_mean = rng.lognormal(np.log(600), 0.5, rows)
+    geometric_std = np.exp(rng.uniform(0.1, 0.6, rows))
+    mean = geometric_mean * np.exp(np.log(geometric_std) ** 2 / 2)
+    std = mean * np.sqrt(np.expm1(np.log(geometric_std) ** 2))
+    return key, mean, std, geometric_mean, geometric_std
+
+
+def assert_same(a, b):
+    np.testing.assert_array_equal(a["key"], b["key"])
+    np.testing.assert_array_equal(a["count"], b["count"])
+    np.testing.assert_allclose(a["mean"], b["mean"], rtol=1e-12)
+    np.testing.assert_allclose(a["m2"], b["m2"], rtol=1e-9)
+    np.testing.assert_allclose(a["hist"], b["hist"], rtol=1e-5, atol=1e-5)
+
+
+def test_merge_equals_ingesting_both():
+    key, *columns = observations(2000, seed=1)
+    first, second = slice(0, 700), slice(700, None)
+
+    merged = sketches.merge(sketches.from_observations(key[first], *(c[first] for c in columns)),
+                            sketches.from_observations(key[second], *(c[second] for c in columns)))
+    assert_same(merged, sketches.from_observations(key, *columns))
+
+
+def test_pairwise_merge_of_chunks_equals_ingesting_all():
+    key, *columns = observations(2000, seed=5)
+    merger = sketches.PairwiseMerge(sketches.merge)
+    for rows in np.array_split(np.arange(2000), 7):
+        merger.add(sketches.from_observations(key[rows], *(c[rows] for c in columns)))
+
+    assert len(merger.parts) == 3
+    assert_same(merger.result(sketches.empty()), sketches.from_observations(key, *columns))
+
+
+def test_merge_stores_equals_ingesting_both(tmp_path):
+    key, *columns = observations(2000, seed=2)
+    stores = [str(tmp_path / name) for name in ("january", "february", "merged", "both")]
+    ids, geo_loc = np.arange(N_NODES), np.zeros((N_NODES, 2))
+    for store, rows in zip(stores, (slice(0, 1200), slice(1200, None), None, slice(None))):
+        edge_store.save_nodes(ids, geo_loc, store)
+        if rows is not None:
+            sketches.save(sketches.from_observations(key[rows], *(c[rows] for c in columns)), N_NODES, store)
+
+    summary = sketches.merge_stores(stores[:2], stores[2], intervals=range(2))
+    for i in range(2):
+        merged, both = edge_store.load_sketch(i, stores[2]), edge_store.load_sketch(i, stores[3])
+        assert summary[i] == len(both["src"])
+        for column in ("src", "dst", "count"):
+            np.testing.assert_array_equal(merged[column], both[column])
+        for column in ("mean", "m2", "hist"):
+            np.testing.assert_allclose(merged[column], both[column], rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(edge_store.load_edges(i, stores[2])[2], both["mean"], rtol=1e-6)
+
+
+def test_merge_stores_skips_missing_sketches(tmp_path, caplog):
+    key, *columns = observations(500, seed=3)
+    complete, partial, merged = (str(tmp_path / name) for name in ("complete", "partial", "merged"))
+    sketch = sketches.from_observations(key, *columns)
+    sketches.save(sketch, N_NODES, complete)
+    interval_0 = sketch["key"] < N_NODES * N_NODES
+    sketches.save({name: values[interval_0] for name, values in sketch.items()}, N_NODES, partial)
+    edge_store.save_nodes(np.arange(N_NODES), np.zeros((N_NODES, 2)), complete)
+
+    with caplog.at_level(logging.WARNING, logger="sketches"):
+        summary = sketches.merge_stores([complete, partial], merged, intervals=range(3))
+
+    assert sorted(summary) == [0, 1]
+    assert partial in caplog.text and "interval 1" in caplog.text
+    np.testing.assert_array_equal(edge_store.load_sketch(1, merged)["count"],
+                                  edge_store.load_sketch(1, complete)["count"])
+
+
+@pytest.mark.parametrize("q, mean_error, max_error", [(50, 0.001, 0.005), (90, 0.006, 0.01)])
+def test_percentiles_of_lognormal_mixtures(q, mean_error, max_error):
+    rng = np.random.default_rng(4)
+    errors = []
+    for _ in range(100):
+        rows = rng.integers(5, 200)
+        geometric_mean = rng.lognormal(np.log(600), 0.5, rows)
+        geometric_std = np.exp(rng.uniform(0.1, 0.6, rows))
+        sketch = sketches.from_observations(np.zeros(rows, dtype=np.int64), geometric_mean,
+                                            geometric_mean=geometric_mean, geometric_std=geometric_std)
+
+        # Exact quantile of the mixture of the lognormal distributions of the rows
+        cdf = lambda x: ndtr((np.log(x) - np.log(geometric_mean)) / np.log(geometric_std)).mean() - q / 100
+        exact = brentq(cdf, 1, 1e6)
+        errors.append(abs(sketches.statistic(sketch, f"p{q}")[0] / exact - 1))
+
+    assert np.mean(errors) < mean_error
+    assert np.max(errors) < max_error
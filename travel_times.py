@@ -0,0 +1,229 @@
+import os
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import edge_store
+import instrument
+from instrument import span
+
+logger = logging.getLogger(__name__)
+
+# Value of a predecessor when there is none (source node or unreachable node)
+NO_PREDECESSOR = -9999
+
+
+def shortest_paths(A, sources):
+    """
+    Travel times and predecessors of shortest paths from the given sources.
+    """
+    # scipy and networkx (through construct_graphs) are only imported to compute travel times,
+    # looking up precomputed ones (eg. in cli.py route) needs just numpy
+    from scipy.sparse import csgraph
+
+    D, P = csgraph.dijkstra(A, directed=True, indices=sources, return_predecessors=True)
+    return D.astype(np.float32), P.astype(np.int32)
+
+
+def shortest_path(predecessors, n1, n2):
+    """
+    Shortest path from n1 to n2 as a list of nodes, None if there is no path.
+    :param predecessors: row of n1 in a predecessor matrix (see shortest_paths)
+    """
+    path = [n2]
+    while path[-1] != n1:
+        prev = int(predecessors[path[-1]])
+        if prev == NO_PREDECESSOR:
+            return None
+        path.append(prev)
+    path.reverse()
+    return path
+
+
+# Temporal graph and output files of the current worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(A, time_interval, path):
+    _worker["A"], _worker["interval"], _worker["path"] = A, time_interval, path
+
+
+def _fill(sources, batch=64):
+    """
+    Run dijkstra from the sources of a worker and write the rows straight into the
+    memory-mapped output files, so nothing but the number of rows goes back to the parent.
+    """
+    i, path = _worker["interval"], _worker["path"]
+    D = edge_store.load_array(f"travel_times_{i}.tmp", path, mmap_mode="r+")
+    P = edge_store.load_array(f"predecessors_{i}.tmp", path, mmap_mode="r+")
+    for start in range(0, len(sources), batch):
+        rows = sources[start:start + batch]
+        D[rows], P[rows] = shortest_paths(_worker["A"], rows)
+    D.flush()
+    P.flush()
+    return len(sources)
+
+
+def precompute(time_interval, n_jobs=None, path=edge_store.STORE_DIR):
+    """
+    Compute travel times between all pairs of nodes of the temporal graph
+    with a dijkstra from every source, split between worker processes.
+    Workers write their rows directly into memory-mapped travel time and predecessor
+    matrices in the edge store, which every later consumer maps without copying (see all_sources).
+    :param time_interval: slot in the day (see construct_graphs.temporal_graph)
+    :param n_jobs: number of worker processes, by default the number of cores
+    :param path: directory of the edge store
+    :return: a tuple of the (memory-mapped) travel time and predecessor matrices
+    """
+    import construct_graphs
+
+    A = construct_graphs.temporal_csr(time_interval, path)
+    n = A.shape[0]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    version = edge_store.version(time_interval, path)
+
+    # Outputs are written under temporary names and renamed when complete,
+    # so readers never see a half-computed matrix
+    os.makedirs(path, exist_ok=True)
+    for name, dtype in ((f"travel_times_{time_interval}", np.float32), (f"predecessors_{time_interval}", np.int32)):
+        np.lib.format.open_memmap(edge_store.array_file(name + ".tmp", path), mode="w+", dtype=dtype, shape=(n, n)).flush()
+
+    # Small chunks balance the work between workers
+    chunks = np.array_split(np.arange(n), min(n, 4 * n_jobs))
+    with span("routing.all_sources", interval=time_interval, jobs=n_jobs) as s, \
+            ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                initargs=(A, time_interval, path)) as executor:
+        s.graph(A)
+        sum(executor.map(_fill, chunks))
+
+    for name in (f"travel_times_{time_interval}", f"predecessors_{time_interval}"):
+        os.replace(edge_store.array_file(name + ".tmp", path), edge_store.array_file(name, path))
+    mark_current(time_interval, version, path)
+    return (edge_store.load_array(f"travel_times_{time_interval}", path),
+            edge_store.load_array(f"predecessors_{time_interval}", path))
+
+
+def mark_current(time_interval, version=None, path=edge_store.STORE_DIR):
+    """
+    Remember that the travel times of an interval are computed from the given version of
+    its edges (the current one by default), see is_current.
+    """
+    versions = {}
+    if os.path.exists(os.path.join(path, "travel_times.json")):
+        with open(os.path.join(path, "travel_times.json")) as f:
+            versions = json.load(f)
+    versions[str(time_interval)] = edge_store.version(time_interval, path) if version is None else version
+    with open(os.path.join(path, "travel_times.json"), "w") as f:
+        json.dump(versions, f)
+
+
+def is_current(time_interval, path=edge_store.STORE_DIR):
+    """
+    Whether precomputed travel times of an interval exist and match the current edges.
+    """
+    if not edge_store.has_array(f"travel_times_{time_interval}", path):
+        return False
+    try:
+        with open(os.path.join(path, "travel_times.json")) as f:
+            return json.load(f).get(str(time_interval)) == edge_store.version(time_interval, path)
+    except FileNotFoundError:
+        return False
+
+
+def all_sources(time_interval, n_jobs=None, path=edge_store.STORE_DIR):
+    """
+    Travel times and predecessors of shortest paths between all pairs of nodes, shared by
+    every analysis that needs them (features, evaluation, closeness, routing lookups).
+    They are computed once by precompute and memory-mapped by every later caller and process
+    until the edges of the interval change.
+    :return: a tuple of read-only memory-mapped travel time and predecessor matrices
+    """
+    if not is_current(time_interval, path):
+        return precompute(time_interval, n_jobs, path)
+    return (edge_store.load_array(f"travel_times_{time_interval}", path),
+            edge_store.load_array(f"predecessors_{time_interval}", path))
+
+
+class TravelTimes:
+    """
+    Precomputed travel times of all temporal graphs (see all_sources) for fast batch lookups.
+    The version of the edges is kept with every matrix, matrices of intervals whose edges changed
+    since (eg. by updates.apply_updates) are loaded again before a lookup. Versions are only read
+    again when the file of versions changed (see edge_store.versions_stamp), so a lookup costs one stat.
+    """
+
+    def __init__(self, intervals=range(4), path=edge_store.STORE_DIR):
+        """
+        Load the travel time matrices of the given intervals into one array,
+        predecessors are only memory-mapped, because they are needed just for paths.
+        :param intervals: time intervals to load
+        :param path: directory of the edge store
+        """
+        self.intervals = list(intervals)
+        self.store_path = path
+        self.versions = [None] * len(self.intervals)
+        self._stamp = None
+        self.times = None
+        self.predecessors = [None] * len(self.intervals)
+        # Slot of every loaded interval, -1 for intervals that are not loaded
+        self._slot = np.full(max(self.intervals) + 1, -1)
+        self._slot[self.intervals] = np.arange(len(self.intervals))
+        self._refresh()
+
+    def _refresh(self):
+        stamp = edge_store.versions_stamp(self.store_path)
+        if stamp is not None and stamp == self._stamp:
+            return
+        versions = edge_store.versions(self.store_path)
+        for slot, i in enumerate(self.intervals):
+            version = versions.get(str(i), 0)
+            if version == self.versions[slot]:
+                continue
+            D, P = all_sources(i, path=self.store_path)
+            if self.times is None:
+                self.times = np.empty((len(self.intervals),) + D.shape, dtype=D.dtype)
+            self.times[slot], self.predecessors[slot], self.versions[slot] = D, P, version
+        # The stamp is taken before reading, a change in between is found by the next lookup
+        self._stamp = stamp
+
+    def slots(self, time_interval):
+        """
+        Slots of time intervals in times.
+        :raise KeyError: if an interval is not loaded
+        """
+        time_interval = np.asarray(time_interval)
+        inside = (time_interval >= 0) & (time_interval < len(self._slot))
+        slot = np.where(inside, self._slot[np.where(inside, time_interval, 0)], -1)
+        if (slot < 0).any():
+            missing = np.unique(time_interval[slot < 0]).tolist()
+            raise KeyError(f"Travel times of intervals {missing} are not loaded, loaded are {self.intervals}")
+        return slot
+
+    def lookup(self, n1, n2, time_interval):
+        """
+        Travel times of many pairs at once.
+        :param n1: array of source nodes
+        :param n2: array of destination nodes
+        :param time_interval: array of time intervals (or a single interval for all pairs)
+        :return: array of travel times, inf where there is no path
+        """
+        slot = self.slots(time_interval)
+        self._refresh()
+        return self.times[slot, n1, n2]
+
+    def path(self, n1, n2, time_interval):
+        """
+        Shortest path from n1 to n2 as a list of nodes, None if there is no path.
+        """
+        slot = int(self.slots(time_interval))
+        self._refresh()
+        return shortest_path(self.predecessors[slot][n1], n1, n2)
+
+
+if __name__ == "__main__":
+    instrument.configure()
+    for i in range(4):
+        logger.info("Precomputing travel times in interval: %s", i)
+        precompute(i)
@@ -0,0 +1,122 @@
+import numpy as np
+
+import construct_graphs
+import edge_store
+import routing
+import travel_times
+
+
+def _merge(src, dst, time_interval, travel_time, n, path):
+    """
+    Add observations of one interval to the running means of its edges.
+    Existing edges are updated in place in the memory-mapped store, the files are
+    rewritten only when new edges appear.
+    :return: a tuple of src, dst, old and new weight of every changed edge (old is inf for new edges)
+    """
+    # Sum and count observations of the same edge first
+    keys, inverse = np.unique(src.astype(np.int64) * n + dst, return_inverse=True)
+    sums = np.bincount(inverse, weights=travel_time)
+    counts = np.bincount(inverse)
+
+    old_src, old_dst, _ = edge_store.load_edges(time_interval, path)
+    old_keys = old_src.astype(np.int64) * n + old_dst
+    pos = np.searchsorted(old_keys, keys).clip(max=max(len(old_keys) - 1, 0))
+    found = old_keys[pos] == keys if len(old_keys) else np.zeros(len(keys), dtype=bool)
+
+    # Edges are kept sorted by key (see edge_store.save_edges)
+    _, _, weight = edge_store.load_edges(time_interval, path, mmap_mode="r+")
+    count = edge_store.load_counts(time_interval, path, mmap_mode="r+")
+    p = pos[found]
+    old_weight = weight[p].astype(np.float64)
+    new_weight = (old_weight * count[p] + sums[found]) / (count[p] + counts[found])
+
+    if found.all() and isinstance(count, np.memmap):
+        weight[p] = new_weight
+        count[p] += counts[found]
+        weight.flush()
+        count.flush()
+        edge_store.bump_version(time_interval, path)
+    else:
+        weight, count = np.array(weight), np.array(count)
+        weight[p] = new_weight
+        count[p] += counts[found]
+        new = ~found
+        edge_store.save_edges(time_interval,
+                              np.concatenate([old_src, keys[new] // n]),
+                              np.concatenate([old_dst, keys[new] % n]),
+                              np.concatenate([weight, sums[new] / counts[new]]),
+                              np.concatenate([count, counts[new]]), path=path)
+
+    return (np.concatenate([keys[found] // n, keys[~found] // n]),
+            np.concatenate([keys[found] % n, keys[~found] % n]),
+            np.concatenate([old_weight, np.full((~found).sum(), np.inf)]),
+            np.concatenate([new_weight, sums[~found] / counts[~found]]))
+
+
+def affected_sources(D, P, src, dst, old_weight, new_weight):
+    """
+    Sources whose shortest paths can change after the weights of edges change:
+    sources that reach dst faster through a cheaper edge and sources whose
+    shortest path tree contains an edge that got more expensive.
+    :param D: travel time matrix (see travel_times.precompute)
+    :param P: predecessor matrix
+    :return: sorted array of source nodes
+    """
+    decreased = new_weight < old_weight
+    rows = np.zeros(D.shape[0], dtype=bool)
+    if decreased.any():
+        u, v, w = src[decreased], dst[decreased], new_weight[decreased]
+        rows |= (D[:, u] + w < D[:, v]).any(axis=1)
+    if (~decreased).any():
+        u, v = src[~decreased], dst[~decreased]
+        rows |= (P[:, v] == u).any(axis=1)
+    return np.flatnonzero(rows)
+
+
+def apply_updates(src, dst, time_interval, travel_time, path=edge_store.STORE_DIR):
+    """
+    Apply a batch of new travel time observations without rebuilding everything.
+    Means of the edges are updated in the edge store, rows of precomputed travel times
+    (see travel_times.py) are recomputed only for sources whose shortest paths are affected,
+    distances of existing landmarks (see routing.build_landmarks) are recomputed, and
+    cached centralities of changed intervals are invalidated through the version of the edges
+    (see pipeline.run).
+    :param src: array of source nodes
+    :param dst: array of destination nodes
+    :param time_interval: array of time intervals of the observations
+    :param travel_time: array of observed travel times
+    :param path: directory of the edge store
+    :return: dict with the number of changed edges and refreshed travel time rows per interval
+    """
+    src, dst = np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64)
+    time_interval = np.broadcast_to(time_interval, src.shape)
+    travel_time = np.asarray(travel_time, dtype=np.float64)
+    ids, _ = construct_graphs.read_nodes(path)
+    n = int(ids.max()) + 1
+
+    summary = {}
+    for i in np.unique(time_interval).tolist():
+        mask = time_interval == i
+        current = travel_times.is_current(i, path)
+        u, v, old_weight, new_weight = _merge(src[mask], dst[mask], i, travel_time[mask], n, path)
+        summary[i] = {"edges": len(u), "rows": 0}
+
+        if edge_store.has_array(f"travel_times_{i}", path):
+            D = edge_store.load_array(f"travel_times_{i}", path, mmap_mode="r+")
+            P = edge_store.load_array(f"predecessors_{i}", path, mmap_mode="r+")
+            rows = affected_sources(D, P, u, v, old_weight, new_weight)
+            if len(rows):
+                A = construct_graphs.temporal_csr(i, path)
+                D[rows], P[rows] = travel_times.shortest_paths(A, rows)
+                D.flush()
+                P.flush()
+            summary[i]["rows"] = len(rows)
+            # Refreshed rows make the matrices match the new edges again
+            if current:
+                travel_times.mark_current(i, path=path)
+
+        if edge_store.has_array(f"landmarks_{i}", path) and len(u):
+            A = construct_graphs.temporal_csr(i, path)
+            routing.save_landmarks(i, A, np.array(edge_store.load_array(f"landmarks_{i}", path)), path)
+
+    return summary